@@ -0,0 +1,409 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torch import nn
+from bleu import BLEU
+from datasets import CaptionDataset
+from decoding import beam_search, greedy_search
+from feature_cache import PrefixActivationCache
+from imaging import load_image
+from models import BACKBONES, Encoder, Decoder
+from models_backup import AdaptiveLSTMCell, FusedAdaptiveLSTMCell
+from utils import load_model
+
+
+def time_fn(fn, device, n_iter=100, n_warmup=10):
+    """
+    Times a function, synchronizing with the device so that asynchronous kernels are accounted for.
+
+    :param fn: function taking no arguments
+    :param device: device the function runs on
+    :param n_iter: number of timed calls
+    :param n_warmup: number of untimed calls (lets cudnn / the TorchScript fuser settle)
+    :return: mean seconds per call
+    """
+    for _ in range(n_warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(n_iter):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start) / n_iter
+
+
+def bench_backbones(args):
+    """
+    Measures encoder throughput per backbone; with trained checkpoints, also their BLEU-4 and CIDEr-D on the TEST split
+    configured in eval.py.
+    """
+    device = torch.device(args.device)
+    images = torch.randn(args.batch_size, 3, 256, 256, device=device)
+
+    if args.checkpoints:
+        import eval as evaluation
+
+        models = list()
+        for path in args.checkpoints:
+            encoder, decoder, model_device = load_model(path, device)
+            models.append((getattr(encoder, 'backbone', 'resnet101'), path, encoder, decoder, model_device))
+    else:
+        models = [(name, '-', Encoder(backbone=name, weights=None).to(device).eval(), None, device)
+                  for name in BACKBONES]
+
+    print('%-14s %-40s %12s %8s %8s' % ('backbone', 'checkpoint', 'images/sec', 'BLEU-4', 'CIDEr-D'))
+    for name, path, encoder, decoder, model_device in models:
+        with torch.no_grad():
+            t = time_fn(lambda: encoder(images.to(model_device)), model_device, args.n_iter)
+        scores = evaluation.evaluate(args.beam_size, encoder, decoder, model_device) if decoder else None
+        bleu4, cider = ('%.4f' % scores[0], '%.4f' % scores[1]) if scores else ('-', '-')
+        print('%-14s %-40s %12.1f %8s %8s' % (name, path, args.batch_size / t, bleu4, cider))
+
+
+def bench_bleu(args):
+    """
+    Checks the incremental BLEU against nltk's corpus_bleu, and times both.
+
+    Hypotheses are references with words randomly dropped and replaced, so that all n-gram orders partially match.
+    """
+    from nltk.translate.bleu_score import corpus_bleu
+
+    rng = random.Random(0)
+    if args.data_folder:
+        with open(os.path.join(args.data_folder, 'WORDMAP_' + args.data_name + '.json'), 'r') as j:
+            word_map = json.load(j)
+        dataset = CaptionDataset(args.data_folder, args.data_name, 'TEST')
+        references = dataset.references(ignore={word_map['<start>'], word_map['<end>'], word_map['<pad>']})
+        vocab_size = len(word_map)
+    else:
+        vocab_size = 2633
+        references = [[[rng.randrange(vocab_size) for _ in range(rng.randint(5, 20))] for _ in range(5)]
+                      for _ in range(1000)]
+    hypotheses = [[w if rng.random() < 0.8 else rng.randrange(vocab_size) for w in rng.choice(refs)
+                   if rng.random() < 0.9] for refs in references]
+
+    start = time.time()
+    nltk_scores = [corpus_bleu(references, hypotheses, weights=(1. / n,) * n) for n in range(1, 5)]
+    nltk_time = time.time() - start
+
+    start = time.time()
+    bleu = BLEU()
+    for i in range(0, len(hypotheses), args.batch_size):
+        bleu.update(references[i:i + args.batch_size], hypotheses[i:i + args.batch_size])
+    scores = [bleu.score(n) for n in range(1, 5)]
+    bleu_time = time.time() - start
+
+    print('%d hypotheses, %d references each\n' % (len(hypotheses), len(references[0])))
+    for n in range(4):
+        print('BLEU-%d: nltk %.10f, ours %.10f, |diff| %.1e' % (
+            n + 1, nltk_scores[n], scores[n], abs(nltk_scores[n] - scores[n])))
+        assert abs(nltk_scores[n] - scores[n]) < 1e-9
+    print('\nnltk: %.3fs (BLEU-1 to 4), ours: %.3fs (BLEU-1 to 4, batches of %d)' % (
+        nltk_time, bleu_time, args.batch_size))
+
+
+def bench_prefix_cache(args):
+    """
+    Compares a fine-tuning step of the encoder from pixels with one from cached prefix activations (read back from a
+    memory-mapped cache), and reports what the cache costs on disk.
+    """
+    device = torch.device(args.device)
+    encoder = Encoder(backbone=args.backbone, weights=None, pooled=True).to(device)
+    encoder.fine_tune(True)
+    encoder.train()
+    images = torch.randn(args.batch_size, 3, 256, 256, device=device)
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = PrefixActivationCache(cache_dir, 'BENCH', encoder, args.batch_size)
+        cache.create()
+        encoder.eval()
+        with torch.no_grad():
+            cache.write(list(range(args.batch_size)), encoder.forward_prefix(images))
+        encoder.train()
+        cache.flush()
+
+        def from_pixels():
+            encoder(images).sum().backward()
+
+        def from_cache():
+            activations = torch.from_numpy(np.stack([cache[i] for i in range(args.batch_size)]))
+            encoder(activations.to(device).float(), from_prefix=True).sum().backward()
+
+        # The frozen prefix stays in eval mode while training (see Encoder.train), so both compute the same outputs, up
+        # to the cache's float16
+        with torch.no_grad():
+            activations = torch.from_numpy(np.stack([cache[i] for i in range(args.batch_size)]))
+            diff = (encoder(images) - encoder(activations.to(device).float(), from_prefix=True)).abs().max().item()
+        print('max |from pixels - from cached prefix| = %.2e\n' % diff)
+
+        pixels_time = time_fn(from_pixels, device, args.n_iter)
+        cache_time = time_fn(from_cache, device, args.n_iter)
+        bytes_per_image = cache.disk_bytes() / args.batch_size
+    finally:
+        shutil.rmtree(cache_dir)
+
+    n_images = args.n_images
+    if args.data_folder:
+        dataset = CaptionDataset(args.data_folder, args.data_name, 'TRAIN')
+        n_images = len(dataset) // dataset.cpi
+    print('%-24s %14s' % ('encoder step', 'ms / batch'))
+    print('%-24s %14.1f' % ('from pixels', pixels_time * 1000))
+    print('%-24s %14.1f' % ('from cached prefix', cache_time * 1000))
+    print('\nSaves %.1f%% of encoder step time (%.1f ms per batch of %d)' % (
+        100 * (1 - cache_time / pixels_time), (pixels_time - cache_time) * 1000, args.batch_size))
+    print('Costs %.2f MB of disk per image, %.2f GB for %d images' % (
+        bytes_per_image / 2. ** 20, bytes_per_image * n_images / 2. ** 30, n_images))
+
+
+def decoding_inputs(args):
+    """
+    Model and encoded images for the decoding benchmarks.
+
+    Without a checkpoint, a randomly initialized model decodes random images: its captions mostly run to the maximum
+    length, which is the worst case.
+
+    :return: decoder, encoded images, index of <start>, index of <end>, device
+    """
+    device = torch.device(args.device)
+    if args.checkpoint:
+        encoder, decoder, device = load_model(args.checkpoint, device)
+    else:
+        torch.manual_seed(0)
+        encoder = Encoder(backbone='resnet18', weights=None, pooled=True).to(device).eval()
+        decoder = Decoder(embed_dim=512, decoder_dim=512, vocab_size=args.vocab_size,
+                          encoder_dim=encoder.encoder_dim).to(device).eval()
+    start, end = 0, 1
+    if args.data_folder:
+        with open(os.path.join(args.data_folder, 'WORDMAP_' + args.data_name + '.json'), 'r') as j:
+            word_map = json.load(j)
+        start, end = word_map['<start>'], word_map['<end>']
+        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        dataset = CaptionDataset(args.data_folder, args.data_name, 'TEST', transform=transforms.Compose([normalize]))
+        images = torch.stack([dataset[i * dataset.cpi][0] for i in range(args.n_images)])
+    else:
+        images = torch.randn(args.n_images, 3, 256, 256)
+
+    with torch.no_grad():
+        encoder_out = torch.cat([encoder(images[i:i + 32].to(device)) for i in range(0, args.n_images, 32)])
+    return decoder, encoder_out, start, end, device
+
+
+def bench_beam(args):
+    """
+    Measures beam search throughput (images/sec, decoding only) for several numbers of images decoded at once, and
+    checks that every batch size finds the same captions as decoding images one by one.
+    """
+    decoder, encoder_out, start, end, device = decoding_inputs(args)
+
+    def decode(batch_size):
+        seqs = list()
+        for i in range(0, args.n_images, batch_size):
+            seqs.extend(beam_search(decoder, encoder_out[i:i + batch_size], start, end, args.beam_size)[0])
+        return seqs
+
+    reference = None
+    print('%-12s %12s %12s' % ('batch size', 'images/sec', 'mismatches'))
+    for batch_size in args.batch_sizes:
+        t = time_fn(lambda: decode(batch_size), device, n_iter=1, n_warmup=0)
+        seqs = decode(batch_size)
+        if reference is None:
+            reference = seqs
+        mismatches = sum(a != b for a, b in zip(seqs, reference))
+        print('%-12d %12.1f %12d' % (batch_size, args.n_images / t, mismatches))
+
+
+def bench_greedy(args):
+    """
+    Measures greedy decoding throughput (images/sec, decoding only) against beam search with a beam size of 1, which
+    finds the same captions, for several numbers of images decoded at once.
+    """
+    decoder, encoder_out, start, end, device = decoding_inputs(args)
+
+    def decode(search, batch_size):
+        seqs = list()
+        for i in range(0, args.n_images, batch_size):
+            seqs.extend(search(encoder_out[i:i + batch_size])[0])
+        return seqs
+
+    searches = [('beam search, k=1', lambda x: beam_search(decoder, x, start, end, 1, args.max_length)),
+                ('greedy', lambda x: greedy_search(decoder, x, start, end, args.max_length))]
+    print('%-12s %20s %20s %12s' % ('batch size', searches[0][0] + ' img/s', searches[1][0] + ' img/s', 'mismatches'))
+    for batch_size in args.batch_sizes:
+        times, seqs = list(), list()
+        for name, search in searches:
+            times.append(time_fn(lambda: decode(search, batch_size), device, n_iter=1, n_warmup=0))
+            seqs.append(decode(search, batch_size))
+        mismatches = sum(a != b for a, b in zip(*seqs))
+        print('%-12d %20.1f %20.1f %12d' % (batch_size, args.n_images / times[0], args.n_images / times[1], mismatches))
+
+
+def bench_images(args):
+    """
+    Compares reading images with JPEGs decoded at a reduced size (see imaging.load_image) to reading them fully
+    decoded: images/sec, and how much the images read differ.
+
+    Without an image folder, reads random JPEGs (by default of the size of most Flickr8k images, 500x375), which are
+    smooth enough to be compressed like photographs.
+
+    JPEGs are only decoded at a reduced size if that still leaves at least size pixels both ways, so 500x375 images are
+    decoded fully for a size of 256: the gain is with larger images, or smaller sizes.
+    """
+    temp_dir = None
+    if args.image_folder:
+        paths = sorted(os.path.join(args.image_folder, name) for name in os.listdir(args.image_folder)
+                       if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg'))[:args.n_images]
+    else:
+        temp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        paths = list()
+        for i in range(args.n_images):
+            noise = Image.fromarray(rng.randint(0, 256, (15, 20, 3)).astype(np.uint8))
+            paths.append(os.path.join(temp_dir, '%d.jpg' % i))
+            noise.resize(tuple(args.image_size), Image.BICUBIC).save(paths[-1], quality=90)
+
+    try:
+        times, images = list(), list()
+        for draft in (False, True):
+            start = time.time()
+            images.append(np.stack([load_image(path, args.size, draft) for path in paths]).astype(np.float32))
+            times.append(time.time() - start)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    diff = np.abs(images[1] - images[0])
+    print('%d images, resized to %dx%d\n' % (len(paths), args.size, args.size))
+    print('%-24s %12s' % ('decode', 'images/sec'))
+    print('%-24s %12.1f' % ('full', len(paths) / times[0]))
+    print('%-24s %12.1f' % ('reduced (draft)', len(paths) / times[1]))
+    print('\n|difference| (0-255): mean %.2f, 99th percentile %.0f, max %.0f' % (
+        diff.mean(), np.percentile(diff, 99), diff.max()))
+    print('Difference of the normalized images the encoder sees: mean %.4f' % (diff.mean() / 255. / 0.226))
+
+
+def bench_lstm(args):
+    """
+    Checks FusedAdaptiveLSTMCell against AdaptiveLSTMCell, then times both against nn.LSTMCell.
+    """
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    cell = AdaptiveLSTMCell(args.input_size, args.hidden_size).to(device)
+    cell.b_ih.data.uniform_(-0.1, 0.1)  # non-zero biases, so that the bias folding is actually checked
+    cell.b_hh.data.uniform_(-0.1, 0.1)
+    fused = FusedAdaptiveLSTMCell.from_cell(cell)
+    lstm = nn.LSTMCell(args.input_size, args.hidden_size).to(device)
+
+    inp = torch.randn(args.batch_size, args.input_size, device=device, requires_grad=True)
+    h = torch.randn(args.batch_size, args.hidden_size, device=device, requires_grad=True)
+    c = torch.randn(args.batch_size, args.hidden_size, device=device, requires_grad=True)
+
+    # Numerical parity, forward and backward
+    outs = cell(inp, (h, c))
+    grads = torch.autograd.grad(sum(o.sum() for o in outs), (inp, h, c))
+    fused_outs = fused(inp, (h, c))
+    fused_grads = torch.autograd.grad(sum(o.sum() for o in fused_outs), (inp, h, c))
+    for name, a, b in zip(['h', 'c', 's', 'd_inp', 'd_h', 'd_c'], list(outs) + list(grads),
+                          list(fused_outs) + list(fused_grads)):
+        diff = (a - b).abs().max().item()
+        print('max |%s - fused %s| = %.3e' % (name, name, diff))
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-5), name
+
+    # Speed, a full decode of args.steps steps, forward and backward
+    def run(step):
+        def fn():
+            ht, ct = h, c
+            total = 0.
+            for _ in range(args.steps):
+                out = step(inp, (ht, ct))
+                ht, ct = out[0], out[1]
+                total = total + ht.sum()
+            total.backward()
+
+        return fn
+
+    results = [('AdaptiveLSTMCell', time_fn(run(cell), device, args.n_iter)),
+               ('FusedAdaptiveLSTMCell', time_fn(run(fused), device, args.n_iter)),
+               ('nn.LSTMCell', time_fn(run(lstm), device, args.n_iter))]
+    print('\n%-24s %12s %10s' % ('cell', 'ms / decode', 'speedup'))
+    for name, t in results:
+        print('%-24s %12.3f %9.2fx' % (name, t * 1000, results[0][1] / t))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show, Attend, and Tell - Benchmarks')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='device to run on')
+    parser.add_argument('--n_iter', default=50, type=int, help='number of timed iterations')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    backbone_parser = subparsers.add_parser('backbones', help='encoder images/sec (and BLEU-4, CIDEr-D) per backbone')
+    backbone_parser.add_argument('--batch_size', default=32, type=int)
+    backbone_parser.add_argument('--checkpoints', nargs='*', help='trained checkpoints to evaluate, one per backbone')
+    backbone_parser.add_argument('--beam_size', default=3, type=int, help='beam size for BLEU-4')
+    backbone_parser.set_defaults(func=bench_backbones)
+
+    bleu_parser = subparsers.add_parser('bleu', help='incremental BLEU vs. nltk corpus_bleu')
+    bleu_parser.add_argument('--data_folder', help='folder with data files, to use its TEST references (default: random)')
+    bleu_parser.add_argument('--data_name', default='flickr8k_5_cap_per_img_5_min_word_freq')
+    bleu_parser.add_argument('--batch_size', default=32, type=int)
+    bleu_parser.set_defaults(func=bench_bleu)
+
+    prefix_parser = subparsers.add_parser('prefix_cache',
+                                          help='encoder fine-tuning step from cached prefix activations')
+    prefix_parser.add_argument('--backbone', default='resnet101', choices=sorted(BACKBONES))
+    prefix_parser.add_argument('--batch_size', default=16, type=int)
+    prefix_parser.add_argument('--data_folder', help='folder with data files, to size the cache for its TRAIN split')
+    prefix_parser.add_argument('--data_name', default='flickr8k_5_cap_per_img_5_min_word_freq')
+    prefix_parser.add_argument('--n_images', default=6000, type=int, help='training images, without --data_folder')
+    prefix_parser.set_defaults(func=bench_prefix_cache)
+
+    beam_parser = subparsers.add_parser('beam', help='batched beam search images/sec vs. images per batch')
+    beam_parser.add_argument('--checkpoint', help='trained checkpoint (default: random model)')
+    beam_parser.add_argument('--data_folder', help='folder with data files, to decode TEST images (default: random)')
+    beam_parser.add_argument('--data_name', default='flickr8k_5_cap_per_img_5_min_word_freq')
+    beam_parser.add_argument('--vocab_size', default=2633, type=int, help='vocabulary size of the random model')
+    beam_parser.add_argument('--beam_size', default=5, type=int)
+    beam_parser.add_argument('--n_images', default=64, type=int)
+    beam_parser.add_argument('--batch_sizes', default=[1, 8, 32, 64], type=int, nargs='+',
+                             help='images per batch; the first one is the reference for mismatches')
+    beam_parser.set_defaults(func=bench_beam)
+
+    greedy_parser = subparsers.add_parser('greedy', help='greedy decoding vs. beam search with a beam size of 1')
+    greedy_parser.add_argument('--checkpoint', help='trained checkpoint (default: random model)')
+    greedy_parser.add_argument('--data_folder', help='folder with data files, to decode TEST images (default: random)')
+    greedy_parser.add_argument('--data_name', default='flickr8k_5_cap_per_img_5_min_word_freq')
+    greedy_parser.add_argument('--vocab_size', default=2633, type=int, help='vocabulary size of the random model')
+    greedy_parser.add_argument('--max_length', default=51, type=int, help='number of words to decode at most')
+    greedy_parser.add_argument('--n_images', default=256, type=int)
+    greedy_parser.add_argument('--batch_sizes', default=[1, 32, 128], type=int, nargs='+', help='images per batch')
+    greedy_parser.set_defaults(func=bench_greedy)
+
+    images_parser = subparsers.add_parser('images', help='reduced-size JPEG decoding vs. full decoding')
+    images_parser.add_argument('--image_folder', help='folder of JPEGs, e.g. Flickr8k_Dataset (default: random JPEGs)')
+    images_parser.add_argument('--image_size', default=[500, 375], type=int, nargs=2,
+                               help='width and height of the random JPEGs')
+    images_parser.add_argument('--n_images', default=500, type=int, help='images to read at most')
+    images_parser.add_argument('--size', default=256, type=int, help='size to resize to')
+    images_parser.set_defaults(func=bench_images)
+
+    lstm_parser = subparsers.add_parser('lstm', help='fused vs. unfused sentinel LSTM cell')
+    lstm_parser.add_argument('--batch_size', default=32, type=int)
+    lstm_parser.add_argument('--input_size', default=512 + 2048, type=int, help='embed_dim + encoder_dim')
+    lstm_parser.add_argument('--hidden_size', default=512, type=int)
+    lstm_parser.add_argument('--steps', default=20, type=int, help='decode steps per iteration')
+    lstm_parser.set_defaults(func=bench_lstm)
+
+    args = parser.parse_args()
+    args.func(args)
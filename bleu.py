@@ -0,0 +1,134 @@
+import math
+import sys
+import numpy as np
+
+
+def ngram_codes(tokens, sentence_ids, n, base):
+    """
+    Encodes every n-gram that doesn't straddle two sentences as a single integer.
+
+    The code is the n-gram read as a number in base `base`, so it is exact as long as base ** n fits in 64 bits (a
+    vocabulary of up to 65535 words for 4-grams); beyond that it wraps around and becomes a hash.
+
+    :param tokens: word indices of all sentences one after the other, a uint64 array
+    :param sentence_ids: sentence every token belongs to, an int64 array
+    :param n: n-gram order
+    :param base: larger than any word index
+    :return: codes, sentence of every n-gram
+    """
+    n_windows = len(tokens) - n + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    valid = sentence_ids[:n_windows] == sentence_ids[n - 1:]
+    codes = np.zeros(n_windows, dtype=np.uint64)
+    for j in range(n):
+        codes = codes * np.uint64(base) + tokens[j:j + n_windows]
+    return codes[valid], sentence_ids[:n_windows][valid]
+
+
+def flatten(sentences):
+    """
+    :param sentences: list of lists of word indices
+    :return: all tokens one after the other, sentence of every token, length of every sentence
+    """
+    lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+    tokens = np.fromiter((w for s in sentences for w in s), dtype=np.uint64, count=int(lengths.sum()))
+    sentence_ids = np.repeat(np.arange(len(sentences), dtype=np.int64), lengths)
+    return tokens, sentence_ids, lengths
+
+
+class BLEU(object):
+    """
+    Corpus-level BLEU-1 to BLEU-4, accumulated batch by batch.
+
+    Matches nltk.translate.bleu_score.corpus_bleu without smoothing: precisions are clipped n-gram matches summed over
+    the corpus, and the brevity penalty uses, for every hypothesis, the reference length closest to its own. Only these
+    sums are kept, so memory doesn't grow with the size of the corpus.
+    """
+
+    def __init__(self, max_n=4):
+        """
+        :param max_n: highest n-gram order
+        """
+        self.max_n = max_n
+        self.matches = np.zeros(max_n, dtype=np.int64)  # clipped n-gram matches
+        self.totals = np.zeros(max_n, dtype=np.int64)  # hypothesis n-grams (at least 1 per hypothesis, as in nltk)
+        self.hyp_len = 0
+        self.ref_len = 0
+
+    def update(self, references, hypotheses):
+        """
+        Adds a batch of hypotheses.
+
+        :param references: list, for every hypothesis, of its reference captions (lists of word indices)
+        :param hypotheses: list of hypotheses (lists of word indices)
+        """
+        assert len(references) == len(hypotheses)
+        if len(hypotheses) == 0:
+            return
+        hyp_tokens, hyp_ids, hyp_lens = flatten(hypotheses)
+        refs = [r for img_refs in references for r in img_refs]
+        ref_tokens, ref_ids, ref_lens = flatten(refs)
+        ref_sentence = np.repeat(np.arange(len(references), dtype=np.int64), [len(r) for r in references])
+        base = int(max(hyp_tokens.max(initial=0), ref_tokens.max(initial=0))) + 1
+
+        for n in range(1, self.max_n + 1):
+            hyp_codes, hyp_sentence = ngram_codes(hyp_tokens, hyp_ids, n, base)
+            ref_codes, ref_id = ngram_codes(ref_tokens, ref_ids, n, base)
+            self.totals[n - 1] += np.maximum(hyp_lens - n + 1, 1).sum()
+            if len(hyp_codes) == 0 or len(ref_codes) == 0:
+                continue
+
+            # Number the distinct n-grams of the batch densely, so that (sentence, n-gram) pairs fit in one integer
+            _, dense = np.unique(np.concatenate([hyp_codes, ref_codes]), return_inverse=True)
+            dense = dense.reshape(-1)
+            n_codes = int(dense.max()) + 1
+            hyp_keys = hyp_sentence * n_codes + dense[:len(hyp_codes)]
+            ref_dense = dense[len(hyp_codes):]
+
+            # Count of every n-gram in every hypothesis
+            hyp_keys, hyp_counts = np.unique(hyp_keys, return_counts=True)
+
+            # Maximum count of every n-gram over the references of a hypothesis
+            ref_keys, ref_counts = np.unique(ref_id * n_codes + ref_dense, return_counts=True)
+            ref_keys = ref_sentence[ref_keys // n_codes] * n_codes + ref_keys % n_codes
+            order = np.argsort(ref_keys, kind='stable')
+            ref_keys, ref_counts = ref_keys[order], ref_counts[order]
+            starts = np.flatnonzero(np.r_[True, ref_keys[1:] != ref_keys[:-1]])
+            ref_keys, max_ref_counts = ref_keys[starts], np.maximum.reduceat(ref_counts, starts)
+
+            # Clip hypothesis counts by them
+            pos = np.minimum(np.searchsorted(ref_keys, hyp_keys), len(ref_keys) - 1)
+            found = ref_keys[pos] == hyp_keys
+            self.matches[n - 1] += np.minimum(hyp_counts, np.where(found, max_ref_counts[pos], 0)).sum()
+
+        # Closest reference length to every hypothesis' (the shorter one on ties)
+        span = int(ref_lens.max(initial=0)) + 1
+        distance = np.abs(ref_lens - hyp_lens[ref_sentence]) * span + ref_lens
+        starts = np.r_[0, np.cumsum([len(r) for r in references])[:-1]]
+        self.hyp_len += int(hyp_lens.sum())
+        self.ref_len += int((np.minimum.reduceat(distance, starts) % span).sum())
+
+    def merge(self, other):
+        """
+        Adds the counts of another accumulator (e.g. from another process).
+
+        :param other: BLEU
+        """
+        self.matches += other.matches
+        self.totals += other.totals
+        self.hyp_len += other.hyp_len
+        self.ref_len += other.ref_len
+
+    def score(self, n=4):
+        """
+        :param n: n-gram order
+        :return: BLEU-n, with uniform weights over 1- to n-grams
+        """
+        if self.matches[0] == 0 or self.hyp_len == 0:
+            return 0.
+        bp = 1. if self.hyp_len > self.ref_len else math.exp(1 - self.ref_len / self.hyp_len)
+        # Like nltk, a precision of 0 stands in as the smallest float, rather than zeroing the score outright
+        log_precisions = (math.log(m / t) if m > 0 else math.log(sys.float_info.min)
+                          for m, t in zip(self.matches[:n].tolist(), self.totals[:n].tolist()))
+        return bp * math.exp(math.fsum((1. / n) * lp for lp in log_precisions))
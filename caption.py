@@ -1,19 +1,45 @@
 import torch
-import torch.nn.functional as F
 import numpy as np
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import torchvision.transforms as transforms
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import skimage.transform
 import argparse
-from scipy.misc import imread, imresize
 from PIL import Image
+from imaging import load_image
+from caption_cache import CaptionCache, model_id
+from utils import load_model
+from export import load_word_map
+from decoding import beam_search, greedy_search, max_decode_length
+from render import render, Renderer
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp'}
 
-def caption_image_beam_search(encoder, decoder, image_path, word_map, beam_size=3):
+
+def read_image(image_path):
+    """
+    Reads an image and prepares it for the encoder: RGB, resized to 256x256, scaled to [0, 1] and normalized.
+
+    :param image_path: path to image (or file object)
+    :return: image, a tensor of dimensions (3, 256, 256)
+    """
+    img = load_image(image_path)
+    img = img.transpose(2, 0, 1)
+    img = img / 255.
+    img = torch.FloatTensor(img)
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                     std=[0.229, 0.224, 0.225])
+    transform = transforms.Compose([normalize])
+    return transform(img)  # (3, 256, 256)
+
+
+def caption_image_beam_search(encoder, decoder, image_path, word_map, beam_size=3, greedy=False, max_length=51):
     """
     Reads an image and captions it with beam search.
 
@@ -22,129 +48,186 @@ def caption_image_beam_search(encoder, decoder, image_path, word_map, beam_size=
     :param image_path: path to image
     :param word_map: word map
     :param beam_size: number of sequences to consider at each decode-step
+    :param greedy: decode greedily instead (what a beam size of 1 finds, faster)?
+    :param max_length: number of words to decode at most
     :return: caption, weights for visualization
     """
-
-    k = beam_size
-    vocab_size = len(word_map)
-
     # Read image and process
-    img = imread(image_path)
-    if len(img.shape) == 2:
-        img = img[:, :, np.newaxis]
-        img = np.concatenate([img, img, img], axis=2)
-    img = imresize(img, (256, 256))
-    img = img.transpose(2, 0, 1)
-    img = img / 255.
-    img = torch.FloatTensor(img).to(device)
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                     std=[0.229, 0.224, 0.225])
-    transform = transforms.Compose([normalize])
-    image = transform(img)  # (3, 256, 256)
+    image = read_image(image_path).to(device)  # (3, 256, 256)
 
     # Encode
     image = image.unsqueeze(0)  # (1, 3, 256, 256)
-    encoder_out = encoder(image)  # (1, enc_image_size, enc_image_size, encoder_dim)
-    enc_image_size = encoder_out.size(1)
-    encoder_dim = encoder_out.size(3)
-
-    # Flatten encoding
-    encoder_out = encoder_out.view(1, -1, encoder_dim)  # (1, num_pixels, encoder_dim)
-    num_pixels = encoder_out.size(1)
-
-    # We'll treat the problem as having a batch size of k
-    encoder_out = encoder_out.expand(k, num_pixels, encoder_dim)  # (k, num_pixels, encoder_dim)
-
-    # Tensor to store top k previous words at each step; now they're just <start>
-    k_prev_words = torch.LongTensor([[word_map['<start>']]] * k).to(device)  # (k, 1)
-
-    # Tensor to store top k sequences; now they're just <start>
-    seqs = k_prev_words  # (k, 1)
-
-    # Tensor to store top k sequences' scores; now they're just 0
-    top_k_scores = torch.zeros(k, 1).to(device)  # (k, 1)
-
-    # Tensor to store top k sequences' alphas; now they're just 1s
-    seqs_alpha = torch.ones(k, 1, enc_image_size, enc_image_size).to(device)  # (k, 1, enc_image_size, enc_image_size)
-
-    # Lists to store completed sequences, their alphas and scores
-    complete_seqs = list()
-    complete_seqs_alpha = list()
-    complete_seqs_scores = list()
+    with torch.no_grad():
+        encoder_out = encoder(image)  # (1, enc_image_size, enc_image_size, encoder_dim)
+
+    # Decode, as eval.py does, also recording the weights of the best sequence for visualization
+    if greedy:
+        seqs, _, alphas = greedy_search(decoder, encoder_out, word_map['<start>'], word_map['<end>'], max_length,
+                                        return_alphas=True)
+    else:
+        seqs, _, alphas = beam_search(decoder, encoder_out, word_map['<start>'], word_map['<end>'], beam_size,
+                                      max_length, return_alphas=True)
+    seq = seqs[0]
+    enc_image_size = int(round(alphas.size(2) ** 0.5))
+    alphas = alphas[0, :len(seq)].view(-1, enc_image_size, enc_image_size)  # (len(seq), enc_image_size, ...)
 
-    # Start decoding
-    step = 1
-    h, c = decoder.init_hidden_state(encoder_out)
-
-    # s is a number less than or equal to k, because sequences are removed from this process once they hit <end>
-    while True:
-
-        embeddings = decoder.embedding(k_prev_words).squeeze(1)  # (s, embed_dim)
-
-        awe, alpha = decoder.attention(encoder_out, h)  # (s, encoder_dim), (s, num_pixels)
-
-        alpha = alpha.view(-1, enc_image_size, enc_image_size)  # (s, enc_image_size, enc_image_size)
+    return seq, alphas
 
-        gate = decoder.sigmoid(decoder.f_beta(h))  # gating scalar, (s, encoder_dim)
-        awe = gate * awe
 
-        h, c = decoder.decode_step(torch.cat([embeddings, awe], dim=1), (h, c))  # (s, decoder_dim)
+def list_images(paths):
+    """
+    :param paths: images, folders (searched recursively for images) and .txt files listing images, one per line
+    :return: paths to the images, folders' in sorted order
+    """
+    images = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                images.extend(os.path.join(root, f) for f in sorted(files)
+                              if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS)
+        elif path.endswith('.txt'):
+            with open(path, 'r') as f:
+                images.extend(line.strip() for line in f if line.strip())
+        else:
+            images.append(path)
+    return images
 
-        scores = decoder.fc(h)  # (s, vocab_size)
-        scores = F.log_softmax(scores, dim=1)
 
-        # Add
-        scores = top_k_scores.expand_as(scores) + scores  # (s, vocab_size)
+def try_read_image(image_path, cache=None, params=None):
+    """
+    :param image_path: path to image
+    :param cache: caption_cache.CaptionCache to look the image's caption up in first, or None
+    :param params: decoding parameters for the cache's key, (beam_size, greedy, max_length)
+    :return: key of the image's caption in the cache (None without one), its cached result (None if it isn't), and
+             read_image's image (None if cached), or the exception reading it raised
+    """
+    try:
+        if cache is None:
+            return None, None, read_image(image_path)
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        key = cache.key(data, *params)
+        result = cache.get(key)
+        if result is not None:
+            return key, result, None
+        return key, None, read_image(image_path)  # from the page cache; errors name the file
+    except Exception as e:
+        return None, None, e
+
+
+def caption_images(encoder, decoder, image_paths, word_map, out, beam_size=3, greedy=False, max_length=51,
+                   batch_size=32, workers=8, skip_existing=True, renderer=None, cache=None):
+    """
+    Captions many images, writing a JSONL record for every one to a file.
 
-        # For the first step, all k points will have the same scores (since same k previous words, h, c)
-        if step == 1:
-            top_k_scores, top_k_words = scores[0].topk(k, 0, True, True)  # (s)
-        else:
-            # Unroll and find top scores, and their unrolled indices
-            top_k_scores, top_k_words = scores.view(-1).topk(k, 0, True, True)  # (s)
-
-        # Convert unrolled indices to actual indices of scores
-        prev_word_inds = top_k_words / vocab_size  # (s)
-        next_word_inds = top_k_words % vocab_size  # (s)
-
-        # Add new words to sequences, alphas
-        seqs = torch.cat([seqs[prev_word_inds], next_word_inds.unsqueeze(1)], dim=1)  # (s, step+1)
-        seqs_alpha = torch.cat([seqs_alpha[prev_word_inds], alpha[prev_word_inds].unsqueeze(1)],
-                               dim=1)  # (s, step+1, enc_image_size, enc_image_size)
-
-        # Which sequences are incomplete (didn't reach <end>)?
-        incomplete_inds = [ind for ind, next_word in enumerate(next_word_inds) if
-                           next_word != word_map['<end>']]
-        complete_inds = list(set(range(len(next_word_inds))) - set(incomplete_inds))
-
-        # Set aside complete sequences
-        if len(complete_inds) > 0:
-            complete_seqs.extend(seqs[complete_inds].tolist())
-            complete_seqs_alpha.extend(seqs_alpha[complete_inds].tolist())
-            complete_seqs_scores.extend(top_k_scores[complete_inds])
-        k -= len(complete_inds)  # reduce beam length accordingly
-
-        # Proceed with incomplete sequences
-        if k == 0:
-            break
-        seqs = seqs[incomplete_inds]
-        seqs_alpha = seqs_alpha[incomplete_inds]
-        h = h[prev_word_inds[incomplete_inds]]
-        c = c[prev_word_inds[incomplete_inds]]
-        encoder_out = encoder_out[prev_word_inds[incomplete_inds]]
-        top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
-        k_prev_words = next_word_inds[incomplete_inds].unsqueeze(1)
-
-        # Break if things have been going on too long
-        if step > 50:
-            break
-        step += 1
+    Images are read and resized by a pool of threads, a batch ahead of the one the models are working on, and encoded
+    and decoded in batches. Records are flushed after every batch, and images that already have a caption in the file
+    are skipped, so an interrupted run resumes where it stopped. With a cache, images whose caption it has (from this
+    run, or another one with the same model and parameters) aren't read, encoded or decoded again.
 
-    i = complete_seqs_scores.index(max(complete_seqs_scores))
-    seq = complete_seqs[i]
-    alphas = complete_seqs_alpha[i]
+    :param encoder: encoder model
+    :param decoder: decoder model
+    :param image_paths: paths to the images
+    :param word_map: word map
+    :param out: path to the JSONL file to append records to
+    :param beam_size: number of sequences to consider at each decode-step
+    :param greedy: decode greedily instead?
+    :param max_length: number of words to decode at most
+    :param batch_size: images per batch
+    :param workers: threads reading images
+    :param skip_existing: skip images already captioned in out?
+    :param renderer: render.Renderer to also render the captions and their weights with, or None
+    :param cache: caption_cache.CaptionCache to look captions up in and add them to, or None; not used with a
+                  renderer, as it doesn't keep weights
+    :return: number of images captioned, number that couldn't be read, number skipped
+    """
+    done = set()
+    if skip_existing and os.path.isfile(out):
+        with open(out, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by an interruption
+                if 'caption' in record:
+                    done.add(record['image'])
+    todo = [path for path in image_paths if path not in done]
 
-    return seq, alphas
+    rev_word_map = {v: k for k, v in word_map.items()}  # ix2word
+    special_words = {word_map['<start>'], word_map['<end>'], word_map['<pad>']}
+
+    def caption_of(seq):
+        return ' '.join(rev_word_map[w] for w in seq if w not in special_words)
+
+    if renderer is not None:
+        cache = None
+    params = (beam_size, greedy, max_length)
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    n_captioned = n_failed = 0
+    # An interrupted run may have left a line cut short, which the first new record mustn't be appended to
+    cut_short = False
+    if os.path.isfile(out) and os.path.getsize(out) > 0:
+        with open(out, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            cut_short = f.read(1) != b'\n'
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, open(out, 'a') as f:
+        if cut_short:
+            f.write('\n')
+        pending = [pool.submit(try_read_image, path, cache, params) for path in batches[0]] if batches else []
+        for b, paths in enumerate(batches):
+            keys, cached, images = zip(*[future.result() for future in pending])
+
+            # Read the next batch while this one is encoded and decoded
+            if b + 1 < len(batches):
+                pending = [pool.submit(try_read_image, path, cache, params) for path in batches[b + 1]]
+
+            records = dict()
+            ok = [i for i, image in enumerate(images) if image is not None and not isinstance(image, Exception)]
+            # With a cache, an image met more than once in the batch is captioned once
+            first = dict()
+            for i in ok:
+                first.setdefault(keys[i] or i, i)
+            duplicates = [i for i in ok if first[keys[i] or i] != i]
+            ok = [i for i in ok if first[keys[i] or i] == i]
+            for i in range(len(paths)):
+                if cached[i] is not None:
+                    records[i] = {'image': paths[i], 'caption': caption_of(cached[i]['seq']),
+                                  'complete': cached[i]['complete']}
+                elif isinstance(images[i], Exception):
+                    records[i] = {'image': paths[i], 'error': str(images[i])}
+            if ok:
+                with torch.no_grad():
+                    encoder_out = encoder(torch.stack([images[i] for i in ok]).to(device))
+                render = renderer is not None
+                if greedy:
+                    results = greedy_search(decoder, encoder_out, word_map['<start>'], word_map['<end>'],
+                                            max_length, return_alphas=render)
+                else:
+                    results = beam_search(decoder, encoder_out, word_map['<start>'], word_map['<end>'],
+                                          beam_size, max_length, return_alphas=render)
+                seqs, complete = results[:2]
+                if render:
+                    alphas = results[2]  # (len(ok), longest caption, num_pixels)
+                    enc_image_size = int(round(alphas.size(2) ** 0.5))
+                    renderer.submit([paths[i] for i in ok], seqs,
+                                    alphas.view(alphas.size(0), alphas.size(1), enc_image_size, enc_image_size),
+                                    rev_word_map)
+                for i, seq, c in zip(ok, seqs, complete):
+                    records[i] = {'image': paths[i], 'caption': caption_of(seq), 'complete': c}
+                    if cache is not None:
+                        cache.put(keys[i], {'seq': seq, 'complete': c})
+                for i in duplicates:
+                    records[i] = dict(records[first[keys[i]]], image=paths[i])
+
+            for i in range(len(paths)):
+                f.write(json.dumps(records[i]) + '\n')
+            f.flush()
+            n_read = sum(1 for record in records.values() if 'caption' in record)
+            n_captioned += n_read
+            n_failed += len(paths) - n_read
+    return n_captioned, n_failed, len(image_paths) - len(todo)
 
 
 def visualize_att(image_path, seq, alphas, rev_word_map, smooth=True):
@@ -189,30 +272,81 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Show, Attend, and Tell - Tutorial - Generate Caption')
 
     parser.add_argument('--img', '-i', help='path to image')
-    parser.add_argument('--model', '-m', help='path to model')
-    parser.add_argument('--word_map', '-wm', help='path to word map JSON')
+    parser.add_argument('--bulk', nargs='+', help='caption many images instead: images, folders of images, and .txt '
+                                                  'files listing images (one per line); see --out')
+    parser.add_argument('--out', '-o', default='captions.jsonl', help='JSONL file to append the captions to, in bulk')
+    parser.add_argument('--batch_size', default=32, type=int, help='images per batch, in bulk')
+    parser.add_argument('--workers', default=8, type=int, help='threads reading images, in bulk')
+    parser.add_argument('--redo', dest='skip_existing', action='store_false',
+                        help='in bulk, also caption images already captioned in --out')
+    parser.add_argument('--model', '-m', help='path to model (a checkpoint, or an artifact written by quantize.py or '
+                                              'export.py)')
+    parser.add_argument('--word_map', '-wm', help='path to word map JSON (default: that of an artifact written by '
+                                                  'export.py)')
     parser.add_argument('--beam_size', '-b', default=5, type=int, help='beam size for beam search')
+    parser.add_argument('--greedy', action='store_true', help='decode greedily (beam size 1, faster)')
+    parser.add_argument('--caplens', help='path to the training caption lengths JSON (TRAIN_CAPLENS_*.json), to decode '
+                                          'up to the longest (default: 51 words)')
+    parser.add_argument('--length_percentile', default=100., type=float,
+                        help='percentile of the training caption lengths to decode up to, with --caplens')
     parser.add_argument('--dont_smooth', dest='smooth', action='store_false', help='do not smooth alpha overlay')
+    parser.add_argument('--save', help='write the visualization to this PNG file instead of showing it')
+    parser.add_argument('--render_dir', help='in bulk, also render every caption\'s visualization to this folder')
+    parser.add_argument('--render_workers', default=4, type=int, help='processes rendering visualizations, in bulk')
+    parser.add_argument('--frames', action='store_true', help='render one PNG per word rather than a grid')
+    parser.add_argument('--cache_dir', help='in bulk, also keep captions in this folder, for later runs with the same '
+                                            'model and parameters to reuse (not with --render_dir)')
+    parser.add_argument('--cache_entries', default=10000, type=int,
+                        help='captions to keep in memory, in bulk, for images met again (0, without --cache_dir: none)')
+    parser.add_argument('--cache_mb', default=1024., type=float, help='MB of captions to keep in --cache_dir at most')
 
     args = parser.parse_args()
 
     # Load model
-    checkpoint = torch.load(args.model, map_location='cuda:0')
-    decoder = checkpoint['decoder']
-    decoder = decoder.to(device)
-    decoder.eval()
-    encoder = checkpoint['encoder']
-    encoder = encoder.to(device)
-    encoder.eval()
+    encoder, decoder, device = load_model(args.model, device)
 
     # Load word map (word2ix)
-    with open(args.word_map, 'r') as j:
-        word_map = json.load(j)
+    if args.word_map:
+        with open(args.word_map, 'r') as j:
+            word_map = json.load(j)
+    else:
+        word_map = load_word_map(args.model)
     rev_word_map = {v: k for k, v in word_map.items()}  # ix2word
 
-    # Encode, decode with attention and beam search
-    seq, alphas = caption_image_beam_search(encoder, decoder, args.img, word_map, args.beam_size)
-    alphas = torch.FloatTensor(alphas)
-
-    # Visualize caption and attention of best sequence
-    visualize_att(args.img, seq, alphas, rev_word_map, args.smooth)
+    # Longest caption to decode
+    max_length = 51
+    if args.caplens:
+        with open(args.caplens, 'r') as j:
+            max_length = max_decode_length(json.load(j), args.length_percentile)
+
+    if args.bulk:
+        image_paths = list_images(args.bulk)
+        start = time.time()
+        renderer = Renderer(args.render_dir, args.render_workers, args.smooth, args.frames) if args.render_dir else None
+        cache = None
+        if renderer is None and (args.cache_entries > 0 or args.cache_dir):
+            cache = CaptionCache(model_id(args.model), args.cache_dir, args.cache_entries, int(args.cache_mb * 2 ** 20))
+        n_captioned, n_failed, n_skipped = caption_images(
+            encoder, decoder, image_paths, word_map, args.out, args.beam_size, args.greedy, max_length,
+            args.batch_size, args.workers, args.skip_existing, renderer, cache)
+        if renderer is not None:
+            renderer.close()
+        elapsed = time.time() - start
+        print('Captioned %d images in %.1fs (%.1f images/sec) to %s; %d could not be read, %d already captioned' % (
+            n_captioned, elapsed, n_captioned / max(elapsed, 1e-9), args.out, n_failed, n_skipped))
+        if cache is not None:
+            metrics = cache.metrics()
+            print('Caption cache: %d hits (%d from memory, %d from disk), %d misses, %d evicted from disk' % (
+                metrics['hits'], metrics['memory_hits'], metrics['disk_hits'], metrics['misses'], metrics['evictions']))
+    else:
+        # Encode, decode with attention and beam search (without the cache, which keeps captions but not the attention
+        # weights drawn here, as when rendering in bulk)
+        seq, alphas = caption_image_beam_search(encoder, decoder, args.img, word_map, args.beam_size, args.greedy,
+                                                max_length)
+        alphas = alphas.cpu()
+
+        # Visualize caption and attention of best sequence
+        if args.save:
+            render(args.img, seq, alphas, rev_word_map, args.save, args.smooth, args.frames)
+        else:
+            visualize_att(args.img, seq, alphas, rev_word_map, args.smooth)
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+def model_id(model_path, chunk_size=2 ** 20):
+    """
+    :param model_path: path to a model (a checkpoint or an artifact)
+    :param chunk_size: bytes read at a time
+    :return: digest of the file, which identifies the model in cache keys
+    """
+    digest = hashlib.md5()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CaptionCache(object):
+    """
+    Captions of images already captioned, so that an image captioned again (a retry, or the same image in another feed)
+    isn't encoded and decoded again.
+
+    Captions are keyed by the image file's bytes, the model and the decoding parameters (see key), so that a cached
+    caption is always the one captioning would find. The most recently used ones are kept in memory, and if a folder is
+    given, all of them are also saved there (one small JSON file each), up to max_disk_bytes: beyond that, those used
+    least recently are deleted. The folder may be shared by several processes running the same model.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, model, cache_dir=None, max_entries=10000, max_disk_bytes=2 ** 30):
+        """
+        :param model: identifier of the model, see model_id
+        :param cache_dir: folder to save captions in, or None to only keep them in memory
+        :param max_entries: number of captions to keep in memory
+        :param max_disk_bytes: bytes of captions to keep in cache_dir at most
+        """
+        self.model = model
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()  # key: result, least recently used first
+        self.lock = threading.Lock()  # guards the entries, counters and disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0  # from disk
+        self.disk_bytes = 0
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self.disk_bytes = sum(size for _, size, _ in self.disk_entries())
+
+    def key(self, image_bytes, beam_size, greedy, max_length):
+        """
+        :param image_bytes: contents of the image file
+        :param beam_size: beam size for beam search
+        :param greedy: decoding greedily instead?
+        :param max_length: number of words to decode at most
+        :return: key of the image's caption, a hex digest
+        """
+        params = json.dumps([self.model, 'greedy' if greedy else beam_size, max_length])
+        return hashlib.md5(params.encode() + hashlib.md5(image_bytes).digest()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """
+        :param key: see key
+        :return: the result put with that key, or None
+        """
+        with self.lock:
+            if key in self.entries:
+                self.memory_hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        result = None
+        if self.cache_dir is not None:
+            path = self.path(key)
+            try:
+                with open(path, 'r') as f:
+                    result = json.load(f)
+                os.utime(path)  # used, so evicted last
+            except (IOError, OSError, ValueError):
+                result = None  # not cached, or evicted (or being written) by another process
+
+        with self.lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.remember(key, result)
+        return result
+
+    def put(self, key, result):
+        """
+        :param key: see key
+        :param result: what to return for that key, a JSON-serializable dict
+        """
+        with self.lock:
+            self.remember(key, result)
+        if self.cache_dir is None:
+            return
+
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name, so that a reader never sees a partial file
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(result, f)
+        size = os.path.getsize(tmp_path)
+        try:
+            size -= os.path.getsize(path)  # the caption it replaces, e.g. put by another process
+        except OSError:
+            pass  # not on disk yet
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.disk_bytes += size
+            evict = self.disk_bytes > self.max_disk_bytes
+        if evict:
+            self.evict()
+
+    def remember(self, key, result):
+        # With the lock held
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def disk_entries(self):
+        """
+        :return: (path, size, time last used) of every caption in cache_dir
+        """
+        entries = list()
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # evicted by another process
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """
+        Deletes the captions used least recently from cache_dir, down to 90% of max_disk_bytes, so that eviction (which
+        lists the whole folder) only happens every so many captions.
+        """
+        entries = sorted(self.disk_entries(), key=lambda entry: entry[2])
+        disk_bytes = sum(size for _, size, _ in entries)
+        evicted = 0
+        for path, size, _ in entries:
+            if disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # evicted by another process
+            disk_bytes -= size
+            evicted += 1
+        with self.lock:
+            self.disk_bytes = disk_bytes
+            self.evictions += evicted
+
+    def metrics(self):
+        """
+        :return: hits (from memory and from disk), misses, hit rate, and what the cache holds
+        """
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            return {'hits': hits,
+                    'memory_hits': self.memory_hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'hit_rate': hits / float(max(hits + self.misses, 1)),
+                    'entries': len(self.entries),
+                    'disk_bytes': self.disk_bytes,
+                    'evictions': self.evictions}
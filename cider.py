@@ -0,0 +1,159 @@
+import hashlib
+import json
+import math
+import os
+import pickle
+from collections import Counter
+
+
+def ngram_counts(sentence, max_n=4):
+    """
+    :param sentence: list of word indices
+    :param max_n: highest n-gram order
+    :return: Counter of the 1- to max_n-grams of the sentence, as tuples
+    """
+    counts = Counter()
+    for n in range(1, max_n + 1):
+        for i in range(len(sentence) - n + 1):
+            counts[tuple(sentence[i:i + n])] += 1
+    return counts
+
+
+def tfidf(counts, document_frequency, log_n_images, max_n=4):
+    """
+    Turns n-gram counts into one TF-IDF vector per n-gram order.
+
+    :param counts: Counter of n-grams, see ngram_counts
+    :param document_frequency: number of images whose references contain every n-gram
+    :param log_n_images: log of the number of images in the split
+    :param max_n: highest n-gram order
+    :return: vectors (one dict per order), their norms, number of bigrams (the length CIDEr-D's penalty compares)
+    """
+    vectors = [dict() for _ in range(max_n)]
+    norms = [0.] * max_n
+    length = 0
+    for ngram, tf in counts.items():
+        n = len(ngram) - 1
+        weight = tf * (log_n_images - math.log(max(1., document_frequency.get(ngram, 0.))))
+        vectors[n][ngram] = weight
+        norms[n] += weight ** 2
+        if n == 1:
+            length += tf
+    return vectors, [math.sqrt(norm) for norm in norms], length
+
+
+def reference_tables(references, cache_file=None, max_n=4):
+    """
+    Document frequencies and TF-IDF reference vectors of a split, which only depend on its references.
+
+    With a cache file they are computed once and then read back, as long as the references are the same (their digest
+    is stored alongside).
+
+    :param references: list, for every image of the split, of its reference captions (lists of word indices)
+    :param cache_file: pickle to read the tables from / write them to, or None
+    :param max_n: highest n-gram order
+    :return: tables, to score hypotheses with CIDErD
+    """
+    digest = hashlib.md5(json.dumps([references, max_n]).encode()).hexdigest()
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            tables = pickle.load(f)
+        if tables['digest'] == digest:
+            return tables
+
+    ref_counts = [[ngram_counts(ref, max_n) for ref in img_refs] for img_refs in references]
+
+    # An image counts once for every n-gram any of its references contains
+    document_frequency = Counter()
+    for img_counts in ref_counts:
+        document_frequency.update(set(ngram for counts in img_counts for ngram in counts))
+    log_n_images = math.log(float(len(references)))
+
+    tables = {'digest': digest,
+              'max_n': max_n,
+              'document_frequency': dict(document_frequency),
+              'log_n_images': log_n_images,
+              'references': [[tfidf(counts, document_frequency, log_n_images, max_n) for counts in img_counts]
+                             for img_counts in ref_counts]}
+
+    if cache_file is not None:
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())  # processes training together may all be writing it
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    return tables
+
+
+class CIDErD(object):
+    """
+    Corpus-level CIDEr-D, accumulated batch by batch.
+
+    Follows the coco-caption implementation: TF-IDF weighted n-gram cosine similarity to every reference, with the
+    hypothesis' weights clipped by the reference's and a Gaussian penalty on the length difference, averaged over
+    references and n-gram orders and scaled by 10. Document frequencies come from all references of the split (see
+    reference_tables), so only the hypotheses are processed here.
+    """
+
+    def __init__(self, tables, sigma=6.):
+        """
+        :param tables: reference tables of the split, see reference_tables
+        :param sigma: standard deviation of the length penalty
+        """
+        self.tables = tables
+        self.sigma = sigma
+        self.total = 0.  # sum of the scores of all hypotheses
+        self.count = 0  # number of hypotheses
+
+    def image_score(self, image, hypothesis):
+        """
+        :param image: index of the image in the split
+        :param hypothesis: list of word indices
+        :return: CIDEr-D of the hypothesis
+        """
+        max_n = self.tables['max_n']
+        hyp_vectors, hyp_norms, hyp_length = tfidf(ngram_counts(hypothesis, max_n),
+                                                   self.tables['document_frequency'], self.tables['log_n_images'],
+                                                   max_n)
+        references = self.tables['references'][image]
+        score = 0.
+        for ref_vectors, ref_norms, ref_length in references:
+            penalty = math.exp(-((hyp_length - ref_length) ** 2) / (2 * self.sigma ** 2))
+            for n in range(max_n):
+                ref_vector = ref_vectors[n]
+                similarity = 0.
+                for ngram, weight in hyp_vectors[n].items():
+                    ref_weight = ref_vector.get(ngram)
+                    if ref_weight is not None:
+                        similarity += min(weight, ref_weight) * ref_weight
+                if hyp_norms[n] != 0 and ref_norms[n] != 0:
+                    similarity /= hyp_norms[n] * ref_norms[n]
+                score += similarity * penalty
+        return score / (len(references) * max_n) * 10.
+
+    def update(self, images, hypotheses):
+        """
+        Adds a batch of hypotheses.
+
+        :param images: index in the split of the image of every hypothesis
+        :param hypotheses: list of hypotheses (lists of word indices)
+        """
+        assert len(images) == len(hypotheses)
+        for image, hypothesis in zip(images, hypotheses):
+            self.total += self.image_score(image, hypothesis)
+        self.count += len(hypotheses)
+
+    def merge(self, total, count):
+        """
+        Adds the sums of another accumulator (e.g. from another process, which needn't send its tables).
+
+        :param total: sum of its scores
+        :param count: number of its hypotheses
+        """
+        self.total += total
+        self.count += count
+
+    def score(self):
+        """
+        :return: CIDEr-D, averaged over hypotheses
+        """
+        return self.total / self.count if self.count else 0.
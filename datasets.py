@@ -1,5 +1,6 @@
+import math
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import h5py
 import json
 import os
@@ -59,5 +60,58 @@ class CaptionDataset(Dataset):
                 self.captions[((i // self.cpi) * self.cpi):(((i // self.cpi) * self.cpi) + self.cpi)])
             return img, caption, caplen, all_captions
 
+    def references(self, ignore):
+        """
+        Reference captions of every image, as lists of word indices, for computing BLEU.
+
+        :param ignore: word indices to leave out (e.g. those of <start> and <pad>)
+        :return: list, for every image, of its captions_per_image captions
+        """
+        captions = [[w for w in c if w not in ignore] for c in self.captions]
+        return [captions[i:i + self.cpi] for i in range(0, len(captions), self.cpi)]
+
     def __len__(self):
         return self.dataset_size
+
+
+class ResumableSampler(Sampler):
+    """
+    Shuffles a dataset the same way for a given seed and epoch, and can start an epoch part way through, so that a
+    resumed run sees exactly the batches the interrupted one had left.
+
+    Like DistributedSampler, it can also give every process its own shard of the data (padded, so that all processes
+    get as many items).
+    """
+
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        """
+        :param data_source: dataset to sample from
+        :param seed: seed of the shuffling, which is also offset by the epoch
+        :param num_replicas: number of processes sharing the data
+        :param rank: rank of this process
+        """
+        self.dataset_size = len(data_source)
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(self.dataset_size / float(num_replicas)))  # per process
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """
+        :param epoch: epoch to shuffle for
+        :param start: number of this process' items of the epoch to skip (those already trained on)
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.dataset_size, generator=generator).tolist()
+        indices += indices[:self.num_samples * self.num_replicas - self.dataset_size]  # pad to divide evenly
+        return iter(indices[self.rank::self.num_replicas][self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
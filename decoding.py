@@ -0,0 +1,246 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def init_state(decoder, encoder_out):
+    """
+    Prepares decoding for a batch of images.
+
+    :param decoder: decoder model, with or without attention
+    :param encoder_out: encoded images, a tensor of dimension (batch_size, enc_image_size, enc_image_size, encoder_dim)
+                        (or (batch_size, encoder_dim) if pooled, for decoders without attention)
+    :return: hidden state, cell state, and what the decoder reads from the images at every step: the encoded pixels
+             (batch_size, num_pixels, encoder_dim) for decoders with attention, the pooled context (batch_size,
+             encoder_dim) for the others
+    """
+    if hasattr(decoder, 'attention'):
+        memory = encoder_out.reshape(encoder_out.size(0), -1, encoder_out.size(-1))  # (batch_size, num_pixels, ...)
+        h, c = decoder.init_hidden_state(memory)
+    else:
+        mean_encoder_out, memory = decoder.pool(encoder_out)  # (batch_size, encoder_dim)
+        h, c = decoder.init_hidden_state(mean_encoder_out)
+    return h, c, memory
+
+
+def decode_step(decoder, words, h, c, memory):
+    """
+    Decodes one word for every sequence.
+
+    :param decoder: decoder model, with or without attention
+    :param words: previous word of every sequence, a tensor of dimension (n,)
+    :param h: hidden state, a tensor of dimension (n, decoder_dim)
+    :param c: cell state, a tensor of dimension (n, decoder_dim)
+    :param memory: what the decoder reads from the image of every sequence, see init_state
+    :return: log-probabilities of the next word (n, vocab_size), hidden state, cell state, and the weights put on
+             every pixel (n, num_pixels) (None for decoders without attention, which weigh all pixels the same)
+    """
+    embeddings = decoder.embedding(words)  # (n, embed_dim)
+    if hasattr(decoder, 'attention'):
+        awe, alpha = decoder.attention(memory, h)  # (n, encoder_dim), (n, num_pixels)
+        awe = decoder.sigmoid(decoder.f_beta(h)) * awe  # gating scalar
+        h, c = decoder.decode_step(torch.cat([embeddings, awe], dim=1), (h, c))  # (n, decoder_dim)
+        scores = decoder.fc(h)  # (n, vocab_size)
+    else:
+        alpha = None
+        h, c = decoder.decode_step(torch.cat([embeddings, memory], dim=1), (h, c))  # (n, decoder_dim)
+        scores = decoder.fc(decoder.linear(h))  # (n, vocab_size)
+    return F.log_softmax(scores, dim=1), h, c, alpha
+
+
+def num_pixels(decoder, memory):
+    """
+    :return: number of pixels the decoder weighs at every step
+    """
+    return memory.size(1) if hasattr(decoder, 'attention') else decoder.num_pixels
+
+
+def max_decode_length(caplens, percentile=100.):
+    """
+    Number of words to decode at most, from the lengths of the training captions.
+
+    :param caplens: lengths of the training captions, counting <start> and <end> (as in TRAIN_CAPLENS_*.json)
+    :param percentile: percentile of the lengths to allow for, 100 for the longest caption
+    :return: number of decode-steps (words after <start>, up to and including <end>)
+    """
+    return int(np.ceil(np.percentile(caplens, percentile))) - 1
+
+
+@torch.no_grad()
+def greedy_search(decoder, encoder_out, start, end, max_length=51, return_alphas=False):
+    """
+    Greedy decoding of a batch of images at once: the most likely word at every step, as beam search with a beam size
+    of 1 would find, but without any of the beam bookkeeping.
+
+    Captions are retired as soon as they reach <end>, and the decoder then only runs on the others.
+
+    :param decoder: decoder model, with or without attention
+    :param encoder_out: encoded images, a tensor of dimension (batch_size, ...), see init_state
+    :param start: index of <start>
+    :param end: index of <end>
+    :param max_length: number of words to decode at most
+    :param return_alphas: also return the weights put on every pixel for every word?
+    :return: sequence of every image (lists of word indices, from <start>), whether it reached <end>, and if
+             return_alphas, the weights, a tensor of dimensions (batch_size, max_length + 1, num_pixels) (those of
+             <start> are all 1s, and those past the end of a sequence 0s)
+    """
+    batch_size = encoder_out.size(0)
+    device = encoder_out.device
+    h, c, memory = init_state(decoder, encoder_out)
+    if return_alphas:
+        alphas = torch.zeros(batch_size, max_length + 1, num_pixels(decoder, memory), device=device)
+        alphas[:, 0] = 1.
+
+    seqs = torch.full((batch_size, max_length + 1), start, dtype=torch.long, device=device)
+    lengths = torch.full((batch_size,), max_length + 1, dtype=torch.long, device=device)
+    complete = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    words = torch.full((batch_size,), start, dtype=torch.long, device=device)  # (n_active)
+    active = torch.arange(batch_size, device=device)  # images still being captioned, (n_active)
+
+    for step in range(max_length):
+        log_probs, h, c, alpha = decode_step(decoder, words, h, c, memory)  # (n_active, vocab_size)
+        words = log_probs.argmax(dim=1)  # (n_active)
+        seqs[active, step + 1] = words
+        if return_alphas:
+            alphas[active, step + 1] = alpha if alpha is not None else 1. / alphas.size(2)
+
+        # Retire the captions that ended
+        ended = words == end  # (n_active)
+        if bool(ended.any()):
+            lengths[active[ended]] = step + 2
+            complete[active[ended]] = True
+            live = ~ended
+            active, words, h, c, memory = active[live], words[live], h[live], c[live], memory[live]
+            if active.size(0) == 0:
+                break
+
+    lengths = lengths.tolist()
+    sequences = [seq[:length] for seq, length in zip(seqs.tolist(), lengths)]
+    if return_alphas:
+        return sequences, complete.tolist(), alphas
+    return sequences, complete.tolist()
+
+
+@torch.no_grad()
+def beam_search(decoder, encoder_out, start, end, beam_size, max_length=51, return_alphas=False):
+    """
+    Beam search over a batch of images at once.
+
+    As in the one-image loop it replaces, every image starts with beam_size beams, a beam that reaches <end> is set
+    aside and the image's beam shrinks by one, and the best finished sequence wins.
+
+    All tensors keep a fixed size, though: every image has beam_size slots throughout, and beams that end (or that the
+    image's shrinking beam has no room for any more) are masked out with a score of -inf rather than removed. Words
+    and backpointers go to preallocated buffers, finished beams are recorded on the device, and the best sequences are
+    traced back once decoding is over; so the only synchronization with the host per step is checking whether any
+    beam is still live. If requested, the weights put on pixels are recorded the same way, in a buffer indexed by step
+    and slot, and traced back along with the words.
+
+    :param decoder: decoder model, with or without attention
+    :param encoder_out: encoded images, a tensor of dimension (batch_size, ...), see init_state
+    :param start: index of <start>
+    :param end: index of <end>
+    :param beam_size: number of sequences to consider at each decode-step
+    :param max_length: number of words to decode at most
+    :param return_alphas: also return the weights put on every pixel for every word of the best sequences?
+    :return: best sequence of every image (lists of word indices, from <start>), and whether it reached <end> (if no
+             beam of an image did, its best unfinished sequence is returned); and if return_alphas, the weights, a
+             tensor of dimensions (batch_size, longest sequence, num_pixels) (those of <start> are all 1s, and those
+             past the end of a sequence 0s)
+    """
+    batch_size = encoder_out.size(0)
+    k = beam_size
+    device = encoder_out.device
+    h, c, memory = init_state(decoder, encoder_out)
+
+    # Every image's beam_size slots share its image, and slots are only reordered within images, so the memory
+    # never needs reindexing
+    h = h.repeat_interleave(k, 0)  # (batch_size * k, decoder_dim)
+    c = c.repeat_interleave(k, 0)  # (batch_size * k, decoder_dim)
+    memory = memory.repeat_interleave(k, 0)  # (batch_size * k, ...)
+
+    # Before the first word all of an image's beams would be identical, so only its first slot is live
+    top_k_scores = torch.full((batch_size, k), float('-inf'), device=device)  # (batch_size, k)
+    top_k_scores[:, 0] = 0.
+    prev_words = torch.full((batch_size, k), start, dtype=torch.long, device=device)  # (batch_size, k)
+    beam = torch.full((batch_size,), k, dtype=torch.long, device=device)  # live beams every image may still have
+
+    # Word, and slot at the previous step it extends, of every slot at every step
+    words = torch.zeros(batch_size, max_length, k, dtype=torch.long, device=device)
+    backpointers = torch.zeros(batch_size, max_length, k, dtype=torch.long, device=device)
+    if return_alphas:
+        # Weights every slot put on the pixels at every step (before the slots are reordered)
+        step_alphas = torch.empty(batch_size, max_length, k, num_pixels(decoder, memory), device=device)
+
+    # Finished beams of every image in the order they ended (at most k), and a last column for writes to discard
+    finished_scores = torch.full((batch_size, k + 1), float('-inf'), device=device)
+    finished_steps = torch.zeros(batch_size, k + 1, dtype=torch.long, device=device)
+    finished_slots = torch.zeros(batch_size, k + 1, dtype=torch.long, device=device)
+    n_finished = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    ranks = torch.arange(k, device=device).unsqueeze(0).expand(batch_size, k)  # (batch_size, k)
+    offsets = torch.arange(batch_size, device=device).unsqueeze(1) * k  # first slot of every image, (batch_size, 1)
+
+    for step in range(max_length):
+        log_probs, h, c, alpha = decode_step(decoder, prev_words.view(-1), h, c, memory)  # (batch_size * k, vocab_size)
+        vocab_size = log_probs.size(1)
+        if return_alphas:
+            step_alphas[:, step] = alpha.view(batch_size, k, -1) if alpha is not None else 1. / step_alphas.size(3)
+        scores = top_k_scores.unsqueeze(2) + log_probs.view(batch_size, k, vocab_size)  # (batch_size, k, vocab_size)
+
+        # Top k of every image (masked slots score -inf, so only extend live beams); of those, an image whose beam
+        # shrank keeps only as many as it has room for
+        top_k_scores, top_k_words = scores.view(batch_size, -1).topk(k, 1, True, True)  # (batch_size, k)
+        prev_slots = top_k_words // vocab_size  # (batch_size, k)
+        prev_words = top_k_words % vocab_size  # (batch_size, k)
+        words[:, step] = prev_words
+        backpointers[:, step] = prev_slots
+        kept = ranks < beam.unsqueeze(1)  # (batch_size, k)
+
+        # Record the beams that ended, in order, and shrink their images' beams
+        ended = kept & (prev_words == end)  # (batch_size, k)
+        positions = torch.where(ended, n_finished.unsqueeze(1) + ended.long().cumsum(1) - 1, k)
+        finished_scores.scatter_(1, positions, top_k_scores)
+        finished_steps.scatter_(1, positions, torch.full_like(positions, step))
+        finished_slots.scatter_(1, positions, ranks)
+        n_ended = ended.long().sum(1)
+        n_finished += n_ended
+        beam -= n_ended
+
+        # Mask out beams that ended or weren't kept, and follow the others' backpointers
+        top_k_scores = top_k_scores.masked_fill(~kept | ended, float('-inf'))
+        slots = (offsets + prev_slots).view(-1)
+        h = h[slots]
+        c = c[slots]
+
+        if not bool((beam > 0).any()):
+            break
+
+    # Best finished beam of every image (the first found, on ties), or else its best live one
+    complete = n_finished > 0  # (batch_size)
+    best = finished_scores[:, :k].argmax(dim=1, keepdim=True)  # (batch_size, 1)
+    live = top_k_scores > float('-inf')  # (batch_size, k)
+    last_slots = torch.where(complete, finished_slots.gather(1, best).squeeze(1), live.long().argmax(dim=1))
+    last_steps = torch.where(complete, finished_steps.gather(1, best).squeeze(1), torch.full_like(last_slots, step))
+
+    # Trace the best beams back from their last words; a word's weights are those of the slot it extended
+    seqs = torch.full((batch_size, step + 2), start, dtype=torch.long, device=device)
+    if return_alphas:
+        alphas = torch.zeros(batch_size, step + 2, step_alphas.size(3), device=device)
+        alphas[:, 0] = 1.
+    slots = last_slots.unsqueeze(1)  # (batch_size, 1)
+    for t in range(step, -1, -1):
+        active = (t <= last_steps).unsqueeze(1)  # (batch_size, 1)
+        seqs[:, t + 1:t + 2] = torch.where(active, words[:, t].gather(1, slots), seqs[:, t + 1:t + 2])
+        prev_slots = backpointers[:, t].gather(1, slots)  # (batch_size, 1)
+        if return_alphas:
+            alpha = step_alphas[torch.arange(batch_size, device=device), t, prev_slots.squeeze(1)]
+            alphas[:, t + 1] = torch.where(active, alpha, alphas[:, t + 1])
+        slots = torch.where(active, prev_slots, slots)
+
+    lengths = (last_steps + 2).tolist()
+    sequences = [seq[:length] for seq, length in zip(seqs.tolist(), lengths)]
+    if return_alphas:
+        return sequences, complete.tolist(), alphas
+    return sequences, complete.tolist()
+
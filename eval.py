@@ -1,11 +1,17 @@
+import argparse
+import csv
+import glob
+from concurrent.futures import ThreadPoolExecutor
 import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
 import torchvision.transforms as transforms
 from datasets import *
 from utils import *
-from nltk.translate.bleu_score import corpus_bleu
-import torch.nn.functional as F
+from bleu import BLEU
+from cider import reference_tables, CIDErD
+from decoding import beam_search, greedy_search, max_decode_length
+from feature_cache import EncoderOutputCache
 from tqdm import tqdm
 
 # Parameters
@@ -13,178 +19,223 @@ data_folder = 'dataset_gaussian_0.01'  # folder with data files saved by create_
 data_name = 'flickr8k_5_cap_per_img_5_min_word_freq'  # base name shared by data files
 checkpoint = 'BEST_checkpoint_flickr8k_5_cap_per_img_5_min_word_freq.pth.tar'  # model checkpoint
 word_map_file = 'dataset_gaussian_0.01/WORDMAP_flickr8k_5_cap_per_img_5_min_word_freq.json'  # word map, ensure it's the same the data was encoded with and the model was trained with
-#device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # sets device for model and PyTorch tensors
-device = torch.device("cuda")
-torch.cuda.set_device(0)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # sets device for model and PyTorch tensors
+encoded_cache_dir = None  # folder to also save encoded TEST images in, for later runs (None: only kept in memory)
 
 cudnn.benchmark = True  # set to true only if inputs to model are fixed size; otherwise lot of computational overhead
 
-# Load model
-checkpoint = torch.load(checkpoint,map_location='cuda:0')
-decoder = checkpoint['decoder']
-decoder = decoder.to(device)
-decoder.eval()
-encoder = checkpoint['encoder']
-encoder = encoder.to(device)
-encoder.eval()
-
-# Load word map (word2ix)
-with open(word_map_file, 'r') as j:
-    word_map = json.load(j)
-rev_word_map = {v: k for k, v in word_map.items()}
-vocab_size = len(word_map)
-
 # Normalization transform
 normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                  std=[0.229, 0.224, 0.225])
 
+# Encoded TEST images, computed once per encoder whatever the beam sizes and decoders evaluated with it
+encoder_outputs = EncoderOutputCache(encoded_cache_dir)
 
-def evaluate(beam_size):
-    """
-    Evaluation
 
-    :param beam_size: beam size at which to generate captions for evaluation
-    :return: BLEU-4 score
+def read_word_map(path=None):
     """
-    # DataLoader
-    loader = torch.utils.data.DataLoader(
-        CaptionDataset(data_folder, data_name, 'TEST', transform=transforms.Compose([normalize])),
-        batch_size=1, shuffle=True, num_workers=1, pin_memory=True)
-
-    # TODO: Batched Beam Search
-
-    # Lists to store references (true captions), and hypothesis (prediction) for each image
-    # If for n images, we have n hypotheses, and references a, b, c... for each image, we need -
-    # references = [[ref1a, ref1b, ref1c], [ref2a, ref2b], ...], hypotheses = [hyp1, hyp2, ...]
-    references = list()
-    hypotheses = list()
-
-    # For each image
-    for i, (image, caps, caplens, allcaps) in enumerate(
-            tqdm(loader, desc="EVALUATING AT BEAM SIZE " + str(beam_size))):
-
-        k = beam_size
-
-        # Move to GPU device, if available
-        image = image.to(device)  # (1, 3, 256, 256)
-
-        # Encode
-        encoder_out = encoder(image)  # (1, enc_image_size, enc_image_size, encoder_dim)
-        enc_image_size = encoder_out.size(1)
-        encoder_dim = encoder_out.size(3)
-
-        # Flatten encoding
-        encoder_out = encoder_out.view(1, -1, encoder_dim)  # (1, num_pixels, encoder_dim)
-        num_pixels = encoder_out.size(1)
-
-        # We'll treat the problem as having a batch size of k
-        encoder_out = encoder_out.expand(k, num_pixels, encoder_dim)  # (k, num_pixels, encoder_dim)
-
-        # Tensor to store top k previous words at each step; now they're just <start>
-        k_prev_words = torch.LongTensor([[word_map['<start>']]] * k).to(device)  # (k, 1)
-
-        # Tensor to store top k sequences; now they're just <start>
-        seqs = k_prev_words  # (k, 1)
-
-        # Tensor to store top k sequences' scores; now they're just 0
-        top_k_scores = torch.zeros(k, 1).to(device)  # (k, 1)
-
-        # Lists to store completed sequences and scores
-        complete_seqs = list()
-        complete_seqs_scores = list()
-
-        # Start decoding
-        step = 1
-        h, c = decoder.init_hidden_state(encoder_out)
-
-        # s is a number less than or equal to k, because sequences are removed from this process once they hit <end>
-        while True:
-
-            embeddings = decoder.embedding(k_prev_words).squeeze(1)  # (s, embed_dim)
-            # embeddings = decoder.embedding(k_prev_words)# (s, embed_dim)
-
-            # awe, _ = decoder.attention(encoder_out, h)  # (s, encoder_dim), (s, num_pixels)
-
-            # gate = decoder.sigmoid(decoder.f_beta(h))  # gating scalar, (s, encoder_dim)
-            # awe = gate * awe
+    :param path: path to word map JSON (default: word_map_file)
+    :return: word map (word2ix)
+    """
+    with open(path or word_map_file, 'r') as j:
+        return json.load(j)
 
-            # awe = gate
 
-            # h, c = decoder.decode_step(torch.cat([embeddings, awe], dim=1), (h, c))  # (s, decoder_dim)
-            # print(embeddings.shape)
-            h, c = decoder.decode_step(torch.cat([embeddings, encoder_out.sum(dim=1).squeeze(1)], dim=1), (h, c))  # (s, decoder_dim)
+def load_test_split(folder):
+    """
+    Loads the TEST split of a dataset folder, reading all its images into memory (so that it can be done ahead of
+    time, e.g. while the previous folder is being evaluated).
 
-            scores = decoder.fc(decoder.linear(h))  # (s, vocab_size)
-            scores = F.log_softmax(scores, dim=1)
+    :param folder: folder with data files saved by create_input_files.py
+    :return: CaptionDataset
+    """
+    dataset = CaptionDataset(folder, data_name, 'TEST', transform=transforms.Compose([normalize]))
+    dataset.imgs = dataset.imgs[()]  # (n_images, 3, 256, 256), uint8
+    return dataset
 
 
-            # Add
-            scores = top_k_scores.expand_as(scores) + scores  # (s, vocab_size)
+def corruption_of(folder):
+    """
+    Parses the corruption of a dataset folder's images and its severity from the folder's name, e.g.
+    'dataset_motion_blur_3' -> ('motion_blur', 3.0); folders without a corruption ('dataset', 'clean') are 'clean'.
 
-            # For the first step, all k points will have the same scores (since same k previous words, h, c)
-            if step == 1:
-                top_k_scores, top_k_words = scores[0].topk(k, 0, True, True)  # (s)
-            else:
-                # Unroll and find top scores, and their unrolled indices
-                top_k_scores, top_k_words = scores.view(-1).topk(k, 0, True, True)  # (s)
+    :param folder: folder with data files
+    :return: corruption, severity (or None)
+    """
+    name = os.path.basename(os.path.normpath(folder))
+    parts = [part for part in name.split('_') if part]
+    if parts and parts[0] == 'dataset':
+        parts = parts[1:]
+    severity = None
+    if parts:
+        try:
+            severity = float(parts[-1])
+            parts = parts[:-1]
+        except ValueError:
+            pass
+    return '_'.join(parts) or 'clean', severity
 
-            # Convert unrolled indices to actual indices of scores
-            prev_word_inds = top_k_words / vocab_size  # (s)
-            next_word_inds = top_k_words % vocab_size  # (s)
 
-            # Add new words to sequences
-            seqs = torch.cat([seqs[prev_word_inds], next_word_inds.unsqueeze(1)], dim=1)  # (s, step+1)
+def evaluate(beam_size, encoder, decoder, device=device, batch_size=32, greedy=False, max_length=51,
+             data_folder=data_folder, dataset=None, word_map=None):
+    """
+    Evaluation
 
-            # Which sequences are incomplete (didn't reach <end>)?
-            incomplete_inds = [ind for ind, next_word in enumerate(next_word_inds) if
-                               next_word != word_map['<end>']]
-            complete_inds = list(set(range(len(next_word_inds))) - set(incomplete_inds))
-            # print(seqs)
-            # print(incomplete_inds)
-            # Set aside complete sequences
-            if len(complete_inds) > 0:
-                complete_seqs.extend(seqs[complete_inds].tolist())
-                complete_seqs_scores.extend(top_k_scores[complete_inds])
-            k -= len(complete_inds)  # reduce beam length accordingly
+    :param beam_size: beam size at which to generate captions for evaluation
+    :param encoder: encoder model
+    :param decoder: decoder model
+    :param device: device the models are on
+    :param batch_size: number of images to decode at once
+    :param greedy: decode greedily instead (what a beam size of 1 finds, faster)?
+    :param max_length: number of words to decode at most
+    :param data_folder: folder with the data files of the TEST split to evaluate on
+    :param dataset: its TEST split, if already loaded (see load_test_split)
+    :param word_map: word map the data was encoded with (default: read from word_map_file)
+    :return: BLEU-4 score, CIDEr-D score
+    """
+    if word_map is None:
+        word_map = read_word_map()
+
+    # Every image has captions_per_image captions, but only needs encoding and captioning once (counting every image
+    # captions_per_image times, as when iterating over all captions, scales all n-gram statistics alike and so doesn't
+    # change BLEU-4 or CIDEr-D)
+    if dataset is None:
+        dataset = CaptionDataset(data_folder, data_name, 'TEST', transform=transforms.Compose([normalize]))
+    name = os.path.basename(os.path.normpath(data_folder)) + '_TEST_' + data_name
+    encoded = encoder_outputs.get(dataset, name, encoder, device, batch_size)  # (n_images, ...)
+
+    # N-gram statistics of the references (true captions) and hypothesis (prediction) for each image, for BLEU-4
+    bleu = BLEU()
+
+    # References, without <start>, <end> and pads
+    special_words = {word_map['<start>'], word_map['<end>'], word_map['<pad>']}
+    references = dataset.references(ignore=special_words)
+
+    # Document frequencies and reference vectors for CIDEr-D only depend on the split, so they're cached next to it
+    cider = CIDErD(reference_tables(references, os.path.join(data_folder, 'CIDER_TEST_' + data_name + '.pkl')))
+
+    # For each batch of images
+    for i in tqdm(range(0, encoded.size(0), batch_size),
+                  desc="EVALUATING GREEDILY" if greedy else "EVALUATING AT BEAM SIZE " + str(beam_size)):
+        encoder_out = encoded[i:i + batch_size].to(device)  # (batch_size, ...)
+
+        # Decode all images (and their beams) together
+        if greedy:
+            seqs, complete = greedy_search(decoder, encoder_out, word_map['<start>'], word_map['<end>'], max_length)
+        else:
+            seqs, complete = beam_search(decoder, encoder_out, word_map['<start>'], word_map['<end>'], beam_size,
+                                         max_length)
 
-            # Proceed with incomplete sequences
-            if k == 0:
-                break
-            seqs = seqs[incomplete_inds]
-            h = h[prev_word_inds[incomplete_inds]]
-            c = c[prev_word_inds[incomplete_inds]]
-            encoder_out = encoder_out[prev_word_inds[incomplete_inds]]
-            top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
-            k_prev_words = next_word_inds[incomplete_inds].unsqueeze(1)
+        # Hypotheses
+        hypotheses = list()
+        for j, seq in enumerate(seqs):
+            if not complete[j]:
+                seq = seq[:20]  # no beam reached <end> in time
+            hypotheses.append([w for w in seq if w not in special_words])
 
-            # Break if things have been going on too long
-            if step > 50:
-                break
-            step += 1
-        try:
-            i = complete_seqs_scores.index(max(complete_seqs_scores))
-            seq = complete_seqs[i]
-        except ValueError:
-            seq = seqs[0][:20]
+        # N-grams of the whole batch counted at once
+        bleu.update(references[i:i + len(hypotheses)], hypotheses)
+        cider.update(list(range(i, i + len(hypotheses))), hypotheses)
 
-        # References
-        img_caps = allcaps[0].tolist()
-        img_captions = list(
-            map(lambda c: [w for w in c if w not in {word_map['<start>'], word_map['<end>'], word_map['<pad>']}],
-                img_caps))  # remove <start> and pads
-        references.append(img_captions)
+    # Calculate BLEU-4 and CIDEr-D scores
+    bleu4 = bleu.score(4)
 
-        # Hypotheses
-        hypotheses.append([w for w in seq if w not in {word_map['<start>'], word_map['<end>'], word_map['<pad>']}])
+    return bleu4, cider.score()
 
-        assert len(references) == len(hypotheses)
 
-    # Calculate BLEU-4 scores
-    bleu4 = corpus_bleu(references, hypotheses)
+def sweep(beam_sizes, checkpoints, data_folders=(data_folder,), device=device, batch_size=32, greedy=False,
+          max_length=51, word_map=None):
+    """
+    Evaluates every checkpoint at every beam size on the TEST split of every dataset folder.
+
+    Every checkpoint is loaded once, and every folder's images are read while the previous folder is being decoded.
+    Images are encoded only once per folder and distinct encoder (so once per folder for decoders trained on the same
+    frozen encoder).
+
+    :param beam_sizes: beam sizes to evaluate at
+    :param checkpoints: paths to checkpoints
+    :param data_folders: folders with data files, e.g. one per corruption and severity of the images
+    :param device: device to run the models on
+    :param batch_size: number of images to decode at once
+    :param greedy: decode greedily instead of at every beam size?
+    :param max_length: number of words to decode at most
+    :param word_map: word map the data was encoded with (default: read from word_map_file)
+    :return: one record per checkpoint, folder and beam size (None when decoding greedily), with the corruption and
+             severity of the folder (see corruption_of) and BLEU-4 and CIDEr-D scores
+    """
+    if word_map is None:
+        word_map = read_word_map()
+    models = [(path,) + load_model(path, device) for path in checkpoints]
+    records = list()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(load_test_split, data_folders[0])
+        for n, folder in enumerate(data_folders):
+            dataset = pending.result()
+            if n + 1 < len(data_folders):
+                pending = pool.submit(load_test_split, data_folders[n + 1])
+            corruption, severity = corruption_of(folder)
+            for path, encoder, decoder, model_device in models:
+                for beam_size in [None] if greedy else beam_sizes:
+                    bleu4, cider = evaluate(beam_size, encoder, decoder, model_device, batch_size, greedy, max_length,
+                                            folder, dataset, word_map)
+                    records.append({'checkpoint': path, 'data_folder': folder, 'corruption': corruption,
+                                    'severity': severity, 'beam_size': beam_size, 'bleu4': bleu4, 'cider': cider})
+    return records
+
+
+def write_results(records, path):
+    """
+    Writes evaluation records to a CSV file, or a JSON file if path ends with .json.
 
-    return bleu4
+    :param records: records, as returned by sweep
+    :param path: path to the file
+    """
+    with open(path, 'w') as f:
+        if path.endswith('.json'):
+            json.dump(records, f, indent=2)
+        else:
+            writer = csv.DictWriter(f, fieldnames=list(records[0].keys()))
+            writer.writeheader()
+            writer.writerows(records)
 
 
 if __name__ == '__main__':
-    beam_size = 5
-    print("\nBLEU-4 score @ beam size of %d is %.4f." % (beam_size, evaluate(beam_size)))
+    parser = argparse.ArgumentParser(description='Show, Attend, and Tell - Evaluate')
+    parser.add_argument('--checkpoint', '-m', default=[checkpoint], nargs='+', help='checkpoints to evaluate')
+    parser.add_argument('--data_folder', '-d', default=[data_folder], nargs='+',
+                        help='folders with data files to evaluate on, or glob patterns (e.g. "dataset_blur_*")')
+    parser.add_argument('--word_map', '-wm', help='path to word map JSON (default: that of the first data folder)')
+    parser.add_argument('--beam_size', '-b', default=[5], type=int, nargs='+', help='beam sizes for beam search')
+    parser.add_argument('--greedy', action='store_true', help='decode greedily (beam size 1, batched, faster)')
+    parser.add_argument('--length_percentile', default=100., type=float,
+                        help='percentile of the training caption lengths to decode up to')
+    parser.add_argument('--results', help='file to write the scores to, CSV (or JSON if it ends with .json)')
+    args = parser.parse_args()
+
+    data_folders = list()
+    for pattern in args.data_folder:
+        data_folders.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    word_map = read_word_map(args.word_map or os.path.join(data_folders[0], 'WORDMAP_' + data_name + '.json'))
+
+    # Longest caption to decode, from the training captions
+    with open(os.path.join(data_folders[0], 'TRAIN_CAPLENS_' + data_name + '.json'), 'r') as j:
+        max_length = max_decode_length(json.load(j), args.length_percentile)
+
+    records = sweep(args.beam_size, args.checkpoint, data_folders, device, greedy=args.greedy, max_length=max_length,
+                    word_map=word_map)
+    if args.results:
+        write_results(records, args.results)
+
+    searches = [None] if args.greedy else args.beam_size
+    rows = [(path, folder) for folder in data_folders for path in args.checkpoint]
+    scores = dict(((r['checkpoint'], r['data_folder'], r['beam_size']), (r['bleu4'], r['cider'])) for r in records)
+    width = max([len('checkpoint @ data folder')] + [len(path) + len(folder) + 3 for path, folder in rows])
+    for metric, name in enumerate(['BLEU-4', 'CIDEr-D']):
+        print('\n%s scores' % name)
+        print('%-*s' % (width, 'checkpoint @ data folder') + ''.join(
+            '%10s' % ('greedy' if b is None else 'beam %d' % b) for b in searches))
+        for path, folder in rows:
+            print('%-*s' % (width, path + ' @ ' + folder) + ''.join(
+                '%10.4f' % scores[path, folder, b][metric] for b in searches))
+    print('\nEncoded TEST images %d time(s) for %d evaluations' % (encoder_outputs.misses, len(records)))
@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import pickle
+import time
+import torch
+from models import Decoder
+from utils import load_model, model_config
+
+cpu = torch.device('cpu')
+
+
+def export(checkpoint_path, word_map_file, out, half=False):
+    """
+    Writes an inference-only artifact of a checkpoint: the state_dicts of the encoder and decoder (all their weights,
+    pretrained ones included, so that loading never goes to the network), the config to rebuild them with, and the
+    word map. Optimizer states and training bookkeeping are left out.
+
+    The artifact is loaded (memory-mapped) by utils.load_model, like a checkpoint.
+
+    :param checkpoint_path: path to checkpoint
+    :param word_map_file: path to the word map the model was trained with
+    :param out: path to write the artifact to
+    :param half: store floating point weights as float16 (halving the artifact's size)?
+    """
+    encoder, decoder, _ = load_model(checkpoint_path, cpu)
+    assert isinstance(decoder, Decoder) and not hasattr(decoder, 'attention'), \
+        'only checkpoints of models.Decoder can be exported'
+
+    def cast(state_dict):
+        return {k: v.half() if half and v.is_floating_point() else v for k, v in state_dict.items()}
+
+    with open(word_map_file, 'r') as j:
+        word_map = json.load(j)
+
+    artifact = {'inference': True,
+                'config': model_config(encoder, decoder),
+                'encoder': cast(encoder.state_dict()),
+                'decoder': cast(decoder.state_dict()),
+                'word_map': word_map,
+                'dtype': 'float16' if half else 'float32',
+                'source': checkpoint_path}
+    torch.save(artifact, out)
+
+
+def load_word_map(artifact_path):
+    """
+    :param artifact_path: path to an artifact written by export
+    :return: the word map it holds
+    """
+    try:
+        artifact = torch.load(artifact_path, map_location='cpu', mmap=True, weights_only=True)
+    except (pickle.UnpicklingError, RuntimeError):
+        artifact = None  # e.g. a training checkpoint, which pickles more than tensors
+    if not isinstance(artifact, dict) or 'word_map' not in artifact:
+        raise ValueError('%s holds no word map (only artifacts written by export.py do): pass its word map with '
+                         '--word_map' % artifact_path)
+    return artifact['word_map']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show, Attend, and Tell - Tutorial - Export for inference')
+
+    parser.add_argument('--model', '-m', help='path to checkpoint')
+    parser.add_argument('--word_map', '-wm', help='path to word map JSON')
+    parser.add_argument('--out', '-o', help='path to write the artifact to (default: INFERENCE_<model>)')
+    parser.add_argument('--half', action='store_true', help='store weights as float16')
+
+    args = parser.parse_args()
+    out = args.out or os.path.join(os.path.dirname(args.model), 'INFERENCE_' + os.path.basename(args.model))
+
+    export(args.model, args.word_map, out, args.half)
+    print("Saved %s inference artifact to %s" % ('float16' if args.half else 'float32', out))
+
+    # Report
+    print('\n%-12s %12s %14s' % ('file', 'size (MB)', 'load (s)'))
+    for name, path in (('checkpoint', args.model), ('artifact', out)):
+        start = time.time()
+        load_model(path, cpu)
+        print('%-12s %12.1f %14.2f' % (name, os.path.getsize(path) / 2. ** 20, time.time() - start))
@@ -0,0 +1,257 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.utils.data
+from torch.utils.data import Dataset
+
+
+def prefix_key(encoder):
+    """
+    :param encoder: encoder model
+    :return: digest of the backbone and the weights (and batchnorm statistics) of its frozen prefix
+    """
+    digest = hashlib.md5(encoder.backbone.encode())
+    for name, tensor in encoder.resnet[:encoder.prefix_length].state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def encoder_key(encoder):
+    """
+    :param encoder: encoder model (also quantized)
+    :return: digest of everything the encoder's outputs depend on: its type, whether it pools, and all its weights and
+             buffers
+    """
+    digest = hashlib.md5(('%s %s %s' % (type(encoder).__name__, getattr(encoder, 'backbone', ''),
+                                        getattr(encoder, 'pooled', False))).encode())
+
+    def update(value):
+        if torch.is_tensor(value):
+            value = value.detach().cpu()
+            value = value.dequantize() if value.is_quantized else value
+            digest.update(value.contiguous().numpy().tobytes())
+        elif isinstance(value, (tuple, list)):  # e.g. packed parameters of quantized layers
+            for v in value:
+                update(v)
+        else:
+            digest.update(repr(value).encode())
+
+    for name, value in encoder.state_dict().items():
+        digest.update(name.encode())
+        update(value)
+    return digest.hexdigest()
+
+
+class PrefixActivationCache(object):
+    """
+    Activations of an encoder's frozen prefix (see Encoder.forward_prefix), for every image of a split.
+
+    They are stored as float16 in a memory-mapped file named after the split and the prefix's weights, so that a cache
+    is reused across runs (and by every process training together) as long as the prefix doesn't change. A second file
+    flags the images already cached, so an interrupted fill resumes where it stopped.
+    """
+
+    def __init__(self, cache_dir, name, encoder, n_images, image_size=256):
+        """
+        :param cache_dir: folder to keep the cache in
+        :param name: name of the split, e.g. 'TRAIN_' + data_name
+        :param encoder: encoder model
+        :param n_images: number of images in the split
+        :param image_size: size of the images
+        """
+        with torch.no_grad():
+            param = next(encoder.parameters())
+            shape = encoder.forward_prefix(torch.zeros(1, 3, image_size, image_size, dtype=param.dtype,
+                                                       device=param.device)).shape[1:]
+        self.shape = (n_images,) + tuple(shape)  # (n_images, channels, height, width)
+        self.path = os.path.join(cache_dir, 'PREFIX_%s_%s_%s.f16' % (name, encoder.backbone, prefix_key(encoder)[:12]))
+        self.done_path = self.path + '.done'
+        self.activations = None  # memory maps, opened on first use (also in DataLoader workers)
+        self.done = None
+
+    def __getstate__(self):
+        # Memory maps would be pickled as copies of their contents, so DataLoader workers reopen them instead
+        state = self.__dict__.copy()
+        state['activations'] = state['done'] = None
+        return state
+
+    def create(self):
+        """
+        Creates the (empty) cache files if they don't exist yet. Only one process may call it at a time.
+        """
+        if not os.path.isdir(os.path.dirname(self.path) or '.'):
+            os.makedirs(os.path.dirname(self.path))
+        if not os.path.isfile(self.path) or not os.path.isfile(self.done_path):
+            np.memmap(self.path, dtype=np.float16, mode='w+', shape=self.shape).flush()
+            np.memmap(self.done_path, dtype=np.uint8, mode='w+', shape=(self.shape[0],)).flush()
+
+    def open(self):
+        if self.activations is None:
+            self.activations = np.memmap(self.path, dtype=np.float16, mode='r+', shape=self.shape)
+            self.done = np.memmap(self.done_path, dtype=np.uint8, mode='r+', shape=(self.shape[0],))
+
+    def missing(self):
+        """
+        :return: indices of the images not cached yet
+        """
+        self.open()
+        return np.flatnonzero(self.done == 0).tolist()
+
+    def write(self, images, activations):
+        """
+        :param images: indices of the images
+        :param activations: their prefix activations, a tensor of dimensions (len(images), channels, height, width)
+        """
+        self.open()
+        self.activations[images] = activations.cpu().numpy().astype(np.float16)
+        self.done[images] = 1
+
+    def flush(self):
+        if self.activations is not None:
+            self.activations.flush()
+            self.done.flush()
+
+    def __getitem__(self, image):
+        """
+        :param image: index of the image
+        :return: its prefix activations, a float16 array of dimensions (channels, height, width)
+        """
+        self.open()
+        return self.activations[image]
+
+    def disk_bytes(self):
+        """
+        :return: size of the cache on disk
+        """
+        return int(np.prod(self.shape)) * 2 + self.shape[0]
+
+    def fill(self, dataset, encoder, device, batch_size, rank=0, n_processes=1):
+        """
+        Runs the prefix once over every image not cached yet (this process' share of them, if distributed).
+
+        The prefix runs in eval mode, so that its batchnorm layers use their (frozen) running statistics, as they also
+        do when training without the cache (see models.Encoder.train).
+
+        :param dataset: CaptionDataset of the split
+        :param encoder: encoder model
+        :param device: device the encoder is on
+        :param batch_size: images per batch
+        :param rank: rank of this process
+        :param n_processes: number of processes sharing the work
+        :return: number of images cached, seconds taken
+        """
+        images = [i for i in self.missing() if i % n_processes == rank]  # whatever the other processes did already
+        if not images:
+            return 0, 0.
+        start = time.time()
+        # One caption per image
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+                                             sampler=[i * dataset.cpi for i in images], pin_memory=True)
+        was_training = encoder.training
+        encoder.eval()
+        with torch.inference_mode():
+            for i, batch in enumerate(loader):
+                activations = encoder.forward_prefix(batch[0].to(device))
+                self.write(images[i * batch_size:(i + 1) * batch_size], activations)
+        encoder.train(was_training)
+        self.flush()
+        return len(images), time.time() - start
+
+
+class PrefixActivationDataset(Dataset):
+    """
+    Wraps a CaptionDataset, returning the cached prefix activations of images instead of reading the images.
+    """
+
+    def __init__(self, dataset, cache):
+        """
+        :param dataset: CaptionDataset
+        :param cache: PrefixActivationCache of its split, already filled
+        """
+        self.dataset = dataset
+        self.cache = cache
+        self.cpi = dataset.cpi
+
+    def __getitem__(self, i):
+        activations = torch.from_numpy(np.array(self.cache[i // self.cpi]))  # float16, copied out of the memory map
+        caption = torch.LongTensor(self.dataset.captions[i])
+        caplen = torch.LongTensor([self.dataset.caplens[i]])
+        return activations, caption, caplen
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class EncoderOutputCache(object):
+    """
+    Outputs of encoders for every image of a split, so that evaluating several beam sizes, or several decoders that
+    share an encoder, encodes the split only once.
+
+    Outputs are keyed by the split and the encoder's weights (see encoder_key). The most recent ones are kept in
+    memory, and if a folder is given, they are also saved there (as .npy files, memory-mapped when loaded back) for
+    later runs.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=2):
+        """
+        :param cache_dir: folder to save outputs in, or None to only keep them in memory
+        :param max_entries: number of (split, encoder) outputs to keep in memory
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (name, key): outputs, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dataset, name, encoder, device, batch_size=32):
+        """
+        :param dataset: CaptionDataset of the split
+        :param name: name of the split, e.g. 'TEST_' + data_name
+        :param encoder: encoder model, in eval mode
+        :param device: device the encoder is on
+        :param batch_size: images per batch, when encoding
+        :return: outputs of the encoder for every image, a tensor of dimensions (n_images, ...) on the CPU
+        """
+        key = (name, encoder_key(encoder))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, 'ENCODED_%s_%s.npy' % (name, key[1][:12]))
+        if path is not None and os.path.isfile(path):
+            self.hits += 1
+            outputs = torch.from_numpy(np.load(path, mmap_mode='c'))  # copy-on-write, so that torch may wrap it
+        else:
+            self.misses += 1
+            outputs = self.encode(dataset, encoder, device, batch_size)
+            if path is not None:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                # Written under a temporary name, so that an interrupted run never leaves a partial file behind
+                tmp_path = '%s.%d.tmp.npy' % (path[:-len('.npy')], os.getpid())
+                np.save(tmp_path, outputs.numpy())
+                os.replace(tmp_path, path)
+
+        self.entries[key] = outputs
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return outputs
+
+    @staticmethod
+    def encode(dataset, encoder, device, batch_size):
+        # One caption per image
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+                                             sampler=range(0, len(dataset), dataset.cpi), num_workers=1,
+                                             pin_memory=True)
+        outputs = list()
+        with torch.no_grad():
+            for batch in loader:
+                outputs.append(encoder(batch[0].to(device)).cpu())
+        return torch.cat(outputs)
@@ -0,0 +1,27 @@
+import numpy as np
+from PIL import Image
+
+
+def load_image(path, size=256, draft=True):
+    """
+    Reads an image as RGB and resizes it to size x size, bilinearly (as scipy.misc's imread and imresize did).
+
+    With draft, a JPEG is decoded at a reduced size to begin with: its decoder can downscale by 2, 4 or 8 while
+    decoding (in the DCT domain), which is much faster than decoding every pixel. It downscales as much as it can while
+    staying at least size x size, so the final resize still does the rest, and the result only differs slightly from
+    that of a full decode (see 'python benchmark.py images').
+
+    Greyscale images are repeated over the 3 channels; palette images are converted, and alpha is dropped.
+
+    :param path: path to image (or file object)
+    :param size: size to resize to
+    :param draft: decode JPEGs at a reduced size?
+    :return: image, a uint8 array of dimensions (size, size, 3)
+    """
+    img = Image.open(path)
+    if draft and img.format == 'JPEG':
+        img.draft('RGB', (size, size))
+    img = img.convert('RGB')
+    if img.size != (size, size):
+        img = img.resize((size, size), Image.BILINEAR)
+    return np.asarray(img)
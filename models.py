@@ -5,50 +5,134 @@ import numpy as np
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Supported encoder backbones: constructor, feature size (encoder_dim) of their last convolutional stage
+BACKBONES = {'resnet18': (torchvision.models.resnet18, 512),
+             'resnet34': (torchvision.models.resnet34, 512),
+             'resnet50': (torchvision.models.resnet50, 2048),
+             'resnet101': (torchvision.models.resnet101, 2048),
+             'mobilenet_v2': (torchvision.models.mobilenet_v2, 1280)}
+
+
+def load_backbone(backbone, weights='imagenet', cache_dir=None):
+    """
+    Builds an ImageNet CNN, only going to the network if its pretrained weights are not cached yet.
+
+    :param backbone: one of BACKBONES
+    :param weights: 'imagenet' for torchvision's pretrained weights, path to a local state_dict, or None (random init)
+    :param cache_dir: folder the pretrained weights are cached in (default: torch hub's); on offline machines, copy
+                      the weight files there beforehand
+    :return: CNN
+    """
+    assert backbone in BACKBONES
+    cnn = BACKBONES[backbone][0](weights=None)
+    if weights == 'imagenet':
+        # The same weights the old pretrained=True flag loaded
+        url = torchvision.models.get_model_weights(backbone)['IMAGENET1K_V1'].url
+        cnn.load_state_dict(torch.hub.load_state_dict_from_url(url, model_dir=cache_dir, progress=False))
+    elif weights is not None:
+        cnn.load_state_dict(torch.load(weights, map_location='cpu'))
+    return cnn
+
 
 class Encoder(nn.Module):
     """
     Encoder.
     """
 
-    def __init__(self, encoded_image_size=14):
+    # Class-level defaults, for encoders pickled before these attributes existed
+    backbone = 'resnet101'
+    weights = 'imagenet'
+    cache_dir = None
+    pooled = False
+
+    prefix_length = 5  # leading children of self.resnet that stay frozen even when fine-tuning
+
+    def __init__(self, encoded_image_size=14, backbone='resnet101', weights='imagenet', cache_dir=None, pooled=False):
+        """
+        :param encoded_image_size: size of the encoded image
+        :param backbone: CNN to encode images with, one of BACKBONES
+        :param weights: 'imagenet', path to a local state_dict of the CNN, or None (see load_backbone)
+        :param cache_dir: folder the pretrained weights are cached in
+        :param pooled: output the mean over pixels only? (enough for decoders without attention)
+        """
         super(Encoder, self).__init__()
         self.enc_image_size = encoded_image_size
+        self.pooled = pooled
+        self.backbone = backbone
+        self.weights = weights
+        self.cache_dir = cache_dir
+        self.encoder_dim = BACKBONES[backbone][1]
 
-        resnet = torchvision.models.resnet101(pretrained=True)  # pretrained ImageNet ResNet-101
+        cnn = load_backbone(backbone, weights, cache_dir)  # pretrained ImageNet CNN
 
-        # Remove linear and pool layers (since we're not doing classification)
-        modules = list(resnet.children())[:-1]
-        self.resnet = nn.Sequential(*modules)
+        # Remove linear layer (since we're not doing classification)
+        if backbone.startswith('resnet'):
+            modules = list(cnn.children())[:-1]
+        else:
+            modules = list(cnn.features.children()) + [nn.AdaptiveAvgPool2d(1)]
+        self.resnet = nn.Sequential(*modules)  # named 'resnet' whatever the backbone, to keep checkpoints loadable
 
         # Resize image to fixed size to allow input images of variable size
         self.adaptive_pool = nn.AdaptiveAvgPool2d((encoded_image_size, encoded_image_size))
         self.linear = nn.Linear(encoded_image_size, encoded_image_size)
         self.fine_tune()
 
-    def forward(self, images):
+    def forward(self, images, from_prefix=False):
         """
         Forward propagation.
 
-        :param images: images, a tensor of dimensions (batch_size, 3, image_size, image_size)
-        :return: encoded images
+        :param images: images, a tensor of dimensions (batch_size, 3, image_size, image_size), or if from_prefix, the
+            output of forward_prefix for them
+        :param from_prefix: skip the frozen prefix, whose output images already is?
+        :return: encoded images, or their mean over pixels if pooled
         """
-        out = self.resnet(images)  # (batch_size, 2048, image_size/32, image_size/32)
-        out = self.adaptive_pool(out)  # (batch_size, 2048, encoded_image_size, encoded_image_size)
+        if from_prefix:
+            out = self.resnet[self.prefix_length:](images)  # (batch_size, encoder_dim, 1, 1)
+        else:
+            out = self.resnet(images)  # (batch_size, encoder_dim, 1, 1)
+        out = self.adaptive_pool(out)  # (batch_size, encoder_dim, encoded_image_size, encoded_image_size)
         out = self.linear(out)
-        out = out.permute(0, 2, 3, 1)  # (batch_size, encoded_image_size, encoded_image_size, 2048)
+        if self.pooled:
+            return out.mean(dim=(2, 3))  # (batch_size, encoder_dim)
+        out = out.permute(0, 2, 3, 1)  # (batch_size, encoded_image_size, encoded_image_size, encoder_dim)
         return out
 
+    def forward_prefix(self, images):
+        """
+        Runs the leading blocks of the CNN, which are never fine-tuned, so that their output can be cached.
+
+        :param images: images, a tensor of dimensions (batch_size, 3, image_size, image_size)
+        :return: activations, a tensor of dimensions (batch_size, channels, height, width)
+        """
+        return self.resnet[:self.prefix_length](images)
+
+    def train(self, mode=True):
+        """
+        Sets training mode, except for the frozen prefix, which always stays in eval mode: its batchnorm layers keep
+        using (and don't update) their pretrained running statistics, so that it computes what forward_prefix cached.
+
+        A statically quantized trunk (see quantize.quantize_encoder) is an FX GraphModule, which has no prefix to slice
+        and is only ever run in eval mode anyway.
+
+        :param mode: training mode?
+        :return: self
+        """
+        super(Encoder, self).train(mode)
+        if isinstance(self.resnet, nn.Sequential):
+            self.resnet[:self.prefix_length].eval()
+        return self
+
     def fine_tune(self, fine_tune=True):
         """
-        Allow or prevent the computation of gradients for convolutional blocks 2 through 4 of the encoder.
+        Allow or prevent the computation of gradients for convolutional blocks 2 through 4 of the encoder (for
+        MobileNet, for every block after the fifth).
 
         :param fine_tune: Allow?
         """
         for p in self.resnet.parameters():
             p.requires_grad = False
         # If fine-tuning, only fine-tune convolutional blocks 2 through 4
-        for c in list(self.resnet.children())[5:]:
+        for c in list(self.resnet.children())[self.prefix_length:]:
             for p in c.parameters():
                 p.requires_grad = fine_tune
 
@@ -58,18 +142,21 @@ class Decoder(nn.Module):
     Decoder without attention.
     """
 
-    def __init__(self, embed_dim, decoder_dim, vocab_size, encoder_dim=2048, dropout=0.5):
+    num_pixels = 14 * 14  # class-level default, for decoders pickled before the attribute existed
+
+    def __init__(self, embed_dim, decoder_dim, vocab_size, encoder_dim=2048, dropout=0.5, encoded_image_size=14):
         """
-        :param attention_dim: size of attention network
         :param embed_dim: embedding size
         :param decoder_dim: size of decoder's RNN
         :param vocab_size: size of vocabulary
         :param encoder_dim: feature size of encoded images
         :param dropout: dropout
+        :param encoded_image_size: size of the encoded image
         """
         super(Decoder, self).__init__()
 
         self.encoder_dim = encoder_dim
+        self.num_pixels = encoded_image_size * encoded_image_size
         self.embed_dim = embed_dim
         self.decoder_dim = decoder_dim
         self.vocab_size = vocab_size
@@ -111,14 +198,28 @@ class Decoder(nn.Module):
         for p in self.embedding.parameters():
             p.requires_grad = fine_tune
 
+    def pool(self, encoder_out):
+        """
+        Reduces encoded images to the only two things this decoder uses: their mean over pixels, which initializes the
+        LSTM, and their sum over pixels, which is fed to the LSTM at every step.
+
+        :param encoder_out: encoded images, a tensor of dimension (batch_size, enc_image_size, enc_image_size, encoder_dim)
+                            or (batch_size, num_pixels, encoder_dim), or (batch_size, encoder_dim) if already pooled
+        :return: mean, sum; tensors of dimension (batch_size, encoder_dim)
+        """
+        if encoder_out.dim() == 2:
+            return encoder_out, encoder_out * self.num_pixels
+        encoder_out = encoder_out.reshape(encoder_out.size(0), -1, encoder_out.size(-1))
+        return encoder_out.mean(dim=1), encoder_out.sum(dim=1)
+
     def init_hidden_state(self, encoder_out):
         """
         Creates the initial hidden and cell states for the decoder's LSTM based on the encoded images.
 
-        :param encoder_out: encoded images, a tensor of dimension (batch_size, num_pixels, encoder_dim)
+        :param encoder_out: encoded images, in any of the shapes pool accepts
         :return: hidden state, cell state
         """
-        mean_encoder_out = encoder_out.mean(dim=1)
+        mean_encoder_out, _ = self.pool(encoder_out)
         h = self.init_h(mean_encoder_out)  # (batch_size, decoder_dim)
         c = self.init_c(mean_encoder_out)
         return h, c
@@ -127,41 +228,44 @@ class Decoder(nn.Module):
         """
         Forward propagation.
 
-        :param encoder_out: encoded images, a tensor of dimension (batch_size, enc_image_size, enc_image_size, encoder_dim)
+        :param encoder_out: encoded images, a tensor of dimension (batch_size, enc_image_size, enc_image_size, encoder_dim),
+                            or (batch_size, encoder_dim) if pooled by the encoder
         :param encoded_captions: encoded captions, a tensor of dimension (batch_size, max_caption_length)
-        :param caption_lengths: caption lengths, a tensor of dimension (batch_size, 1)
+        :param caption_lengths: caption lengths, a tensor of dimension (batch_size, 1), best left on the CPU: the decode
+                                lengths are read from them, which would otherwise wait for the device
         :return: scores for vocabulary, sorted encoded captions, decode lengths, weights, sort indices
         """
 
         batch_size = encoder_out.size(0)
-        encoder_dim = encoder_out.size(-1)
         vocab_size = self.vocab_size
 
-        # Flatten image
-        encoder_out = encoder_out.view(batch_size, -1, encoder_dim)  # (batch_size, num_pixels, encoder_dim)
-        num_pixels = encoder_out.size(1)
-
         # Sort input data by decreasing lengths; why? apparent below
         caption_lengths, sort_ind = caption_lengths.squeeze(1).sort(dim=0, descending=True)
+        sort_ind = sort_ind.to(encoder_out.device)
         encoder_out = encoder_out[sort_ind]
         encoded_captions = encoded_captions[sort_ind]
 
         # Embedding
         embeddings = self.embedding(encoded_captions)  # (batch_size, max_caption_length, embed_dim)
 
+        # Pool the image once, rather than at every time-step
+        mean_encoder_out, context = self.pool(encoder_out)  # (batch_size, encoder_dim)
+
         # Initialize LSTM state
-        h, c = self.init_hidden_state(encoder_out)  # (batch_size, decoder_dim)
+        h = self.init_h(mean_encoder_out)  # (batch_size, decoder_dim)
+        c = self.init_c(mean_encoder_out)
 
         # We won't decode at the <end> position, since we've finished generating as soon as we generate <end>
         # So, decoding lengths are actual lengths - 1
         decode_lengths = (caption_lengths - 1).tolist()
 
         # Create tensors to hold word predicion scores and alphas
-        predictions = torch.zeros(batch_size, max(decode_lengths), vocab_size).to(device)
+        predictions = torch.zeros(batch_size, max(decode_lengths), vocab_size, device=encoder_out.device)
 
         for t in range(max(decode_lengths)):
             batch_size_t = sum([l > t for l in decode_lengths])
-            h, c = self.decode_step(torch.cat([embeddings[:batch_size_t, t, :], encoder_out[:batch_size_t].sum(dim=1)], dim=1), (h[:batch_size_t], c[:batch_size_t]))  # (batch_size_t, decoder_dim)
+            h, c = self.decode_step(torch.cat([embeddings[:batch_size_t, t, :], context[:batch_size_t]], dim=1),
+                                    (h[:batch_size_t], c[:batch_size_t]))  # (batch_size_t, decoder_dim)
             hh = self.linear(h)
             preds = self.fc(self.dropout(hh))  # (batch_size_t, vocab_size)
             predictions[:batch_size_t, t, :] = preds
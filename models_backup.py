@@ -1,6 +1,7 @@
 import torch
 import math
 from torch import nn
+import torch.nn.functional as F
 import torchvision
 import numpy as np
 
@@ -87,6 +88,67 @@ class AdaptiveLSTMCell(nn.Module):
         return h_new, c_new, s_new
 
 
+@torch.jit.script
+def adaptive_lstm_gates(gates, ct):
+    """
+    Elementwise gate math of the sentinel LSTM, scripted so that the activations are fused into a single kernel.
+
+    :param gates: pre-activation gates, a tensor of dimension (batch_size, 5 * hidden_size)
+    :param ct: previous cell state, a tensor of dimension (batch_size, hidden_size)
+    :return: hidden state, cell state, sentinel
+    """
+    # Indexing a (batch_size, 5, hidden_size) view rather than chunk(), whose gradient the TorchScript autodiff gets
+    # wrong when the chunks feed different ops
+    gates = gates.view(gates.size(0), 5, -1)
+    ingate, forgetgate, cellgate, outgate, sgate = gates[:, 0], gates[:, 1], gates[:, 2], gates[:, 3], gates[:, 4]
+    c_new = (torch.sigmoid(forgetgate) * ct) + (torch.sigmoid(ingate) * torch.tanh(cellgate))
+    tanh_c = torch.tanh(c_new)
+    h_new = torch.sigmoid(outgate) * tanh_c
+    s_new = torch.sigmoid(sgate) * tanh_c
+    return h_new, c_new, s_new
+
+
+class FusedAdaptiveLSTMCell(nn.Module):
+    """
+    Drop-in replacement for AdaptiveLSTMCell.
+
+    Input-to-hidden and hidden-to-hidden weights are stored as one matrix so that each step costs a single matmul,
+    and the gate activations run through the scripted adaptive_lstm_gates.
+    """
+
+    def __init__(self, inputSize, hiddenSize):
+        super(FusedAdaptiveLSTMCell, self).__init__()
+        self.hiddenSize = hiddenSize
+        self.inputSize = inputSize
+        self.weight = nn.Parameter(torch.Tensor(5 * hiddenSize, inputSize + hiddenSize))  # [w_ih | w_hh]
+        self.bias = nn.Parameter(torch.Tensor(5 * hiddenSize))  # b_ih + b_hh
+        self.init_parameters()
+
+    def init_parameters(self):
+        stdv = 1.0 / math.sqrt(self.hiddenSize)
+        self.weight.data.uniform_(-stdv, stdv)
+        self.bias.data.fill_(0)
+
+    @classmethod
+    def from_cell(cls, cell):
+        """
+        Builds a fused cell computing the same function as an existing AdaptiveLSTMCell.
+
+        :param cell: AdaptiveLSTMCell
+        :return: FusedAdaptiveLSTMCell
+        """
+        fused = cls(cell.inputSize, cell.hiddenSize).to(cell.w_ih.device)
+        with torch.no_grad():
+            fused.weight.copy_(torch.cat([cell.w_ih, cell.w_hh], dim=1))
+            fused.bias.copy_(cell.b_ih + cell.b_hh)
+        return fused
+
+    def forward(self, inp, states):
+        ht, ct = states
+        gates = torch.addmm(self.bias, torch.cat([inp, ht], dim=1), self.weight.t())  # (batch_size, 5 * hiddenSize)
+        return adaptive_lstm_gates(gates, ct)
+
+
 class Attention(nn.Module):
     """
     Attention Network.
@@ -163,7 +225,8 @@ class DecoderWithAttention(nn.Module):
     Decoder.
     """
 
-    def __init__(self, attention_dim, embed_dim, decoder_dim, vocab_size, encoder_dim=2048, dropout=0.5):
+    def __init__(self, attention_dim, embed_dim, decoder_dim, vocab_size, encoder_dim=2048, dropout=0.5,
+                 sentinel=False):
         """
         :param attention_dim: size of attention network
         :param embed_dim: embedding size
@@ -171,6 +234,7 @@ class DecoderWithAttention(nn.Module):
         :param vocab_size: size of vocabulary
         :param encoder_dim: feature size of encoded images
         :param dropout: dropout
+        :param sentinel: decode with the sentinel LSTM cell (FusedAdaptiveLSTMCell) instead of nn.LSTMCell?
         """
         super(DecoderWithAttention, self).__init__()
 
@@ -185,7 +249,10 @@ class DecoderWithAttention(nn.Module):
 
         self.embedding = nn.Embedding(vocab_size, embed_dim)  # embedding layer
         self.dropout = nn.Dropout(p=self.dropout)
-        self.decode_step = nn.LSTMCell(embed_dim + encoder_dim, decoder_dim, bias=True)  # decoding LSTMCell
+        if sentinel:
+            self.decode_step = FusedAdaptiveLSTMCell(embed_dim + encoder_dim, decoder_dim)  # decoding sentinel LSTM
+        else:
+            self.decode_step = nn.LSTMCell(embed_dim + encoder_dim, decoder_dim, bias=True)  # decoding LSTMCell
         self.init_h = nn.Linear(encoder_dim, decoder_dim)  # linear layer to find initial hidden state of LSTMCell
         self.init_c = nn.Linear(encoder_dim, decoder_dim)  # linear layer to find initial cell state of LSTMCell
         self.f_beta = nn.Linear(decoder_dim, encoder_dim)  # linear layer to create a sigmoid-activated gate
@@ -276,9 +343,10 @@ class DecoderWithAttention(nn.Module):
                                                                 h[:batch_size_t])
             gate = self.sigmoid(self.f_beta(h[:batch_size_t]))  # gating scalar, (batch_size_t, encoder_dim)
             attention_weighted_encoding = gate * attention_weighted_encoding
+            # A sentinel LSTM cell also returns its sentinel, after the hidden and cell states
             h, c = self.decode_step(
                 torch.cat([embeddings[:batch_size_t, t, :], attention_weighted_encoding], dim=1),
-                (h[:batch_size_t], c[:batch_size_t]))  # (batch_size_t, decoder_dim)
+                (h[:batch_size_t], c[:batch_size_t]))[:2]  # (batch_size_t, decoder_dim)
             preds = self.fc(self.dropout(h))  # (batch_size_t, vocab_size)
             predictions[:batch_size_t, t, :] = preds
             alphas[:batch_size_t, t, :] = alpha
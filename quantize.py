@@ -0,0 +1,232 @@
+import argparse
+import copy
+import io
+import json
+import os
+import time
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from datasets import CaptionDataset
+from decoding import beam_search
+from models import Encoder, Decoder
+from utils import load_model, model_config
+
+cpu = torch.device('cpu')  # int8 kernels are CPU-only
+
+
+def quantize_decoder(decoder):
+    """
+    Applies dynamic int8 quantization to the decoder's LSTMCell and Linear layers (decode_step, linear, fc, init_h,
+    init_c).
+
+    Weights are stored in int8 and activations are quantized on the fly at every step, so no calibration is needed.
+
+    :param decoder: float decoder model
+    :return: quantized copy of the decoder
+    """
+    decoder = copy.deepcopy(decoder).to(cpu)
+    decoder.eval()
+    return quantize_dynamic(decoder, {nn.LSTMCell, nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_encoder(encoder, calibration_batches=None, static=None):
+    """
+    Quantizes the encoder.
+
+    Convolutions have no dynamic int8 kernels, so with calibration batches the ResNet trunk is statically quantized
+    (activation ranges observed on the calibration images); without them only the encoder's Linear layer is
+    dynamically quantized and the trunk stays in float32.
+
+    :param encoder: float encoder model
+    :param calibration_batches: list of normalized image batches, or None
+    :param static: statically quantize the trunk even without calibration batches (with placeholder activation ranges,
+                   to be overwritten by loading a quantized state_dict, see load_quantized)? Default: if calibrating
+    :return: quantized copy of the encoder
+    """
+    encoder = copy.deepcopy(encoder).to(cpu)
+    encoder.eval()
+    if static is None:
+        static = bool(calibration_batches)
+    if static:
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        example = calibration_batches[0] if calibration_batches else torch.zeros(1, 3, 256, 256)
+        prepared = prepare_fx(encoder.resnet, qconfig_mapping, (example,))
+        with torch.no_grad():
+            for imgs in calibration_batches or [example]:
+                prepared(imgs)
+        encoder.resnet = convert_fx(prepared)
+    return quantize_dynamic(encoder, {nn.Linear}, dtype=torch.qint8)
+
+
+def artifact(encoder, decoder, q_encoder, q_decoder, static, source):
+    """
+    An int8 artifact holds the quantized models' state_dicts and what is needed to rebuild them: the statically
+    quantized trunk is an FX GraphModule, which can't be pickled and loaded back as a whole.
+
+    :param encoder: float encoder model
+    :param decoder: float decoder model
+    :param q_encoder: quantized encoder, see quantize_encoder
+    :param q_decoder: quantized decoder, see quantize_decoder
+    :param static: is the encoder's trunk statically quantized?
+    :param source: path to the float checkpoint
+    :return: artifact, to save with torch.save
+    """
+    return {'quantized': True,
+            'config': model_config(encoder, decoder),
+            'static_encoder': static,
+            'encoder': q_encoder.state_dict(),
+            'decoder': q_decoder.state_dict(),
+            'source': source}
+
+
+def load_quantized(checkpoint):
+    """
+    Rebuilds the quantized models of an artifact: the float models are built from its config (without loading
+    pretrained weights, which the artifact holds), quantized the same way, and take the artifact's weights and
+    quantization parameters.
+
+    :param checkpoint: artifact, see artifact
+    :return: quantized encoder, quantized decoder
+    """
+    encoder = Encoder(**dict(checkpoint['config']['encoder'], weights=None))
+    decoder = Decoder(**checkpoint['config']['decoder'])
+    q_encoder = quantize_encoder(encoder, static=checkpoint['static_encoder'])
+    q_decoder = quantize_decoder(decoder)
+    q_encoder.load_state_dict(checkpoint['encoder'])
+    q_decoder.load_state_dict(checkpoint['decoder'])
+    return q_encoder, q_decoder
+
+
+def calibration_images(data_folder, data_name, n_batches, batch_size):
+    """
+    Reads batches of distinct validation images to calibrate static quantization with.
+
+    :param data_folder: folder with data files saved by create_input_files.py
+    :param data_name: base name shared by data files
+    :param n_batches: number of batches
+    :param batch_size: images per batch
+    :return: list of normalized image batches
+    """
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                     std=[0.229, 0.224, 0.225])
+    dataset = CaptionDataset(data_folder, data_name, 'VAL', transform=transforms.Compose([normalize]))
+    # One caption per image, so that no image is seen twice
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+                                         sampler=list(range(0, len(dataset), dataset.cpi)))
+    batches = list()
+    for imgs, _, _, _ in loader:
+        batches.append(imgs)
+        if len(batches) == n_batches:
+            break
+    return batches
+
+
+def model_size(encoder, decoder):
+    """
+    :return: serialized size of the encoder and decoder, in bytes
+    """
+    buffer = io.BytesIO()
+    torch.save({'encoder': encoder, 'decoder': decoder}, buffer)
+    return buffer.tell()
+
+
+def latency(encoder, decoder, images, beam_size, n_steps=20):
+    """
+    Measures the latency of encoding an image, and of one decode-step over a beam of size beam_size.
+
+    :param encoder: encoder model
+    :param decoder: decoder model
+    :param images: normalized images, a tensor of dimension (n_images, 3, image_size, image_size)
+    :param beam_size: number of sequences decoded in parallel
+    :param n_steps: number of decode-steps to time
+    :return: encoder milliseconds per image, decoder milliseconds per step
+    """
+    with torch.no_grad():
+        start = time.time()
+        for img in images:
+            encoder_out = encoder(img.unsqueeze(0))
+        encoder_ms = (time.time() - start) * 1000 / len(images)
+
+        mean_encoder_out, context = decoder.pool(encoder_out)
+        h, c = decoder.init_hidden_state(mean_encoder_out.expand(beam_size, -1))
+        context = context.expand(beam_size, -1)
+        words = torch.zeros(beam_size, dtype=torch.long)
+        start = time.time()
+        for _ in range(n_steps):
+            embeddings = decoder.embedding(words)
+            h, c = decoder.decode_step(torch.cat([embeddings, context], dim=1), (h, c))
+            words = decoder.fc(decoder.linear(h)).argmax(dim=1)
+        decoder_ms = (time.time() - start) * 1000 / n_steps
+
+    return encoder_ms, decoder_ms
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show, Attend, and Tell - Tutorial - Quantize for CPU inference')
+
+    parser.add_argument('--model', '-m', help='path to float checkpoint')
+    parser.add_argument('--out', '-o', help='path to write the int8 artifact to (default: INT8_<model>)')
+    parser.add_argument('--data_folder', default='dataset', help='folder with data files saved by create_input_files.py')
+    parser.add_argument('--data_name', default='flickr8k_5_cap_per_img_5_min_word_freq',
+                        help='base name shared by data files')
+    parser.add_argument('--word_map', '-wm', help='path to word map JSON (default: that of --data_folder)')
+    parser.add_argument('--static_encoder', action='store_true',
+                        help='statically quantize the ResNet trunk, calibrating on validation images')
+    parser.add_argument('--calibration_batches', default=8, type=int, help='batches of images to calibrate on')
+    parser.add_argument('--batch_size', default=16, type=int, help='calibration batch size')
+    parser.add_argument('--beam_size', '-b', default=5, type=int, help='beam size for latency and BLEU-4')
+    parser.add_argument('--bleu', action='store_true',
+                        help='also report the BLEU-4 and CIDEr-D deltas on the TEST split of --data_folder (slow)')
+
+    args = parser.parse_args()
+    out = args.out or os.path.join(os.path.dirname(args.model), 'INT8_' + os.path.basename(args.model))
+    with open(args.word_map or os.path.join(args.data_folder, 'WORDMAP_' + args.data_name + '.json'), 'r') as j:
+        word_map = json.load(j)
+
+    encoder, decoder, _ = load_model(args.model, cpu)
+
+    calibration = None
+    if args.static_encoder:
+        print("\nCalibrating on %d validation batches..." % args.calibration_batches)
+        calibration = calibration_images(args.data_folder, args.data_name, args.calibration_batches, args.batch_size)
+    q_encoder = quantize_encoder(encoder, calibration)
+    q_decoder = quantize_decoder(decoder)
+
+    torch.save(artifact(encoder, decoder, q_encoder, q_decoder, bool(calibration), args.model), out)
+    print("Saved int8 artifact to %s" % out)
+
+    # Report
+    images = calibration[0] if calibration else torch.randn(8, 3, 256, 256)
+    rows = [('float32', encoder, decoder), ('int8', q_encoder, q_decoder)]
+    print('\n%-8s %12s %16s %18s' % ('model', 'size (MB)', 'encoder ms/img', 'decoder ms/step'))
+    for name, enc, dec in rows:
+        encoder_ms, decoder_ms = latency(enc, dec, images, args.beam_size)
+        print('%-8s %12.1f %16.2f %18.3f' % (name, model_size(enc, dec) / 2. ** 20, encoder_ms, decoder_ms))
+
+    # The artifact must load back (as eval.py, caption.py and serve.py load it) into the models just measured
+    l_encoder, l_decoder, _ = load_model(out, cpu)
+    with torch.no_grad():
+        encoder_out, l_encoder_out = q_encoder(images), l_encoder(images)
+    assert torch.equal(encoder_out, l_encoder_out), 'the loaded encoder differs from the quantized one'
+    start, end = word_map['<start>'], word_map['<end>']
+    seqs = beam_search(q_decoder, encoder_out, start, end, args.beam_size)[0]
+    l_seqs = beam_search(l_decoder, l_encoder_out, start, end, args.beam_size)[0]
+    assert seqs == l_seqs, 'the loaded decoder captions differently from the quantized one'
+    print('\nLoaded %s back: same encoder outputs and captions on %d images' % (out, len(images)))
+
+    if args.bleu:
+        import eval as evaluation
+
+        dataset = evaluation.load_test_split(args.data_folder)
+        (bleu4, cider), (q_bleu4, q_cider) = [evaluation.evaluate(args.beam_size, enc, dec, cpu,
+                                                                  data_folder=args.data_folder, dataset=dataset,
+                                                                  word_map=word_map)
+                                              for _, enc, dec in rows]
+        print("\nBLEU-4 @ beam size of %d: float32 %.4f, int8 %.4f (delta %+.4f)" % (
+            args.beam_size, bleu4, q_bleu4, q_bleu4 - bleu4))
+        print("CIDEr-D @ beam size of %d: float32 %.4f, int8 %.4f (delta %+.4f)" % (
+            args.beam_size, cider, q_cider, q_cider - cider))
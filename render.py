@@ -0,0 +1,170 @@
+import functools
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import skimage.transform
+from PIL import Image, ImageDraw
+
+# Size of every word's tile, as in caption.visualize_att (14 pixels, upscaled 24 times)
+TILE_SIZE = 14 * 24
+PNG_COMPRESSION = 1  # zlib level: encoding dominates rendering, and 1 is much faster than 6 for ~10% larger files
+
+
+@functools.lru_cache()
+def upsampling_matrix(n, size=TILE_SIZE, smooth=True):
+    """
+    Upsampling (and smoothing) as caption.visualize_att does it, with skimage, is linear and separable, so it amounts
+    to one matrix A per axis: a map m upsamples to A m A^T.
+
+    Both also preserve constants, so column j of A is any column of the upsampled map that is 1 on row j and 0
+    elsewhere. A is computed once per size.
+
+    :param n: size of the maps
+    :param size: size to upsample them to
+    :param smooth: also smooth?
+    :return: A, a tensor of dimensions (size, n)
+    """
+    columns = list()
+    for j in range(n):
+        basis = np.zeros((n, n))
+        basis[j] = 1.
+        if smooth:
+            upsampled = skimage.transform.pyramid_expand(basis, upscale=size / float(n), sigma=8. * size / TILE_SIZE)
+        else:
+            upsampled = skimage.transform.resize(basis, [size, size])
+        columns.append(upsampled[:, 0])
+    return torch.from_numpy(np.stack(columns, axis=1)).float()
+
+
+def alpha_maps(alphas, size=TILE_SIZE, smooth=True):
+    """
+    Upsamples the weights of all words (of any number of images) to the size of the tiles they are drawn on, in one
+    batched matrix product (see upsampling_matrix).
+
+    Each map is then scaled to [0, 255], as matplotlib scales an image it shows.
+
+    :param alphas: weights, a tensor of dimensions (n, enc_image_size, enc_image_size)
+    :param size: size of the tiles
+    :param smooth: smooth the maps (with a Gaussian), rather than just interpolating?
+    :return: maps, a uint8 array of dimensions (n, size, size)
+    """
+    alphas = alphas.float()
+    upsample = upsampling_matrix(alphas.size(1), size, smooth).to(alphas.device)  # (size, enc_image_size)
+    maps = upsample.matmul(alphas).matmul(upsample.t())  # (n, size, size)
+    low = maps.flatten(1).min(dim=1)[0].view(-1, 1, 1)
+    high = maps.flatten(1).max(dim=1)[0].view(-1, 1, 1)
+    maps = (maps - low) / (high - low).clamp(min=1e-12)
+    return (maps * 255).round().byte().cpu().numpy()
+
+
+def composite(image_path, words, maps, out, frames=False, columns=5):
+    """
+    Draws every word over the image, overlaid with its (upsampled) weights, and writes a PNG grid of them, or one PNG
+    frame per word. Only uses PIL and numpy, so that it can run in worker processes.
+
+    :param image_path: path to the image captioned
+    :param words: words of the caption, from <start>
+    :param maps: their weights, see alpha_maps
+    :param out: path to write the grid to (with frames, frames are written next to it, numbered)
+    :param frames: write one frame per word rather than a grid?
+    :param columns: words per row of the grid
+    :return: paths written
+    """
+    size = maps.shape[1]
+    image = np.asarray(Image.open(image_path).convert('RGB').resize([size, size], Image.LANCZOS), dtype=np.float32)
+    # 80% opaque greyscale maps over the image; none over <start>
+    tiles = image[np.newaxis] * 0.2 + maps[..., np.newaxis].astype(np.float32) * 0.8  # (n_words, size, size, 3)
+    tiles[0] = image
+    tiles = tiles.round().astype(np.uint8)
+
+    images = list()
+    for tile, word in zip(tiles, words):
+        tile = Image.fromarray(tile)
+        draw = ImageDraw.Draw(tile)
+        draw.rectangle(draw.textbbox((2, 2), word), fill='white')
+        draw.text((2, 2), word, fill='black')
+        images.append(tile)
+
+    if not os.path.isdir(os.path.dirname(out) or '.'):
+        os.makedirs(os.path.dirname(out))
+    if frames:
+        stem = os.path.splitext(out)[0]
+        paths = ['%s_%02d.png' % (stem, t) for t in range(len(images))]
+        for tile, path in zip(images, paths):
+            tile.save(path, compress_level=PNG_COMPRESSION)
+        return paths
+    rows = int(math.ceil(len(images) / float(columns)))
+    grid = Image.new('RGB', (min(columns, len(images)) * size, rows * size), 'white')
+    for t, tile in enumerate(images):
+        grid.paste(tile, ((t % columns) * size, (t // columns) * size))
+    grid.save(out, compress_level=PNG_COMPRESSION)
+    return [out]
+
+
+def render(image_path, seq, alphas, rev_word_map, out, smooth=True, frames=False):
+    """
+    Renders a caption and its weights to disk, without a display (see composite).
+
+    :param image_path: path to image that has been captioned
+    :param seq: caption
+    :param alphas: weights, a tensor of dimensions (len(seq), enc_image_size, enc_image_size)
+    :param rev_word_map: reverse word mapping, i.e. ix2word
+    :param out: path to write to
+    :param smooth: smooth weights?
+    :param frames: write one frame per word rather than a grid?
+    :return: paths written
+    """
+    words = [rev_word_map[ind] for ind in seq]
+    return composite(image_path, words, alpha_maps(alphas, smooth=smooth), out, frames)
+
+
+class Renderer(object):
+    """
+    Renders many captions in parallel: weights are upsampled in the calling process (in batches, see alpha_maps), and
+    composited and encoded to PNG by a pool of worker processes.
+    """
+
+    def __init__(self, out_dir, workers=4, smooth=True, frames=False):
+        """
+        :param out_dir: folder to write to, one grid (or set of frames) per image, named after the image's path
+        :param workers: worker processes
+        :param smooth: smooth weights?
+        :param frames: write one frame per word rather than a grid?
+        """
+        self.out_dir = out_dir
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.smooth = smooth
+        self.frames = frames
+        # Spawned rather than forked, as forking a process running torch's threads isn't safe
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.futures = list()
+
+    def submit(self, image_paths, seqs, alphas, rev_word_map):
+        """
+        :param image_paths: paths to images that have been captioned
+        :param seqs: their captions
+        :param alphas: their weights, a tensor of dimensions (len(seqs), longest caption, enc_image_size, ...)
+        :param rev_word_map: reverse word mapping, i.e. ix2word
+        """
+        lengths = [len(seq) for seq in seqs]
+        maps = alpha_maps(torch.cat([a[:length] for a, length in zip(alphas, lengths)]), smooth=self.smooth)
+        offsets = np.cumsum([0] + lengths)
+        for i, (image_path, seq) in enumerate(zip(image_paths, seqs)):
+            name = os.path.normpath(os.path.splitext(image_path)[0]).lstrip(os.sep).replace(os.sep, '_')
+            out = os.path.join(self.out_dir, name + '.png')
+            self.futures.append(self.pool.submit(composite, image_path, [rev_word_map[ind] for ind in seq],
+                                                 maps[offsets[i]:offsets[i + 1]], out, self.frames))
+
+    def close(self):
+        """
+        Waits for all images to be written.
+
+        :return: paths written
+        """
+        paths = [path for future in self.futures for path in future.result()]
+        self.pool.shutdown()
+        return paths
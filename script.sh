@@ -5,6 +5,8 @@
 #SBATCH --gres=gpu:1
 #SBATCH --mem=20000  # memory in Mb
 #SBATCH --time=0-08:00:00
+#SBATCH --signal=B:USR1@300  # 5 minutes before the time limit, have train.py save a checkpoint and stop
+#SBATCH --requeue  # may be requeued: by Slurm if preempted, by train.py if out of time; it resumes from its checkpoint
 
 export CUDA_HOME=/opt/cuda-9.0.176.1/
 
@@ -34,4 +36,4 @@ export DATASET_DIR=${TMP}/datasets/
 
 source /home/${STUDENT_ID}/miniconda3/bin/activate mlp
 cd show_att/
-python train.py 
+exec python train.py  # exec, so that the scheduler's signals reach train.py
@@ -0,0 +1,358 @@
+import argparse
+import base64
+import io
+import json
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from caption import read_image
+from caption_cache import CaptionCache, model_id
+from decoding import beam_search, greedy_search
+from export import load_word_map
+from utils import load_model
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class MicroBatcher(object):
+    """
+    Captions images submitted from any number of threads, gathering them into batches: a batch is run as soon as it is
+    full, or when its first image has waited max_wait seconds, so that concurrent requests share the encoder and
+    decoder while a lone request is only delayed by max_wait.
+
+    The models stay resident, and run on a single worker thread.
+
+    With a cache, image files (see submit_bytes) whose caption it has are answered from it, and requests for an image
+    being captioned wait for that caption rather than captioning it again.
+    """
+
+    def __init__(self, encoder, decoder, word_map, device, beam_size=3, greedy=False, max_length=51,
+                 max_batch_size=16, max_wait=0.01, window=1000, cache=None):
+        """
+        :param encoder: encoder model
+        :param decoder: decoder model
+        :param word_map: word map
+        :param device: device the models are on
+        :param beam_size: beam size for beam search
+        :param greedy: decode greedily instead?
+        :param max_length: number of words to decode at most
+        :param max_batch_size: images per batch at most
+        :param max_wait: seconds the first image of a batch may wait for others
+        :param window: number of recent requests latency percentiles are computed over
+        :param cache: caption_cache.CaptionCache to look captions up in and add them to, or None
+        """
+        self.encoder = encoder
+        self.decoder = decoder
+        self.word_map = word_map
+        self.rev_word_map = {v: k for k, v in word_map.items()}  # ix2word
+        self.special_words = {word_map['<start>'], word_map['<end>'], word_map['<pad>']}
+        self.device = device
+        self.beam_size = beam_size
+        self.greedy = greedy
+        self.max_length = max_length
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache = cache
+        self.in_flight = dict()  # key in the cache: Future of the caption of an image being captioned
+        self.coalesced = 0  # requests that waited for an image being captioned
+
+        self.queue = queue.Queue()  # (image, future, time submitted, key in the cache or None)
+        self.lock = threading.Lock()  # guards the metrics
+        self.latencies = deque(maxlen=window)  # seconds from submission to result
+        self.waits = deque(maxlen=window)  # seconds from submission to the start of the batch
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.started = time.time()
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image, key=None):
+        """
+        :param image: image, a tensor of dimensions (3, 256, 256) (see caption.read_image)
+        :param key: key in the cache to add the result to once it is delivered, or None
+        :return: Future of the result, a dict with the caption, its word indices and whether it reached <end>
+        """
+        future = Future()
+        self.queue.put((image, future, time.time(), key))
+        return future
+
+    def submit_bytes(self, image_bytes):
+        """
+        :param image_bytes: contents of an image file
+        :return: Future of the result, see submit
+        """
+        if self.cache is None:
+            return self.submit(read_image(io.BytesIO(image_bytes)))
+
+        key = self.cache.key(image_bytes, self.beam_size, self.greedy, self.max_length)
+        cached = self.cache.get(key)
+        if cached is not None:
+            future = Future()
+            future.set_result(self.result(cached['seq'], cached['complete']))
+            return future
+        with self.lock:
+            if key in self.in_flight:
+                self.coalesced += 1
+                return self.in_flight[key]
+
+        image = read_image(io.BytesIO(image_bytes))
+        with self.lock:
+            if key in self.in_flight:  # submitted by another thread while this one read the image
+                self.coalesced += 1
+                return self.in_flight[key]
+            future = self.submit(image, key)
+            self.in_flight[key] = future
+        return future
+
+    def cache_results(self, keys, results=None):
+        """
+        Adds results to the cache, which may write them to disk, so only once they are delivered; then forgets their
+        images as being captioned.
+
+        :param keys: keys in the cache of the images of a batch (None for images submitted without one)
+        :param results: their results, or None if captioning them failed
+        """
+        for n, key in enumerate(keys):
+            if key is None:
+                continue
+            if results is not None:
+                try:
+                    self.cache.put(key, {'seq': results[n]['seq'], 'complete': results[n]['complete']})
+                except OSError as e:  # e.g. a full disk, which shouldn't stop the service
+                    print('Could not cache a caption: %s' % e, file=sys.stderr)
+            with self.lock:
+                del self.in_flight[key]
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            images, futures, submitted, keys = zip(*batch)
+            start = time.time()
+            try:
+                results = self.caption(torch.stack(images))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                with self.lock:
+                    self.errors += len(batch)
+                self.cache_results(keys)
+                continue
+            end = time.time()
+            with self.lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self.waits.extend(start - t for t in submitted)
+                self.latencies.extend(end - t for t in submitted)
+            for future, result in zip(futures, results):
+                future.set_result(result)  # runs the requests' callbacks, e.g. writing the replies
+            self.cache_results(keys, results)
+
+    def caption(self, images):
+        """
+        :param images: images, a tensor of dimensions (batch_size, 3, 256, 256)
+        :return: results, see submit
+        """
+        with torch.no_grad():
+            encoder_out = self.encoder(images.to(self.device))
+        start, end = self.word_map['<start>'], self.word_map['<end>']
+        if self.greedy:
+            seqs, complete = greedy_search(self.decoder, encoder_out, start, end, self.max_length)
+        else:
+            seqs, complete = beam_search(self.decoder, encoder_out, start, end, self.beam_size, self.max_length)
+        return [self.result(seq, done) for seq, done in zip(seqs, complete)]
+
+    def result(self, seq, complete):
+        return {'caption': ' '.join(self.rev_word_map[w] for w in seq if w not in self.special_words),
+                'seq': seq,
+                'complete': complete}
+
+    def metrics(self):
+        """
+        :return: queue depth, request and batch counts, mean batch size, and percentiles of the latency and of the time
+                 spent queueing (in ms, over the most recent requests); with a cache, its metrics (see
+                 CaptionCache.metrics) and the number of requests that waited for an image being captioned
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            waits = np.array(self.waits) * 1000
+            metrics = {'queue_depth': self.queue.qsize(),
+                       'requests': self.requests,
+                       'errors': self.errors,
+                       'batches': self.batches,
+                       'mean_batch_size': self.requests / max(self.batches, 1),
+                       'uptime_s': time.time() - self.started}
+            coalesced = self.coalesced
+        for name, values in (('latency_ms', latencies), ('queue_wait_ms', waits)):
+            metrics[name] = {'p%d' % p: float(np.percentile(values, p)) if len(values) else None for p in (50, 95, 99)}
+        if self.cache is not None:
+            metrics['cache'] = dict(self.cache.metrics(), coalesced=coalesced)
+        return metrics
+
+
+def read_request_image(request):
+    """
+    :param request: dict with either 'path', the path to an image, or 'image', the base64-encoded image file
+    :return: contents of the image file
+    """
+    if 'image' in request:
+        return base64.b64decode(request['image'])
+    with open(request['path'], 'rb') as f:
+        return f.read()
+
+
+class CaptionHandler(BaseHTTPRequestHandler):
+    """
+    POST /caption with a JSON request (see read_request_image) returns the caption; GET /metrics returns the
+    batcher's metrics.
+    """
+
+    batcher = None  # set by serve_http
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.reply(200, self.batcher.metrics())
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/caption':
+            self.reply(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            # Read in this request's thread, in parallel with the others
+            future = self.batcher.submit_bytes(read_request_image(request))
+        except Exception as e:
+            self.reply(400, {'error': str(e)})
+            return
+        try:
+            self.reply(200, future.result())
+        except Exception as e:
+            self.reply(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        pass  # one line per request is too much at high rates; see /metrics
+
+
+def serve_http(batcher, host='127.0.0.1', port=8000):
+    CaptionHandler.batcher = batcher
+    server = ThreadingHTTPServer((host, port), CaptionHandler)
+    print('Serving on http://%s:%d (POST /caption, GET /metrics)' % (host, port), file=sys.stderr)
+    server.serve_forever()
+
+
+def serve_jsonl(batcher, lines=sys.stdin, out=sys.stdout):
+    """
+    Captions JSONL requests (see read_request_image; an 'id' is echoed back) from lines, writing a JSONL result for
+    every one to out as soon as it is ready, so possibly out of order. A {"metrics": true} request returns the
+    batcher's metrics.
+    """
+    lock = threading.Lock()
+
+    def write(result):
+        with lock:
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+
+    def done(request_id, future, written):
+        try:
+            write(dict(future.result(), id=request_id))
+        except Exception as e:
+            write({'id': request_id, 'error': str(e)})
+        finally:
+            written.set()
+
+    # Results are written by the futures' callbacks, on the batcher's (daemon) thread, so this waits for the writes
+    # rather than for the futures
+    pending = list()
+    for line in lines:
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            if request.get('metrics'):
+                write(dict(batcher.metrics(), id=request_id))
+                continue
+            future = batcher.submit_bytes(read_request_image(request))
+        except Exception as e:
+            write({'id': request_id, 'error': str(e)})
+            continue
+        written = threading.Event()
+        future.add_done_callback(lambda f, request_id=request_id, written=written: done(request_id, f, written))
+        pending.append(written)
+    for written in pending:
+        written.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show, Attend, and Tell - Caption service')
+
+    parser.add_argument('--model', '-m', help='path to model (a checkpoint, or an artifact written by quantize.py or '
+                                              'export.py)')
+    parser.add_argument('--word_map', '-wm', help='path to word map JSON (default: that of an artifact written by '
+                                                  'export.py)')
+    parser.add_argument('--beam_size', '-b', default=3, type=int, help='beam size for beam search')
+    parser.add_argument('--greedy', action='store_true', help='decode greedily (beam size 1, faster)')
+    parser.add_argument('--max_length', default=51, type=int, help='number of words to decode at most')
+    parser.add_argument('--max_batch_size', default=16, type=int, help='images per batch at most')
+    parser.add_argument('--max_wait_ms', default=10., type=float, help='ms a request may wait for others to batch with')
+    parser.add_argument('--stdio', action='store_true', help='read JSONL requests from stdin instead of serving HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--threads', type=int, help='threads for CPU inference (default: torch\'s)')
+    parser.add_argument('--cpu', action='store_true', help='run on the CPU even if a GPU is available')
+    parser.add_argument('--cache_dir', help='also keep captions in this folder, for restarts and other processes with '
+                                            'the same model and parameters to reuse')
+    parser.add_argument('--cache_entries', default=10000, type=int,
+                        help='captions to keep in memory, for images requested again (0, without --cache_dir: none)')
+    parser.add_argument('--cache_mb', default=1024., type=float, help='MB of captions to keep in --cache_dir at most')
+
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    encoder, decoder, device = load_model(args.model, torch.device('cpu') if args.cpu else device)
+    if args.word_map:
+        with open(args.word_map, 'r') as j:
+            word_map = json.load(j)
+    else:
+        word_map = load_word_map(args.model)
+
+    cache = None
+    if args.cache_entries > 0 or args.cache_dir:
+        cache = CaptionCache(model_id(args.model), args.cache_dir, args.cache_entries, int(args.cache_mb * 2 ** 20))
+    batcher = MicroBatcher(encoder, decoder, word_map, device, args.beam_size, args.greedy, args.max_length,
+                           args.max_batch_size, args.max_wait_ms / 1000., cache=cache)
+    if args.stdio:
+        serve_jsonl(batcher)
+    else:
+        serve_http(batcher, args.host, args.port)
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import torch
+
+
+class StageProfiler(object):
+    """
+    Times the stages of every training step (data loading, host-to-device copies, forward, backward, ...), and reports
+    their mean per step along with images/sec and tokens/sec.
+
+    Kernels run asynchronously on GPUs, so the device is synchronized around every stage: timings are then accurate, at
+    some cost in throughput. This is why it's opt-in; when disabled, stages cost a no-op context manager.
+
+    Optionally, a torch.profiler trace of a window of steps is written, with every stage labelled.
+    """
+
+    def __init__(self, device, enabled=True, metrics_file=None, interval=100, trace_steps=None, trace_dir='traces',
+                 rank=0):
+        """
+        :param device: device the model trains on
+        :param enabled: time stages at all?
+        :param metrics_file: JSONL file to append a record to every interval steps, or None
+        :param interval: steps per record
+        :param trace_steps: (first, last) global steps to trace with torch.profiler (counting from 1), or None
+        :param trace_dir: folder to write traces to
+        :param rank: rank of this process, recorded with the metrics
+        """
+        self.device = device
+        self.enabled = enabled
+        self.interval = interval
+        self.trace_steps = trace_steps if enabled else None
+        self.trace_dir = trace_dir
+        self.rank = rank
+        self.metrics = open(metrics_file, 'a') if enabled and metrics_file is not None else None
+
+        self.global_step = 0  # steps over all epochs
+        self.last_report = None  # record of the last complete interval
+        self.profile = None  # torch.profiler, while tracing
+        self.reset()
+        if self.trace_steps is not None and self.trace_steps[0] <= 1:
+            self.start_trace()
+
+    def reset(self):
+        """
+        Starts a new interval.
+        """
+        self.stage_times = OrderedDict()  # seconds spent in every stage during the interval
+        self.steps = 0
+        self.images = 0
+        self.tokens = 0
+        self.start = time.time()
+
+    def sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the code run in the context as stage name.
+        """
+        if not self.enabled:
+            yield
+            return
+        self.sync()
+        start = time.time()
+        if self.profile is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self.sync()
+        self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        """
+        Adds time measured outside of a stage context (e.g. waiting for the DataLoader).
+        """
+        if self.enabled:
+            self.stage_times[name] = self.stage_times.get(name, 0.) + seconds
+
+    def step(self, epoch, images, tokens):
+        """
+        Ends a step, writing a record if the interval is over.
+
+        :param epoch: epoch number
+        :param images: images in the step's batch
+        :param tokens: words decoded in the step
+        """
+        if not self.enabled:
+            return
+        self.steps += 1
+        self.images += images
+        self.tokens += tokens
+        self.global_step += 1
+
+        # Tracing window, which starts before its first step and stops after its last one
+        if self.trace_steps is not None:
+            first, last = self.trace_steps
+            if self.global_step == last and self.profile is not None:
+                self.stop_trace(first, last)
+            elif self.global_step + 1 == first:
+                self.start_trace()
+
+        if self.steps == self.interval:
+            self.last_report = self.report(epoch)
+            if self.metrics is not None:
+                self.metrics.write(json.dumps(self.last_report) + '\n')
+                self.metrics.flush()
+            self.reset()
+
+    def report(self, epoch):
+        """
+        :return: a record of the current interval
+        """
+        elapsed = time.time() - self.start
+        return {'time': time.time(),
+                'rank': self.rank,
+                'epoch': epoch,
+                'step': self.global_step,
+                'steps': self.steps,
+                'step_ms': elapsed * 1000 / max(self.steps, 1),
+                'images_per_sec': self.images / elapsed,
+                'tokens_per_sec': self.tokens / elapsed,
+                'stage_ms': OrderedDict((name, t * 1000 / max(self.steps, 1)) for name, t in self.stage_times.items())}
+
+    def summary(self, epoch):
+        """
+        :return: one line summing up the current interval (or the last one, if the current one just started)
+        """
+        record = self.report(epoch) if self.steps > 0 or self.last_report is None else self.last_report
+        stages = ', '.join('%s %.1f' % (name, ms) for name, ms in record['stage_ms'].items())
+        return 'Stages (ms/step): {0}\tImages/sec {1:.1f}\tTokens/sec {2:.1f}'.format(
+            stages, record['images_per_sec'], record['tokens_per_sec'])
+
+    def start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profile = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.profile.__enter__()
+
+    def stop_trace(self, first, last):
+        self.profile.__exit__(None, None, None)
+        if not os.path.isdir(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        path = os.path.join(self.trace_dir, 'trace_rank%d_steps%d-%d.json' % (self.rank, first, last))
+        self.profile.export_chrome_trace(path)
+        self.profile = None
+        print('Wrote torch.profiler trace of steps %d to %d to %s' % (first, last, path))
+
+    def close(self):
+        """
+        Stops a trace still running, and closes the metrics file.
+        """
+        if self.profile is not None:
+            self.stop_trace(self.trace_steps[0], self.global_step)
+        if self.metrics is not None:
+            self.metrics.close()
@@ -0,0 +1,59 @@
+import copy
+import os
+import sys
+import torch
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from models_backup import AdaptiveLSTMCell, DecoderWithAttention, FusedAdaptiveLSTMCell
+
+
+def random_cell(input_size, hidden_size):
+    cell = AdaptiveLSTMCell(input_size, hidden_size)
+    cell.b_ih.data.uniform_(-0.1, 0.1)  # non-zero biases, so that the bias folding is actually checked
+    cell.b_hh.data.uniform_(-0.1, 0.1)
+    return cell
+
+
+def test_fused_cell_matches_adaptive_cell():
+    torch.manual_seed(0)
+    cell = random_cell(24, 16)
+    fused = FusedAdaptiveLSTMCell.from_cell(cell)
+    inp = torch.randn(4, 24, requires_grad=True)
+    h = torch.randn(4, 16, requires_grad=True)
+    c = torch.randn(4, 16, requires_grad=True)
+
+    outs = cell(inp, (h, c))
+    grads = torch.autograd.grad(sum(o.sum() for o in outs), (inp, h, c) + tuple(cell.parameters()))
+    fused_outs = fused(inp, (h, c))
+    fused_grads = torch.autograd.grad(sum(o.sum() for o in fused_outs), (inp, h, c) + tuple(fused.parameters()))
+
+    for a, b in zip(list(outs) + list(grads[:3]), list(fused_outs) + list(fused_grads[:3])):
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-6)
+    # The fused weight's gradient is that of [w_ih | w_hh], and both biases get the fused bias' gradient
+    d_w_ih, d_w_hh, d_b_ih, d_b_hh = grads[3:]
+    d_weight, d_bias = fused_grads[3:]
+    assert torch.allclose(torch.cat([d_w_ih, d_w_hh], dim=1), d_weight, rtol=1e-4, atol=1e-6)
+    assert torch.allclose(d_b_ih, d_bias, rtol=1e-4, atol=1e-6) and torch.allclose(d_b_hh, d_bias, rtol=1e-4, atol=1e-6)
+
+
+def test_decoder_with_fused_cell_matches_adaptive_cell():
+    torch.manual_seed(0)
+    decoder = DecoderWithAttention(attention_dim=8, embed_dim=8, decoder_dim=16, vocab_size=12, encoder_dim=24,
+                                   sentinel=True)
+    decoder.eval()  # no dropout
+    cell = random_cell(8 + 24, 16)
+    reference = copy.deepcopy(decoder)
+    reference.decode_step = cell
+    decoder.decode_step = FusedAdaptiveLSTMCell.from_cell(cell)
+
+    encoder_out = torch.randn(3, 2, 2, 24)
+    captions = torch.randint(0, 12, (3, 6))
+    caplens = torch.LongTensor([[6], [4], [5]])
+    with torch.no_grad():
+        outs, reference_outs = decoder(encoder_out, captions, caplens), reference(encoder_out, captions, caplens)
+
+    assert outs[2] == reference_outs[2]  # decode lengths
+    for a, b in zip(outs[:2] + outs[3:], reference_outs[:2] + reference_outs[3:]):
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,34 @@
+import os
+import sys
+import torch
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from decoding import beam_search
+from models import Encoder, Decoder
+from quantize import artifact, quantize_decoder, quantize_encoder
+from utils import load_model
+
+
+def test_static_artifact_round_trip(tmp_path):
+    torch.manual_seed(0)
+    encoder = Encoder(backbone='resnet18', weights=None, pooled=True)  # as load_model sets it for this decoder
+    decoder = Decoder(embed_dim=16, decoder_dim=16, vocab_size=9, encoder_dim=512)
+    images = torch.randn(2, 3, 256, 256)
+
+    q_encoder = quantize_encoder(encoder, [images])
+    q_decoder = quantize_decoder(decoder)
+    path = str(tmp_path / 'INT8_checkpoint.pth.tar')
+    torch.save(artifact(encoder, decoder, q_encoder, q_decoder, True, 'checkpoint.pth.tar'), path)
+
+    l_encoder, l_decoder, device = load_model(path, torch.device('cpu'))
+    assert not l_encoder.training and not l_decoder.training
+    with torch.no_grad():
+        encoder_out, l_encoder_out = q_encoder(images), l_encoder(images)
+    assert torch.equal(encoder_out, l_encoder_out)
+    assert beam_search(q_decoder, encoder_out, 7, 8, 3, 5)[0] == beam_search(l_decoder, l_encoder_out, 7, 8, 3, 5)[0]
+
+    # Switching modes, as fine-tuning and evaluating do, leaves the quantized trunk alone
+    l_encoder.train()
+    l_encoder.eval()
@@ -0,0 +1,101 @@
+import base64
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+import torch
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from models import Encoder, Decoder
+from serve import serve_jsonl
+
+
+@pytest.fixture(scope='module')
+def model(tmp_path_factory):
+    """
+    A small randomly initialized checkpoint and its word map.
+    """
+    folder = tmp_path_factory.mktemp('model')
+    words = ['a', 'dog', 'runs', 'on', 'grass']
+    word_map = {w: i + 1 for i, w in enumerate(words + ['<unk>', '<start>', '<end>'])}
+    word_map['<pad>'] = 0
+    torch.manual_seed(0)
+    encoder = Encoder(backbone='resnet18', weights=None)
+    decoder = Decoder(embed_dim=16, decoder_dim=16, vocab_size=len(word_map), encoder_dim=512)
+    checkpoint_path = str(folder / 'checkpoint.pth.tar')
+    torch.save({'encoder': encoder, 'decoder': decoder}, checkpoint_path)
+    word_map_path = str(folder / 'WORDMAP.json')
+    with open(word_map_path, 'w') as j:
+        json.dump(word_map, j)
+    return checkpoint_path, word_map_path
+
+
+def serve_stdio(model, requests, *args):
+    checkpoint_path, word_map_path = model
+    lines = ''.join(json.dumps(request) + '\n' for request in requests)
+    process = subprocess.run([sys.executable, os.path.join(root, 'serve.py'), '--stdio', '--cpu', '-m', checkpoint_path,
+                              '-wm', word_map_path, '--beam_size', '2', '--max_length', '5'] + list(args),
+                             input=lines, capture_output=True, text=True, cwd=root, timeout=300)
+    assert process.returncode == 0, process.stderr
+    return [json.loads(line) for line in process.stdout.splitlines()]
+
+
+@pytest.mark.parametrize('cache', ['none', 'memory', 'disk'])
+def test_stdio_answers_every_request(model, cache, tmp_path):
+    images = [os.path.join(root, 'tests', 'test.png'), os.path.join(root, 'tests', 'test2.png')]
+    # Duplicates, both while the first is being captioned (coalesced) and after (from the cache)
+    requests = [{'id': n, 'path': images[[0, 0, 1][n % 3]]} for n in range(8)]
+    requests.append({'id': 'missing', 'path': 'missing.png'})
+    args = {'none': ['--cache_entries', '0'], 'memory': [], 'disk': ['--cache_dir', str(tmp_path / 'captions')]}[cache]
+    results = serve_stdio(model, requests, *args)
+
+    # One line per request, however many were answered by the same captioning
+    assert sorted(str(result['id']) for result in results) == sorted(str(request['id']) for request in requests)
+    by_id = dict((result['id'], result) for result in results)
+    assert 'error' in by_id['missing']
+    for request in requests[:-1]:
+        assert by_id[request['id']]['caption'] == by_id[images.index(request['path']) * 2]['caption']
+
+
+class SlowOutput(io.StringIO):
+    """
+    Output that takes a while to write to, like a pipe to a slow reader.
+    """
+
+    def write(self, s):
+        time.sleep(0.05)
+        return super(SlowOutput, self).write(s)
+
+
+class ThreadBatcher(object):
+    """
+    Stands in for serve.MicroBatcher: completes futures on its own thread, where their callbacks then run.
+    """
+
+    def __init__(self):
+        self.futures = dict()  # image: Future of its result, shared by the duplicates
+
+    def submit_bytes(self, image_bytes):
+        if image_bytes not in self.futures:
+            future = Future()
+            self.futures[image_bytes] = future
+            threading.Timer(0.01, future.set_result, [{'caption': image_bytes.decode()}]).start()
+        return self.futures[image_bytes]
+
+
+def test_serve_jsonl_waits_for_writes():
+    images = [b'a dog', b'a dog', b'a cat', b'a dog', b'a cat']
+    lines = [json.dumps({'id': n, 'image': base64.b64encode(image).decode()}) + '\n' for n, image in enumerate(images)]
+    out = SlowOutput()
+    serve_jsonl(ThreadBatcher(), lines, out)
+
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert sorted(result['id'] for result in results) == list(range(len(images)))
+    assert all(result['caption'] == images[result['id']].decode() for result in results)
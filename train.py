@@ -1,26 +1,37 @@
 import time
+import random
+import signal
+import subprocess
 import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torchvision.transforms as transforms
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.nn.utils.rnn import pack_padded_sequence
+from torch.utils.data.distributed import DistributedSampler
 from models import Encoder, Decoder
 from datasets import *
 from utils import *
-from nltk.translate.bleu_score import corpus_bleu
+from bleu import BLEU
+from cider import reference_tables, CIDErD
+from telemetry import StageProfiler
+from feature_cache import PrefixActivationCache, PrefixActivationDataset
 
 # Data parameters
 data_folder = 'dataset'  # folder with data files saved by create_input_files.py
 data_name = 'flickr8k_5_cap_per_img_5_min_word_freq'  # base name shared by data files
 
 # Model parameters
+backbone = 'resnet101'  # encoder CNN, one of models.BACKBONES
+backbone_weights = 'imagenet'  # 'imagenet', or path to a local state_dict of the backbone (for offline nodes)
+backbone_cache_dir = None  # folder pretrained backbone weights are cached in, None for torch hub's default
 emb_dim = 512  # dimension of word embeddings
 decoder_dim = 512  # dimension of decoder RNN
 dropout = 0.5
-#device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # sets device for model and PyTorch tensors
-device = torch.device("cuda")
-torch.cuda.set_device(0)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # sets device for model and PyTorch tensors
 cudnn.benchmark = True  # set to true only if inputs to model are fixed size; otherwise lot of computational overhead
 
 # Training parameters
@@ -35,42 +46,121 @@ grad_clip = 5.  # clip gradients at an absolute value of
 alpha_c = 1.  # regularization parameter for 'doubly stochastic attention', as in the paper
 best_bleu4 = 0.  # BLEU-4 score right now
 print_freq = 100  # print training/validation stats every __ batches
+val_subset_size = None  # validate on a fixed subset of this many validation captions every epoch, None for all of them
+full_val_every = 5  # with a subset, still validate on all of them every __ epochs (only those pick the best
+                    # checkpoint; an epoch improves if its BLEU-4 beats the best one computed on the same captions)
+best_subset_bleu4 = 0.  # BLEU-4 score right now, on the validation subset
 fine_tune_encoder = True  # fine-tune encoder?
 checkpoint = None  # path to checkpoint, None if none
-
-
-def main():
+skip_pretrained_weights = True  # don't save frozen encoder weights that are identical to the pretrained backbone
+prefix_cache_dir = None  # folder to cache the activations of the encoder's frozen prefix in (float16, about 2MB per
+                         # image for ResNets), to train from them instead of from pixels; None to recompute them
+
+# Profiling parameters
+profile_stages = False  # time every stage of a training step (syncs the GPU around each, so slows training a bit)
+metrics_file = None  # JSONL file to append stage timings and images/tokens per sec to, None to only print them
+metrics_interval = 100  # training steps per metrics record
+trace_steps = None  # (first, last) training steps (from 1, over all epochs) to capture a torch.profiler trace of
+trace_dir = 'traces'  # folder to write traces to
+
+# Resumption parameters, for jobs that can be preempted or run out of time
+step_checkpoint_every = 1000  # also save the checkpoint every __ training batches, None to only save it after epochs
+resume = True  # if checkpoint is None, continue an unfinished run from its checkpoint_<data_name>.pth.tar, if any
+shuffle_seed = 0  # seed of the order of training batches (reproducible, so that an epoch can be resumed part way)
+stop_signals = [signal.SIGTERM] + ([signal.SIGUSR1] if hasattr(signal, 'SIGUSR1') else [])  # save and stop on these
+stop_requested = False  # set when one of stop_signals is received
+stop_signal = None  # the one received
+requeue_signals = [signal.SIGUSR1] if hasattr(signal, 'SIGUSR1') else []  # after stopping on these (sent before the
+                                                                          # time limit by script.sh / long.sh), requeue
+                                                                          # the Slurm job, which resumes
+stop_poll_every = 20  # with several processes, agree on whether to stop every __ batches (it takes a collective)
+
+# Distributed parameters
+distributed = False  # data-parallel training over several processes? (always on when launched with torchrun)
+world_size = 2  # number of processes to spawn on this machine, if distributed
+dist_backend = 'gloo'  # works on CPU-only nodes; 'nccl' is faster across GPUs
+rank = 0  # rank of this process, set by main
+
+
+def main(process_rank=0, n_processes=1):
     """
     Training and validation.
+
+    :param process_rank: rank of this process, if distributed
+    :param n_processes: number of processes training together
     """
 
-    global best_bleu4, epochs_since_improvement, checkpoint, start_epoch, fine_tune_encoder, data_name, word_map
+    global best_bleu4, best_subset_bleu4, epochs_since_improvement, checkpoint, start_epoch, fine_tune_encoder, \
+        data_name, word_map, device, rank
+
+    # Save a checkpoint and stop after the current batch when the scheduler is about to end the job
+    for signum in stop_signals:
+        signal.signal(signum, request_stop)
+
+    rank = process_rank
+    if n_processes > 1:
+        dist.init_process_group(dist_backend, rank=rank, world_size=n_processes)
+        if torch.cuda.is_available():
+            device = torch.device('cuda', rank % torch.cuda.device_count())
+        else:
+            torch.set_num_threads(max(1, os.cpu_count() // n_processes))  # don't oversubscribe the CPU cores
 
     # Read word map
     word_map_file = os.path.join(data_folder, 'WORDMAP_' + data_name + '.json')
     with open(word_map_file, 'r') as j:
         word_map = json.load(j)
 
+    # Continue where an interrupted run left off, unless told which checkpoint to start from
+    latest_checkpoint = 'checkpoint_' + data_name + '.pth.tar'
+    if checkpoint is None and resume and os.path.isfile(latest_checkpoint):
+        latest_checkpoint = load_checkpoint(latest_checkpoint)
+        if latest_checkpoint.get('step') is not None or (latest_checkpoint['epoch'] + 1 < epochs and
+                                                          latest_checkpoint['epochs_since_improvement'] < 20):
+            checkpoint = latest_checkpoint
+
     # Initialize / load checkpoint
+    start_step = 0  # batches of the first epoch already trained on
+    rng = None  # random number generator states to resume with
+    recent_bleu4 = 0.  # BLEU-4 of the last validation
     if checkpoint is None:
-        decoder = Decoder(embed_dim=emb_dim,decoder_dim=decoder_dim,vocab_size=len(word_map),dropout=dropout)
-        decoder_optimizer = torch.optim.Adam(params=filter(lambda p: p.requires_grad, decoder.parameters()),
-                                             lr=decoder_lr)
-        encoder = Encoder()
+        # The decoder doesn't attend over pixels, so the encoder only needs to hand it pooled features
+        encoder = Encoder(backbone=backbone, weights=backbone_weights, cache_dir=backbone_cache_dir, pooled=True)
         encoder.fine_tune(fine_tune_encoder)
         encoder_optimizer = torch.optim.Adam(params=filter(lambda p: p.requires_grad, encoder.parameters()),
                                              lr=encoder_lr) if fine_tune_encoder else None
+        decoder = Decoder(embed_dim=emb_dim, decoder_dim=decoder_dim, vocab_size=len(word_map),
+                          encoder_dim=encoder.encoder_dim, dropout=dropout)
+        decoder_optimizer = torch.optim.Adam(params=filter(lambda p: p.requires_grad, decoder.parameters()),
+                                             lr=decoder_lr)
 
     else:
-        checkpoint = torch.load(checkpoint)
-        start_epoch = checkpoint['epoch'] + 1
+        if not isinstance(checkpoint, dict):
+            checkpoint = load_checkpoint(checkpoint)
+        if checkpoint.get('step') is None:
+            start_epoch = checkpoint['epoch'] + 1
+        else:
+            # Saved part way through an epoch, which resumes from the next batch
+            start_epoch, start_step = checkpoint['epoch'], checkpoint['step']
         epochs_since_improvement = checkpoint['epochs_since_improvement']
-        best_bleu4 = checkpoint['bleu-4']
-        decoder = checkpoint['decoder']
-        decoder_optimizer = checkpoint['decoder_optimizer']
-        encoder = checkpoint['encoder']
-        encoder_optimizer = checkpoint['encoder_optimizer']
-        if fine_tune_encoder is True and encoder_optimizer is None:
+        best_bleu4 = checkpoint.get('best_bleu-4', checkpoint['bleu-4'])
+        best_subset_bleu4 = checkpoint.get('best_subset_bleu-4', 0.)
+        recent_bleu4 = checkpoint['bleu-4']
+        rng = checkpoint.get('rng')
+        if rank == 0:
+            print("Resuming at epoch %d, batch %d\n" % (start_epoch, start_step))
+        # Optimizers are rebuilt around the models once they are on the device, then given their saved state
+        decoder = checkpoint['decoder'].to(device)
+        decoder_optimizer = torch.optim.Adam(params=filter(lambda p: p.requires_grad, decoder.parameters()),
+                                             lr=decoder_lr)
+        decoder_optimizer.load_state_dict(checkpoint['decoder_optimizer'])
+        encoder = checkpoint['encoder'].to(device)
+        encoder.pooled = True
+        encoder_optimizer = None
+        if checkpoint['encoder_optimizer'] is not None:
+            encoder_optimizer = torch.optim.Adam(params=filter(lambda p: p.requires_grad, encoder.parameters()),
+                                                 lr=encoder_lr)
+            encoder_optimizer.load_state_dict(checkpoint['encoder_optimizer'])
+        elif fine_tune_encoder is True:
             encoder.fine_tune(fine_tune_encoder)
             encoder_optimizer = torch.optim.Adam(params=filter(lambda p: p.requires_grad, encoder.parameters()),
                                                  lr=encoder_lr)
@@ -79,60 +169,179 @@ def main():
     decoder = decoder.to(device)
     encoder = encoder.to(device)
 
+    # Validate and save the bare models; train the wrapped ones, which average gradients across processes
+    encoder_module, decoder_module = encoder, decoder
+    if n_processes > 1:
+        encoder = DistributedDataParallel(encoder)
+        decoder = DistributedDataParallel(decoder, find_unused_parameters=True)  # f_beta is never used
+
     # Loss function
     criterion = nn.CrossEntropyLoss().to(device)
 
     # Custom dataloaders
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
-    train_loader = torch.utils.data.DataLoader(
-        CaptionDataset(data_folder, data_name, 'TRAIN', transform=transforms.Compose([normalize])),
-        batch_size=batch_size, shuffle=True, num_workers=workers, pin_memory=True)
-    val_loader = torch.utils.data.DataLoader(
-        CaptionDataset(data_folder, data_name, 'VAL', transform=transforms.Compose([normalize])),
-        batch_size=batch_size, shuffle=True, num_workers=workers, pin_memory=True)
+    train_dataset = CaptionDataset(data_folder, data_name, 'TRAIN', transform=transforms.Compose([normalize]))
+    val_dataset = CaptionDataset(data_folder, data_name, 'VAL', transform=transforms.Compose([normalize]))
+
+    # Run the frozen prefix of the encoder once per training image, and train from its cached activations
+    if prefix_cache_dir is not None:
+        prefix_cache = PrefixActivationCache(prefix_cache_dir, 'TRAIN_' + data_name, encoder_module,
+                                             len(train_dataset) // train_dataset.cpi)
+        if rank == 0:
+            prefix_cache.create()
+        if n_processes > 1:
+            dist.barrier()
+        n_cached, fill_time = prefix_cache.fill(train_dataset, encoder_module, device, batch_size, rank, n_processes)
+        if n_processes > 1:
+            dist.barrier()
+        if rank == 0:
+            print("Prefix activations: cached %d images in %.1fs; %.2f GB on disk at %s\n" % (
+                n_cached, fill_time, prefix_cache.disk_bytes() / 2. ** 30, prefix_cache.path))
+        train_dataset = PrefixActivationDataset(train_dataset, prefix_cache)
+    # Each process gets its own shard of the data (batch_size is per process), in an order that can be resumed
+    train_sampler = ResumableSampler(train_dataset, seed=shuffle_seed, num_replicas=n_processes, rank=rank)
+    val_sampler = DistributedSampler(val_dataset, shuffle=False) if n_processes > 1 else None
+    # It also gets its own generator (for the seeds of its workers), so that starting an epoch doesn't draw from the
+    # global one, whose state is resumed
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler,
+                                               num_workers=workers, pin_memory=True, generator=torch.Generator())
+    # Validation order is fixed (no shuffling), so validate knows which images a batch holds
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size, sampler=val_sampler,
+                                             num_workers=workers, pin_memory=True)
+    val_subset_loader = None
+    if val_subset_size is not None:
+        val_subset = sorted(random.Random(0).sample(range(len(val_dataset)), val_subset_size))  # same every epoch
+        val_subset_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size,
+                                                        sampler=val_subset[rank::n_processes],
+                                                        num_workers=workers, pin_memory=True)
+
+    # Tokenize the reference captions once per run, rather than at every validation
+    val_references = val_dataset.references(ignore={word_map['<start>'], word_map['<pad>']})
+    # Likewise CIDEr-D's document frequencies and reference vectors, which are also cached on disk across runs
+    val_cider_tables = reference_tables(val_references, os.path.join(data_folder, 'CIDER_VAL_' + data_name + '.pkl'))
+    full_val_time = None  # seconds per validation caption, last time all of them were validated
+
+    # Checkpoints are written in the background while the next epoch trains
+    checkpoint_writer = CheckpointWriter(skip_pretrained=skip_pretrained_weights)
+
+    # Per-stage timings of training steps, if asked for (every process keeps its own, to spot stragglers)
+    profiler = StageProfiler(device, enabled=profile_stages,
+                             metrics_file=metrics_file if n_processes == 1 or metrics_file is None
+                             else '%s.%d' % (metrics_file, rank),
+                             interval=metrics_interval, trace_steps=trace_steps, trace_dir=trace_dir, rank=rank)
+
+    def save_step(epoch, step, wait):
+        """
+        Saves the checkpoint part way through an epoch, after step batches.
+
+        :param wait: wait for it to be written?
+        """
+        if rank == 0:
+            save_checkpoint(data_name, epoch, epochs_since_improvement, encoder_module, decoder_module,
+                            encoder_optimizer, decoder_optimizer, recent_bleu4, False, writer=checkpoint_writer,
+                            step=step, best_bleu4=best_bleu4, best_subset_bleu4=best_subset_bleu4)
+            if wait:
+                checkpoint_writer.wait()
+
+    # Draw random numbers (dropout, DataLoader worker seeds) as the interrupted run would have; only the first
+    # process' generators are saved, the others keep their own
+    if rng is not None and rank == 0:
+        set_rng_states(rng)
 
     # Epochs
     for epoch in range(start_epoch, epochs):
+        resuming = epoch == start_epoch and start_step > 0  # part way through the epoch?
 
         # Decay learning rate if there is no improvement for 8 consecutive epochs, and terminate training after 20
+        # (the optimizer state of a resumed epoch is already decayed)
         if epochs_since_improvement == 20:
             break
-        if epochs_since_improvement > 0 and epochs_since_improvement % 8 == 0:
+        if epochs_since_improvement > 0 and epochs_since_improvement % 8 == 0 and not resuming:
             adjust_learning_rate(decoder_optimizer, 0.8)
             if fine_tune_encoder:
                 adjust_learning_rate(encoder_optimizer, 0.8)
 
         # One epoch's training
-        train(train_loader=train_loader,
-              encoder=encoder,
-              decoder=decoder,
-              criterion=criterion,
-              encoder_optimizer=encoder_optimizer,
-              decoder_optimizer=decoder_optimizer,
-              epoch=epoch)
+        train_sampler.set_epoch(epoch, start_step * batch_size if resuming else 0)  # reshuffle differently every epoch
+        train_loader.generator.manual_seed(shuffle_seed + epoch)
+        stopped = train(train_loader=train_loader,
+                        encoder=encoder,
+                        decoder=decoder,
+                        criterion=criterion,
+                        encoder_optimizer=encoder_optimizer,
+                        decoder_optimizer=decoder_optimizer,
+                        epoch=epoch,
+                        profiler=profiler,
+                        from_prefix=prefix_cache_dir is not None,
+                        start_step=start_step if resuming else 0,
+                        save_step=save_step)
+        if stopped:
+            if rank == 0:
+                print("\nStopped on request; the checkpoint saved will resume this epoch.\n")
+            break
 
         # One epoch's validation
-        recent_bleu4 = validate(val_loader=val_loader,
-                                encoder=encoder,
-                                decoder=decoder,
-                                criterion=criterion)
-
-        # Check if there was an improvement
-        is_best = recent_bleu4 > best_bleu4
-        best_bleu4 = max(recent_bleu4, best_bleu4)
-        if not is_best:
+        full_val = val_subset_loader is None or (epoch + 1) % full_val_every == 0 or epoch + 1 == epochs
+        val_start = time.time()
+        recent_bleu4 = validate(val_loader=val_loader if full_val else val_subset_loader,
+                                encoder=encoder_module,
+                                decoder=decoder_module,
+                                criterion=criterion,
+                                image_references=val_references,
+                                cider_tables=val_cider_tables)
+        val_time = time.time() - val_start
+        if full_val:
+            full_val_time = val_time / len(val_loader.sampler)
+        elif rank == 0 and full_val_time is not None:
+            print(" * Validated on a subset in %.1fs, %.1fs less than all of the validation data\n" % (
+                val_time, full_val_time * len(val_loader.sampler) - val_time))
+
+        # Check if there was an improvement, against the best BLEU-4 computed on the same captions: the best checkpoint
+        # is only picked by validations on all of them
+        if full_val:
+            is_best = improved = recent_bleu4 > best_bleu4
+            best_bleu4 = max(recent_bleu4, best_bleu4)
+        else:
+            is_best = False
+            improved = recent_bleu4 > best_subset_bleu4
+            best_subset_bleu4 = max(recent_bleu4, best_subset_bleu4)
+        if not improved:
             epochs_since_improvement += 1
-            print("\nEpochs since last improvement: %d\n" % (epochs_since_improvement,))
+            if rank == 0:
+                print("\nEpochs since last improvement: %d\n" % (epochs_since_improvement,))
         else:
             epochs_since_improvement = 0
 
-        # Save checkpoint
-        save_checkpoint(data_name, epoch, epochs_since_improvement, encoder, decoder, encoder_optimizer,
-                        decoder_optimizer, recent_bleu4, is_best)
+        # Save checkpoint (every process holds the same weights, so only the first one writes them)
+        if rank == 0:
+            save_checkpoint(data_name, epoch, epochs_since_improvement, encoder_module, decoder_module,
+                            encoder_optimizer, decoder_optimizer, recent_bleu4, is_best, writer=checkpoint_writer,
+                            best_bleu4=best_bleu4, best_subset_bleu4=best_subset_bleu4)
+
+    checkpoint_writer.wait()
+    profiler.close()
+
+    if n_processes > 1:
+        dist.destroy_process_group()
 
+    # Slurm only requeues preempted jobs by itself, not those that run out of time
+    if stop_requested and stop_signal in requeue_signals and rank == 0 and 'SLURM_JOB_ID' in os.environ:
+        print("\nRequeueing job %s to resume from the checkpoint.\n" % os.environ['SLURM_JOB_ID'])
+        subprocess.call(['scontrol', 'requeue', os.environ['SLURM_JOB_ID']])
 
-def train(train_loader, encoder, decoder, criterion, encoder_optimizer, decoder_optimizer, epoch):
+
+def request_stop(signum, frame):
+    """
+    Signal handler asking training to save a checkpoint and stop after the current batch.
+    """
+    global stop_requested, stop_signal
+    stop_requested = True
+    stop_signal = signum
+
+
+def train(train_loader, encoder, decoder, criterion, encoder_optimizer, decoder_optimizer, epoch, profiler=None,
+          from_prefix=False, start_step=0, save_step=None):
     """
     Performs one epoch's training.
 
@@ -143,69 +352,88 @@ def train(train_loader, encoder, decoder, criterion, encoder_optimizer, decoder_
     :param encoder_optimizer: optimizer to update encoder's weights (if fine-tuning)
     :param decoder_optimizer: optimizer to update decoder's weights
     :param epoch: epoch number
+    :param profiler: StageProfiler timing every stage of a step, or None
+    :param from_prefix: does train_loader yield cached prefix activations (see feature_cache) rather than images?
+    :param start_step: batches of the epoch already trained on (train_loader starts after them)
+    :param save_step: function saving a mid-epoch checkpoint, called with the epoch, the batches of the epoch trained
+        on, and whether to wait for it to be written; None to never save one
+    :return: whether training stopped before the end of the epoch, on request
     """
+    if profiler is None:
+        profiler = StageProfiler(device, enabled=False)
 
     decoder.train()  # train mode (dropout and batchnorm is used)
     encoder.train()
 
     batch_time = AverageMeter()  # forward prop. + back prop. time
     data_time = AverageMeter()  # data loading time
-    losses = AverageMeter()  # loss (per word decoded)
-    top5accs = AverageMeter()  # top5 accuracy
+    losses = DeviceAverageMeter()  # loss (per word decoded), only copied to the host when printed
+    top5accs = DeviceAverageMeter()  # top5 accuracy, likewise
 
     start = time.time()
 
     # Batches
     for i, (imgs, caps, caplens) in enumerate(train_loader):
         data_time.update(time.time() - start)
+        profiler.record('data', data_time.val)
 
         # Move to GPU, if available
-        imgs = imgs.to(device)
-        caps = caps.to(device)
-        caplens = caplens.to(device)
+        with profiler.stage('h2d'):
+            imgs = imgs.to(device)
+            caps = caps.to(device)  # caplens stay on the CPU, for the decoder to read decode lengths from
 
         # Forward prop.
-        imgs = encoder(imgs)
-        scores, caps_sorted, decode_lengths, sort_ind = decoder(imgs, caps, caplens)
+        with profiler.stage('encoder'):
+            if from_prefix:
+                imgs = encoder(imgs.float(), from_prefix=True)  # cached in float16
+            else:
+                imgs = encoder(imgs)
+        with profiler.stage('decoder'):
+            scores, caps_sorted, decode_lengths, sort_ind = decoder(imgs, caps, caplens)
 
-        # Since we decoded starting with <start>, the targets are all words after <start>, up to <end>
-        targets = caps_sorted[:, 1:]
+            # Since we decoded starting with <start>, the targets are all words after <start>, up to <end>
+            targets = caps_sorted[:, 1:]
 
-        # Remove timesteps that we didn't decode at, or are pads
-        # pack_padded_sequence is an easy trick to do this
-        scores, _ = pack_padded_sequence(scores, decode_lengths, batch_first=True)
-        targets, _ = pack_padded_sequence(targets, decode_lengths, batch_first=True)
+            # Remove timesteps that we didn't decode at, or are pads
+            # pack_padded_sequence is an easy trick to do this
+            scores = pack_padded_sequence(scores, decode_lengths, batch_first=True).data
+            targets = pack_padded_sequence(targets, decode_lengths, batch_first=True).data
 
-        # Calculate loss
-        loss = criterion(scores, targets)
+            # Calculate loss
+            loss = criterion(scores, targets)
 
         # Back prop.
-        decoder_optimizer.zero_grad()
-        if encoder_optimizer is not None:
-            encoder_optimizer.zero_grad()
-        loss.backward()
+        with profiler.stage('backward'):
+            decoder_optimizer.zero_grad()
+            if encoder_optimizer is not None:
+                encoder_optimizer.zero_grad()
+            loss.backward()
 
         # Clip gradients
-        if grad_clip is not None:
-            clip_gradient(decoder_optimizer, grad_clip)
-            if encoder_optimizer is not None:
-                clip_gradient(encoder_optimizer, grad_clip)
+        with profiler.stage('clip'):
+            if grad_clip is not None:
+                clip_gradient(decoder_optimizer, grad_clip)
+                if encoder_optimizer is not None:
+                    clip_gradient(encoder_optimizer, grad_clip)
 
         # Update weights
-        decoder_optimizer.step()
-        if encoder_optimizer is not None:
-            encoder_optimizer.step()
+        with profiler.stage('optimizer'):
+            decoder_optimizer.step()
+            if encoder_optimizer is not None:
+                encoder_optimizer.step()
 
         # Keep track of metrics
-        top5 = accuracy(scores, targets, 5)
-        losses.update(loss.item(), sum(decode_lengths))
-        top5accs.update(top5, sum(decode_lengths))
+        with profiler.stage('metrics'):
+            n_words = sum(decode_lengths)
+            losses.update(loss, n_words)
+            top5accs.update(correct_topk(scores, targets, 5).double() * (100.0 / n_words), n_words)
         batch_time.update(time.time() - start)
+        profiler.step(epoch, len(caplens), sum(decode_lengths))
 
         start = time.time()
 
         # Print status
-        if i % print_freq == 0:
+        if i % print_freq == 0 and rank == 0:
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Batch Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data Load Time {data_time.val:.3f} ({data_time.avg:.3f})\t'
@@ -214,38 +442,64 @@ def train(train_loader, encoder, decoder, criterion, encoder_optimizer, decoder_
                                                                           batch_time=batch_time,
                                                                           data_time=data_time, loss=losses,
                                                                           top5=top5accs))
-
-
-def validate(val_loader, encoder, decoder, criterion):
+            if profiler.enabled:
+                print(profiler.summary(epoch))
+
+        # Save the checkpoint every step_checkpoint_every batches, and before stopping if asked to (every process has
+        # to stop at the same batch, so they agree on it first, every stop_poll_every batches and at the end of epochs)
+        step = start_step + i + 1
+        stop = stop_requested
+        if dist.is_initialized() and step % stop_poll_every != 0 and i + 1 < len(train_loader):
+            stop = False
+        elif dist.is_initialized():
+            stop = torch.tensor([float(stop)], device=device if dist.get_backend() == 'nccl' else 'cpu')
+            dist.all_reduce(stop, op=dist.ReduceOp.MAX)
+            stop = bool(stop.item())
+        if save_step is not None and (stop or (step_checkpoint_every is not None and
+                                               step % step_checkpoint_every == 0)):
+            save_step(epoch, step, wait=stop)
+        if stop:
+            return True
+
+    return False
+
+
+@torch.inference_mode()
+def validate(val_loader, encoder, decoder, criterion, image_references, cider_tables):
     """
     Performs one epoch's validation.
 
-    :param val_loader: DataLoader for validation data.
+    :param val_loader: DataLoader for validation data, which must not shuffle
     :param encoder: encoder model
     :param decoder: decoder model
     :param criterion: loss layer
-    :return: BLEU-4 score
+    :param image_references: reference captions of every validation image, see CaptionDataset.references
+    :param cider_tables: CIDEr-D tables of these references, see cider.reference_tables
+    :return: BLEU-4 score, over the validation data of all processes if distributed
     """
     decoder.eval()  # eval mode (no dropout or batchnorm)
     if encoder is not None:
         encoder.eval()
 
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top5accs = AverageMeter()
+    losses = DeviceAverageMeter()
+    top5accs = DeviceAverageMeter()
 
     start = time.time()
 
-    references = list()  # references (true captions) for calculating BLEU-4 score
-    hypotheses = list()  # hypotheses (predictions)
+    # The loader doesn't shuffle, so its sampler tells which captions (and so, images) every batch holds
+    indices = torch.LongTensor(list(val_loader.sampler))
+    cpi = val_loader.dataset.cpi
+
+    bleu = BLEU()  # n-gram statistics for BLEU-4, accumulated batch by batch
+    cider = CIDErD(cider_tables)
 
     # Batches
-    for i, (imgs, caps, caplens, allcaps) in enumerate(val_loader):
+    for i, (imgs, caps, caplens, _) in enumerate(val_loader):
 
         # Move to device, if available
         imgs = imgs.to(device)
-        caps = caps.to(device)
-        caplens = caplens.to(device)
+        caps = caps.to(device)  # caplens stay on the CPU, for the decoder to read decode lengths from
 
         # Forward prop.
         if encoder is not None:
@@ -255,65 +509,89 @@ def validate(val_loader, encoder, decoder, criterion):
         # Since we decoded starting with <start>, the targets are all words after <start>, up to <end>
         targets = caps_sorted[:, 1:]
 
+        # Best word at every timestep, for the hypotheses
+        _, preds = torch.max(scores, dim=2)
+
         # Remove timesteps that we didn't decode at, or are pads
         # pack_padded_sequence is an easy trick to do this
-        scores_copy = scores.clone()
-        scores, _ = pack_padded_sequence(scores, decode_lengths, batch_first=True)
-        targets, _ = pack_padded_sequence(targets, decode_lengths, batch_first=True)
+        scores = pack_padded_sequence(scores, decode_lengths, batch_first=True).data
+        targets = pack_padded_sequence(targets, decode_lengths, batch_first=True).data
 
         # Calculate loss
         loss = criterion(scores, targets)
 
         # Keep track of metrics
-        losses.update(loss.item(), sum(decode_lengths))
-        top5 = accuracy(scores, targets, 5)
-        top5accs.update(top5, sum(decode_lengths))
+        n_words = sum(decode_lengths)
+        losses.update(loss, n_words)
+        top5accs.update(correct_topk(scores, targets, 5).double() * (100.0 / n_words), n_words)
         batch_time.update(time.time() - start)
 
         start = time.time()
 
-        if i % print_freq == 0:
+        if i % print_freq == 0 and rank == 0:
             print('Validation: [{0}/{1}]\t'
                   'Batch Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
                   'Top-5 Accuracy {top5.val:.3f} ({top5.avg:.3f})\t'.format(i, len(val_loader), batch_time=batch_time,
                                                                             loss=losses, top5=top5accs))
 
-        # Store references (true captions), and hypothesis (prediction) for each image
+        # References (true captions), and hypothesis (prediction) for each image
         # If for n images, we have n hypotheses, and references a, b, c... for each image, we need -
         # references = [[ref1a, ref1b, ref1c], [ref2a, ref2b], ...], hypotheses = [hyp1, hyp2, ...]
 
-        # References
-        allcaps = allcaps[sort_ind]  # because images were sorted in the decoder
-        for j in range(allcaps.shape[0]):
-            img_caps = allcaps[j].tolist()
-            img_captions = list(
-                map(lambda c: [w for w in c if w not in {word_map['<start>'], word_map['<pad>']}],
-                    img_caps))  # remove <start> and pads
-            references.append(img_captions)
-
-        # Hypotheses
-        _, preds = torch.max(scores_copy, dim=2)
-        preds = preds.tolist()
-        temp_preds = list()
-        for j, p in enumerate(preds):
-            temp_preds.append(preds[j][:decode_lengths[j]])  # remove pads
-        preds = temp_preds
-        hypotheses.extend(preds)
-
-        assert len(references) == len(hypotheses)
+        # References, already tokenized
+        img_inds = indices[i * val_loader.batch_size:(i + 1) * val_loader.batch_size][sort_ind.cpu()] // cpi
+        references = [image_references[j] for j in img_inds.tolist()]  # because images were sorted in the decoder
+
+        # Hypotheses, copied to the host once per batch
+        hypotheses = [p[:l] for p, l in zip(preds.tolist(), decode_lengths)]  # remove pads
+
+        bleu.update(references, hypotheses)
+        cider.update(img_inds.tolist(), hypotheses)
+
+    # Gather every process' n-gram statistics, so that all processes compute the same BLEU-4 (and agree on early
+    # stopping); DistributedSampler pads the data to a multiple of the number of processes, so a few images count twice
+    if dist.is_initialized():
+        gathered = [None] * dist.get_world_size()
+        dist.all_gather_object(gathered, (bleu, cider.total, cider.count))
+        bleu, cider = BLEU(), CIDErD(cider_tables)
+        for process_bleu, cider_total, cider_count in gathered:
+            bleu.merge(process_bleu)
+            cider.merge(cider_total, cider_count)
 
     # Calculate BLEU-4 scores
-    bleu4 = corpus_bleu(references, hypotheses)
+    bleu4 = bleu.score(4)
 
-    print(
-        '\n * LOSS - {loss.avg:.3f}, TOP-5 ACCURACY - {top5.avg:.3f}, BLEU-4 - {bleu}\n'.format(
-            loss=losses,
-            top5=top5accs,
-            bleu=bleu4))
+    if rank == 0:
+        print(
+            '\n * LOSS - {loss.avg:.3f}, TOP-5 ACCURACY - {top5.avg:.3f}, BLEU-4 - {bleu}, CIDEr-D - {cider}\n'.format(
+                loss=losses,
+                top5=top5accs,
+                bleu=bleu4,
+                cider=cider.score()))
 
     return bleu4
 
 
 if __name__ == '__main__':
-    main()
+    if 'WORLD_SIZE' in os.environ:
+        # Launched by torchrun, which sets the rendezvous environment of every process
+        main(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']))
+    elif distributed:
+        # Launch world_size processes on this machine
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        context = mp.spawn(main, args=(world_size,), nprocs=world_size, join=False)
+
+        # The scheduler signals this process only, so pass stop signals on to the ones training
+        def forward_signal(signum, frame):
+            for process in context.processes:
+                if process.is_alive():
+                    os.kill(process.pid, signum)
+
+        for signum in stop_signals:
+            signal.signal(signum, forward_signal)
+        while not context.join():
+            pass
+    else:
+        main()
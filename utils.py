@@ -1,12 +1,15 @@
 import os
+import random
+import shutil
+import threading
 import numpy as np
 import h5py
 import json
 import torch
-from scipy.misc import imread, imresize
 from tqdm import tqdm
 from collections import Counter
 from random import seed, choice, sample
+from imaging import load_image
 
 
 def create_input_files(dataset, karpathy_json_path, image_folder, captions_per_image, min_word_freq, output_folder,
@@ -112,11 +115,7 @@ def create_input_files(dataset, karpathy_json_path, image_folder, captions_per_i
                 assert len(captions) == captions_per_image
 
                 # Read images
-                img = imread(impaths[i])
-                if len(img.shape) == 2:
-                    img = img[:, :, np.newaxis]
-                    img = np.concatenate([img, img, img], axis=2)
-                img = imresize(img, (256, 256))
+                img = load_image(impaths[i])
                 img = img.transpose(2, 0, 1)
                 assert img.shape == (3, 256, 256)
                 assert np.max(img) <= 255
@@ -205,11 +204,175 @@ def clip_gradient(optimizer, grad_clip):
                 param.grad.data.clamp_(-grad_clip, grad_clip)
 
 
+def snapshot(obj):
+    """
+    Copies the tensors of a (nested) state_dict to CPU memory, so that it can be serialized while training goes on.
+
+    :param obj: state_dict, or any nesting of dicts, lists and tuples of tensors and plain values
+    :return: copy, with every tensor on the CPU
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def model_config(encoder, decoder):
+    """
+    Records the arguments the encoder and decoder were built with, so that they can be rebuilt from their state_dicts.
+
+    :param encoder: encoder model
+    :param decoder: decoder model
+    :return: config
+    """
+    return {'encoder': {'encoded_image_size': encoder.enc_image_size,
+                        'backbone': encoder.backbone,
+                        'weights': encoder.weights,
+                        'cache_dir': encoder.cache_dir,
+                        'pooled': encoder.pooled},
+            'decoder': {'embed_dim': decoder.embed_dim,
+                        'decoder_dim': decoder.decoder_dim,
+                        'vocab_size': decoder.vocab_size,
+                        'encoder_dim': decoder.encoder_dim,
+                        'dropout': decoder.dropout.p,
+                        'encoded_image_size': int(round(decoder.num_pixels ** 0.5))}}
+
+
+def pretrained_keys(encoder):
+    """
+    Finds the frozen encoder weights that are still identical to those of the pretrained backbone; these needn't be
+    saved, since rebuilding the encoder reloads them.
+
+    Only parameters qualify: the frozen prefix keeps its pretrained BatchNorm running statistics (see Encoder.train),
+    but the blocks after it update theirs in train mode even when they aren't fine-tuned.
+
+    :param encoder: encoder model
+    :return: set of state_dict keys
+    """
+    if encoder.weights is None:
+        return set()
+    from models import Encoder
+
+    pretrained = Encoder(encoder.enc_image_size, encoder.backbone, encoder.weights, encoder.cache_dir).state_dict()
+    return {k for k, p in encoder.named_parameters()
+            if not p.requires_grad and torch.equal(p.detach().cpu(), pretrained[k])}
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints on a background thread.
+
+    save_checkpoint snapshots the state_dicts to CPU memory before handing them over, so training resumes as soon as
+    the copy is made. Files are written under a temporary name and renamed into place, so that an interrupted write
+    never clobbers the previous checkpoint.
+    """
+
+    def __init__(self, skip_pretrained=True):
+        """
+        :param skip_pretrained: leave out frozen encoder weights that are identical to the pretrained backbone?
+        """
+        self.skip_pretrained = skip_pretrained
+        self.thread = None
+        self.error = None
+        self.frozen = None  # frozen encoder parameters the last time they were compared to the pretrained backbone
+        self.skipped = set()
+
+    def skipped_keys(self, encoder):
+        """
+        :param encoder: encoder model
+        :return: state_dict keys of the encoder that needn't be saved
+        """
+        if not self.skip_pretrained:
+            return set()
+        frozen = frozenset(k for k, p in encoder.named_parameters() if not p.requires_grad)
+        if frozen != self.frozen:  # only compare again if fine-tuning was switched on or off
+            self.frozen = frozen
+            self.skipped = pretrained_keys(encoder)
+        return self.skipped
+
+    def submit(self, state, filename, is_best):
+        """
+        Writes a checkpoint in the background, once the previous one is written.
+
+        :param state: checkpoint, with every tensor already on the CPU
+        :param filename: path to save it to
+        :param is_best: also make it the BEST_ checkpoint?
+        """
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(state, filename, is_best))
+        self.thread.start()
+
+    def write(self, state, filename, is_best):
+        try:
+            write_checkpoint(state, filename, is_best)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Blocks until the checkpoint being written is on disk, and raises any error writing it.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def write_checkpoint(state, filename, is_best):
+    """
+    Writes a checkpoint atomically (temporary file, then rename).
+
+    :param state: checkpoint
+    :param filename: path to save it to
+    :param is_best: also make it the BEST_ checkpoint?
+    """
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+    # If this checkpoint is the best so far, store a copy so it doesn't get overwritten by a worse checkpoint
+    # A hard link costs nothing and stays valid, since the next checkpoint is renamed over the name, not written into it
+    if is_best:
+        best_filename = os.path.join(os.path.dirname(filename), 'BEST_' + os.path.basename(filename))
+        try:
+            os.link(filename, best_filename + '.tmp')
+        except OSError:  # no hard links on this file system
+            shutil.copyfile(filename, best_filename + '.tmp')
+        os.replace(best_filename + '.tmp', best_filename)
+
+
+def rng_states():
+    """
+    :return: states of the Python, numpy and PyTorch (CPU and CUDA) random number generators
+    """
+    return {'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_states(states):
+    """
+    Restores random number generators saved by rng_states.
+    """
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if states['cuda'] is not None and torch.cuda.is_available() and len(states['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
 def save_checkpoint(data_name, epoch, epochs_since_improvement, encoder, decoder, encoder_optimizer, decoder_optimizer,
-                    bleu4, is_best):
+                    bleu4, is_best, writer=None, step=None, best_bleu4=None, best_subset_bleu4=None):
     """
     Saves model checkpoint.
 
+    Only state_dicts are saved; load_checkpoint rebuilds the models from them. The states of the random number
+    generators are saved too, so that a resumed run draws what the interrupted one would have.
+
     :param data_name: base name of processed dataset
     :param epoch: epoch number
     :param epochs_since_improvement: number of epochs since last improvement in BLEU-4 score
@@ -219,19 +382,107 @@ def save_checkpoint(data_name, epoch, epochs_since_improvement, encoder, decoder
     :param decoder_optimizer: optimizer to update decoder's weights
     :param bleu4: validation BLEU-4 score for this epoch
     :param is_best: is this checkpoint the best so far?
+    :param writer: CheckpointWriter to save in the background with, None to save right away
+    :param step: batches of the epoch trained on, if saving mid-epoch; None if the epoch is over
+    :param best_bleu4: best validation BLEU-4 score so far
+    :param best_subset_bleu4: best BLEU-4 score so far on the validation subset, if validating on one
     """
+    skipped = writer.skipped_keys(encoder) if writer is not None else set()
     state = {'epoch': epoch,
              'epochs_since_improvement': epochs_since_improvement,
              'bleu-4': bleu4,
-             'encoder': encoder,
-             'decoder': decoder,
-             'encoder_optimizer': encoder_optimizer,
-             'decoder_optimizer': decoder_optimizer}
+             'config': model_config(encoder, decoder),
+             'encoder': snapshot({k: v for k, v in encoder.state_dict().items() if k not in skipped}),
+             'encoder_skipped': sorted(skipped),
+             'encoder_fine_tuned': encoder_optimizer is not None,
+             'decoder': snapshot(decoder.state_dict()),
+             'encoder_optimizer': snapshot(encoder_optimizer.state_dict()) if encoder_optimizer is not None else None,
+             'decoder_optimizer': snapshot(decoder_optimizer.state_dict()),
+             'step': step,
+             'best_bleu-4': best_bleu4 if best_bleu4 is not None else bleu4,
+             'best_subset_bleu-4': best_subset_bleu4,
+             'rng': rng_states()}
     filename = 'checkpoint_' + data_name + '.pth.tar'
-    torch.save(state, filename)
-    # If this checkpoint is the best so far, store a copy so it doesn't get overwritten by a worse checkpoint
-    if is_best:
-        torch.save(state, 'BEST_' + filename)
+    if writer is None:
+        write_checkpoint(state, filename, is_best)
+    else:
+        writer.submit(state, filename, is_best)
+
+
+def load_checkpoint(checkpoint_path, mmap=False):
+    """
+    Loads a checkpoint onto the CPU, rebuilding its models if it holds state_dicts.
+
+    Checkpoints that pickled whole models and optimizers (older ones, and older quantized artifacts) are read as they
+    are. Either way, the models come back as modules and the optimizers as state_dicts (or None). Quantized artifacts
+    are rebuilt by quantize.load_quantized.
+
+    Inference artifacts written by export.py hold every weight, so their models are rebuilt without loading the
+    pretrained backbone, or even allocating and initializing weights: the models take the artifact's tensors as they
+    are (upcast to float32 if they were saved as float16).
+
+    :param checkpoint_path: path to checkpoint
+    :param mmap: memory-map the checkpoint's tensors rather than read them, so that only those used are ever read (files
+                 in the legacy, non-zip serialization format are read as usual)
+    :return: checkpoint
+    """
+    try:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False, mmap=mmap)
+    except RuntimeError:
+        if not mmap:
+            raise
+        checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    if checkpoint.get('inference', False):
+        from models import Encoder, Decoder
+
+        with torch.device('meta'):
+            encoder = Encoder(**dict(checkpoint['config']['encoder'], weights=None))
+            decoder = Decoder(**checkpoint['config']['decoder'])
+        encoder.load_state_dict(checkpoint['encoder'], assign=True)
+        decoder.load_state_dict(checkpoint['decoder'], assign=True)
+        checkpoint['encoder'], checkpoint['decoder'] = encoder.float(), decoder.float()
+    elif checkpoint.get('quantized', False) and isinstance(checkpoint['encoder'], dict):
+        from quantize import load_quantized
+
+        checkpoint['encoder'], checkpoint['decoder'] = load_quantized(checkpoint)
+    elif isinstance(checkpoint['encoder'], dict):
+        from models import Encoder, Decoder
+
+        # Rebuilding the encoder reloads the pretrained weights that weren't saved
+        encoder = Encoder(**checkpoint['config']['encoder'])
+        encoder.fine_tune(checkpoint['encoder_fine_tuned'])
+        missing, unexpected = encoder.load_state_dict(checkpoint['encoder'], strict=False)
+        assert set(missing) == set(checkpoint['encoder_skipped']) and not unexpected
+        decoder = Decoder(**checkpoint['config']['decoder'])
+        decoder.load_state_dict(checkpoint['decoder'])
+        checkpoint['encoder'], checkpoint['decoder'] = encoder, decoder
+    for name in ('encoder_optimizer', 'decoder_optimizer'):
+        if isinstance(checkpoint.get(name), torch.optim.Optimizer):
+            checkpoint[name] = checkpoint[name].state_dict()
+    return checkpoint
+
+
+def load_model(checkpoint_path, device):
+    """
+    Loads the encoder and decoder of a checkpoint for inference.
+
+    Quantized artifacts (see quantize.py) can only run on the CPU, so they are always loaded there. Checkpoints are
+    memory-mapped, so that parts not needed here (like optimizer states) are never read.
+
+    :param checkpoint_path: path to checkpoint (or artifact written by quantize.py or export.py)
+    :param device: device to move the models to
+    :return: encoder, decoder, device the models were moved to
+    """
+    checkpoint = load_checkpoint(checkpoint_path, mmap=True)
+    if checkpoint.get('quantized', False):
+        device = torch.device('cpu')
+    encoder = checkpoint['encoder'].to(device)
+    encoder.eval()
+    decoder = checkpoint['decoder'].to(device)
+    decoder.eval()
+    # Decoders without attention only use the image features pooled over pixels, so have the encoder return just that
+    encoder.pooled = not hasattr(decoder, 'attention')
+    return encoder, decoder, device
 
 
 class AverageMeter(object):
@@ -255,6 +506,46 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class DeviceAverageMeter(object):
+    """
+    AverageMeter for 0D tensors, which keeps its sums on their device.
+
+    Updating it doesn't wait for the device; val, avg and sum are only copied to the host when they're read (e.g. to
+    print them), which is when the device is synchronized.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._val = 0.
+        self._sum = 0.
+        self.count = 0
+
+    def update(self, val, n=1):
+        """
+        :param val: 0D tensor (or number)
+        :param n: number of items val is the average of, a Python number
+        """
+        if torch.is_tensor(val):
+            val = val.detach().double()  # summed in double precision, like the Python floats of AverageMeter
+        self._val = val
+        self._sum = self._sum + val * n
+        self.count += n
+
+    @property
+    def val(self):
+        return float(self._val)
+
+    @property
+    def sum(self):
+        return float(self._sum)
+
+    @property
+    def avg(self):
+        return self.sum / self.count
+
+
 def adjust_learning_rate(optimizer, shrink_factor):
     """
     Shrinks learning rate by a specified factor.
@@ -284,3 +575,16 @@ def accuracy(scores, targets, k):
     correct = ind.eq(targets.view(-1, 1).expand_as(ind))
     correct_total = correct.view(-1).float().sum()  # 0D tensor
     return correct_total.item() * (100.0 / batch_size)
+
+
+def correct_topk(scores, targets, k):
+    """
+    Counts top-k correct predictions, without copying the count to the host.
+
+    :param scores: scores from the model
+    :param targets: true labels
+    :param k: k in top-k accuracy
+    :return: number of targets in the top-k predictions, a 0D tensor on the device of scores
+    """
+    _, ind = scores.topk(k, 1, True, True)
+    return ind.eq(targets.view(-1, 1)).sum()